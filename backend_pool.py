@@ -0,0 +1,157 @@
+import asyncio
+import random
+from contextlib import asynccontextmanager
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import grpc
+
+from metrics import Gauge
+
+BACKENDS = Gauge("ark_backends", "Backends known to this worker", ["state"])
+BACKEND_INFLIGHT = Gauge("ark_backend_inflight", "Calls in flight per backend", ["backend"])
+
+
+class Backend:
+    """
+    One gRPC backend and its pooled channel, opened on first use.
+    """
+
+    __slots__ = ("target", "inflight", "draining", "_channel", "_channel_factory", "_inflight_gauge")
+
+    def __init__(self, target: str, channel_factory: Callable[[str], grpc.aio.Channel]):
+        self.target = target
+        self.inflight = 0
+        self.draining = False
+        self._channel: Optional[grpc.aio.Channel] = None
+        self._channel_factory = channel_factory
+        self._inflight_gauge = BACKEND_INFLIGHT.labels(target)
+
+    @property
+    def channel(self) -> grpc.aio.Channel:
+        if self._channel is None:
+            self._channel = self._channel_factory(self.target)
+        return self._channel
+
+    async def close(self) -> None:
+        channel, self._channel = self._channel, None
+        BACKEND_INFLIGHT.remove(self.target)
+        if channel is not None:
+            await channel.close()
+
+
+class BackendPool:
+    """
+    The set of backends requests are dispatched to, replaced atomically by `update`.
+
+    A backend dropped from the set is drained: it gets no new calls, calls already in
+    flight on it finish, and its channel is closed when the last one does.
+    """
+
+    def __init__(self, targets: Sequence[str], channel_factory: Callable[[str], grpc.aio.Channel]):
+        self._channel_factory = channel_factory
+        self._active: Tuple[Backend, ...] = ()
+        self._by_target: Dict[str, Backend] = {}
+        self._draining: Dict[str, Backend] = {}
+        self._listeners: List[Callable[[List[str], List[str]], None]] = []
+        self._close_tasks = set()
+        BACKENDS.labels("active").set_function(lambda: len(self._active))
+        BACKENDS.labels("draining").set_function(lambda: len(self._draining))
+        self.update(targets)
+
+    @property
+    def targets(self) -> List[str]:
+        return [backend.target for backend in self._active]
+
+    def add_listener(self, listener: Callable[[List[str], List[str]], None]) -> None:
+        """
+        Call listener(added, removed) whenever the backend set changes
+        """
+        self._listeners.append(listener)
+
+    def update(self, targets: Iterable[str]) -> None:
+        targets = list(dict.fromkeys(target for target in targets if target))
+        if not targets:
+            return  # never drop every backend on an empty discovery result
+        added = [target for target in targets if target not in self._by_target]
+        removed = [target for target in self._by_target if target not in targets]
+        if not added and not removed:
+            return
+
+        by_target = {}
+        for target in targets:
+            backend = self._by_target.get(target) or self._draining.pop(target, None)
+            if backend is None:
+                backend = Backend(target, self._channel_factory)
+            backend.draining = False
+            by_target[target] = backend
+        for target in removed:
+            backend = self._by_target[target]
+            backend.draining = True
+            self._draining[target] = backend
+            if backend.inflight == 0:
+                self._close(backend)
+        self._by_target = by_target
+        self._active = tuple(by_target.values())
+
+        for listener in self._listeners:
+            listener(added, removed)
+
+    def get(self, target: str) -> Optional[Backend]:
+        return self._by_target.get(target)
+
+    def pick(
+        self, exclude: Iterable[str] = (), allow: Optional[Callable[[str], bool]] = None
+    ) -> Optional[Backend]:
+        """
+        A random active backend not in `exclude` for which `allow(target)` holds, if any
+        """
+        candidates = self._active
+        if exclude:
+            excluded = set(exclude)
+            candidates = tuple(backend for backend in candidates if backend.target not in excluded)
+        if allow is None:
+            return candidates[random.randint(0, len(candidates) - 1)] if candidates else None
+        # allow may have side effects such as granting a probe, so only call it until one passes
+        for backend in random.sample(candidates, len(candidates)):
+            if allow(backend.target):
+                return backend
+        return None
+
+    def pick_many(self, count: int, allow: Optional[Callable[[str], bool]] = None) -> List[Backend]:
+        """
+        Distinct backends passing `allow`, as many as available up to count
+        """
+        picked = []
+        for backend in random.sample(self._active, len(self._active)):
+            if len(picked) == count:
+                break
+            if allow is None or allow(backend.target):
+                picked.append(backend)
+        return picked
+
+    @asynccontextmanager
+    async def lease(self, backend: Backend):
+        backend.inflight += 1
+        backend._inflight_gauge.inc()
+        try:
+            yield backend.channel
+        finally:
+            backend.inflight -= 1
+            backend._inflight_gauge.dec()
+            if backend.draining and backend.inflight == 0:
+                self._close(backend)
+
+    def _close(self, backend: Backend) -> None:
+        if self._draining.get(backend.target) is backend:
+            del self._draining[backend.target]
+        try:
+            task = asyncio.get_running_loop().create_task(backend.close())
+        except RuntimeError:
+            return  # no loop yet, so no channel was opened either
+        self._close_tasks.add(task)
+        task.add_done_callback(self._close_tasks.discard)
+
+    async def close(self) -> None:
+        backends = list(self._active) + list(self._draining.values())
+        self._draining.clear()
+        await asyncio.gather(*(backend.close() for backend in backends), return_exceptions=True)
@@ -0,0 +1,122 @@
+"""
+CPU cost against bytes saved of compressing image-heavy chat completion traffic, for
+the HTTP request body, the gRPC request to the backend (default and
+compat_llmserver_vlm_v1 encodings) and a long non-streaming response.
+
+The break-even column is the link speed below which compressing pays off: bytes saved
+per second of compress plus decompress CPU.
+
+    python benchmarks/bench_compression.py [--images 4] [--image-kb 512] [--repeat 5]
+"""
+import argparse
+import base64
+import json
+import os
+import random
+import sys
+import time
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from compression import zstandard
+from encode_cache import EncodedValueCache
+from openai_protocol import ChatCompletionRequest
+from request_builder import RequestBuilder
+
+
+def gzip_compress(data: bytes, level: int) -> bytes:
+    encoder = zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    return encoder.compress(data) + encoder.flush()
+
+
+def codecs():
+    for level in (1, 6, 9):
+        yield f"gzip-{level}", (
+            lambda data, level=level: gzip_compress(data, level),
+            lambda data: zlib.decompress(data, zlib.MAX_WBITS | 16),
+        )
+    if zstandard is not None:
+        for level in (1, 3, 9):
+            yield f"zstd-{level}", (
+                lambda data, level=level: zstandard.ZstdCompressor(level=level).compress(data),
+                lambda data: zstandard.ZstdDecompressor().decompress(data),
+            )
+
+
+def photo(size: int, rng: random.Random) -> bytes:
+    # entropy-coded image data, eg. JPEG, is close to incompressible
+    return b"\xff\xd8\xff\xe0" + rng.randbytes(size - 4)
+
+
+def screenshot(size: int, rng: random.Random) -> bytes:
+    # flat regions and repeated rows, eg. a PNG of a UI with weak filtering
+    row = bytes(rng.choice((0, 0, 0, 255, 128)) for _ in range(1024))
+    return b"\x89PNG\r\n\x1a\n" + (row * (size // len(row) + 1))[: size - 8]
+
+
+def make_body(images: int, image_bytes: int, kind) -> dict:
+    rng = random.Random(0)
+    content = [{"type": "text", "text": "Describe the differences between these images."}]
+    for _ in range(images):
+        url = "data:image/jpeg;base64," + base64.b64encode(kind(image_bytes, rng)).decode()
+        content.append({"type": "image_url", "image_url": {"url": url}})
+    return {"model": "doubao-vision", "messages": [{"role": "user", "content": content}], "max_tokens": 512}
+
+
+def response_body(chars: int) -> bytes:
+    rng = random.Random(0)
+    words = "the model answers with ordinary prose about images tables and code".split()
+    text = " ".join(rng.choice(words) for _ in range(chars // 6))
+    return json.dumps({"choices": [{"message": {"role": "assistant", "content": text}}]}).encode()
+
+
+def measure(compress, decompress, data: bytes, repeat: int):
+    compressed = compress(data)
+    assert decompress(compressed) == data
+    start = time.perf_counter()
+    for _ in range(repeat):
+        compress(data)
+    compress_seconds = (time.perf_counter() - start) / repeat
+    start = time.perf_counter()
+    for _ in range(repeat):
+        decompress(compressed)
+    decompress_seconds = (time.perf_counter() - start) / repeat
+    return len(compressed), compress_seconds, decompress_seconds
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--images", type=int, default=4)
+    parser.add_argument("--image-kb", type=int, default=512)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    cases = []
+    for name, kind in (("photo", photo), ("screenshot", screenshot)):
+        body = make_body(args.images, args.image_kb * 1024, kind)
+        cases.append((f"http {name}", json.dumps(body).encode()))
+        for compat in (False, True):
+            builder = RequestBuilder(EncodedValueCache("bench_tools", 0), EncodedValueCache("bench_rf", 0), compat)
+            leg = "grpc-vlm-v1" if compat else "grpc"
+            # message content parts validate to one-shot iterators, so every build needs its own request
+            request = ChatCompletionRequest.model_validate(body)
+            cases.append((f"{leg} {name}", builder.build(request).SerializeToString()))
+    cases.append(("response text", response_body(64 * 1024)))
+
+    print(f"{'payload':>22} {'codec':>7} {'MiB':>7} {'ratio':>6} {'comp ms':>8} {'decomp ms':>9} {'break-even':>11}")
+    for name, data in cases:
+        for codec, (compress, decompress) in codecs():
+            size, compress_seconds, decompress_seconds = measure(compress, decompress, data, args.repeat)
+            saved_mbit = (len(data) - size) * 8 / 1e6
+            break_even = saved_mbit / (compress_seconds + decompress_seconds)
+            print(
+                f"{name:>22} {codec:>7} {len(data) / 2**20:>7.2f} {size / len(data):>6.3f} "
+                f"{compress_seconds * 1e3:>8.2f} {decompress_seconds * 1e3:>9.2f} {break_even:>6.0f} Mbit/s"
+            )
+    if zstandard is None:
+        print("zstandard is not installed, zstd skipped")
+
+
+if __name__ == "__main__":
+    main()
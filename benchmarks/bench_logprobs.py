@@ -0,0 +1,118 @@
+"""
+Serialization time of the logprobs of one completion at top_logprobs=20, columnar
+LogprobsEncoder against nested dicts and against the openai_protocol models.
+
+    python benchmarks/bench_logprobs.py [--tokens 256] [--top 20] [--repeat 20]
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from logprobs import LOGPROBS, TOKEN_IDS, TOKENS, TOP_LOGPROBS, TOP_TOKEN_IDS, TOP_TOKENS, LogprobsEncoder, TokenTable
+from openai_protocol import ChatCompletionLogProb, ChatCompletionLogProbs, ChatCompletionLogProbsContent
+from proto import ark_pb2
+
+
+def make_responses(tokens: int, top: int, per_chunk: int, with_strings: bool):
+    rng = random.Random(0)
+    vocab = [f"t{i}".encode() if i % 7 else f" wörd{i}".encode() for i in range(32000)]
+    responses = []
+    for start in range(0, tokens, per_chunk):
+        count = min(per_chunk, tokens - start)
+        ids = [rng.randrange(len(vocab)) for _ in range(count)]
+        top_ids = [rng.randrange(len(vocab)) for _ in range(count * top)]
+        response = ark_pb2.InferenceResponse()
+        response.outputs[TOKEN_IDS].int64_list.values.extend(ids)
+        response.outputs[LOGPROBS].float_list.values.extend(-rng.expovariate(2.0) for _ in ids)
+        response.outputs[TOP_TOKEN_IDS].int64_list.values.extend(top_ids)
+        response.outputs[TOP_LOGPROBS].float_list.values.extend(-rng.expovariate(1.0) for _ in top_ids)
+        if with_strings:
+            response.outputs[TOKENS].bytes_list.values.extend(vocab[i] for i in ids)
+            response.outputs[TOP_TOKENS].bytes_list.values.extend(vocab[i] for i in top_ids)
+        responses.append(response)
+    return responses
+
+
+def token_of(outputs, key, i, token_id) -> dict:
+    if key in outputs:
+        token = outputs[key].bytes_list.values[i]
+        return {"token": token.decode(errors="replace"), "bytes": list(token)}
+    return {"token": f"token_id:{token_id}", "bytes": None}
+
+
+def as_dicts(responses):
+    content = []
+    for response in responses:
+        outputs = response.outputs
+        ids = list(outputs[TOKEN_IDS].int64_list.values)
+        logprobs = list(outputs[LOGPROBS].float_list.values)
+        top_ids = list(outputs[TOP_TOKEN_IDS].int64_list.values)
+        top_logprobs = list(outputs[TOP_LOGPROBS].float_list.values)
+        k = len(top_ids) // len(ids)
+        for i, token_id in enumerate(ids):
+            token = token_of(outputs, TOKENS, i, token_id)
+            tops = []
+            for j in range(i * k, i * k + k):
+                top = token_of(outputs, TOP_TOKENS, j, top_ids[j])
+                tops.append({"token": top["token"], "logprob": top_logprobs[j], "bytes": top["bytes"]})
+            content.append(
+                {"token": token["token"], "logprob": logprobs[i], "bytes": token["bytes"], "top_logprobs": tops}
+            )
+    return json.dumps({"content": content}, ensure_ascii=False)
+
+
+def as_models(responses):
+    content = []
+    for response in responses:
+        outputs = response.outputs
+        ids = outputs[TOKEN_IDS].int64_list.values
+        logprobs = outputs[LOGPROBS].float_list.values
+        top_ids = outputs[TOP_TOKEN_IDS].int64_list.values
+        top_logprobs = outputs[TOP_LOGPROBS].float_list.values
+        k = len(top_ids) // len(ids)
+        for i, token_id in enumerate(ids):
+            token = token_of(outputs, TOKENS, i, token_id)
+            tops = [
+                ChatCompletionLogProb(logprob=top_logprobs[j], **token_of(outputs, TOP_TOKENS, j, top_ids[j]))
+                for j in range(i * k, i * k + k)
+            ]
+            content.append(ChatCompletionLogProbsContent(logprob=logprobs[i], top_logprobs=tops, **token))
+    return ChatCompletionLogProbs(content=content).model_dump_json()
+
+
+def as_columns(encoder: LogprobsEncoder, responses):
+    entries = []
+    for response in responses:
+        entries.extend(encoder.encode(response.outputs))
+    return encoder.content(entries)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tokens", type=int, default=256)
+    parser.add_argument("--top", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    print(f"{'strings':>8} {'tokens/chunk':>12} {'models ms':>10} {'dicts ms':>9} {'columnar ms':>12} {'vs dicts':>9}")
+    for with_strings in (False, True):
+        for per_chunk in (1, 16):
+            responses = make_responses(args.tokens, args.top, per_chunk, with_strings)
+            encoder = LogprobsEncoder(TokenTable())
+            assert json.loads(as_columns(encoder, responses)) == json.loads(as_dicts(responses))
+            models = timeit.timeit(lambda: as_models(responses), number=args.repeat) / args.repeat
+            dicts = timeit.timeit(lambda: as_dicts(responses), number=args.repeat) / args.repeat
+            columns = timeit.timeit(lambda: as_columns(encoder, responses), number=args.repeat) / args.repeat
+            print(
+                f"{'backend' if with_strings else 'ids':>8} {per_chunk:>12} {models * 1e3:>10.2f} "
+                f"{dicts * 1e3:>9.2f} {columns * 1e3:>12.2f} {dicts / columns:>8.2f}x"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+"""
+Compare full pydantic validation of a chat completion body against fast_parser.
+
+    python benchmarks/bench_parse.py [--repeat 100]
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fast_parser import parse_chat_completion_request
+from openai_api_server import make_ark_req
+from openai_protocol import ChatCompletionRequest
+
+
+def make_body(num_messages: int) -> bytes:
+    messages = [{"role": "system", "content": "You are a helpful assistant. " * 20}]
+    for i in range(num_messages - 1):
+        if i % 2 == 0:
+            messages.append({"role": "user", "content": f"Question {i}: " + "lorem ipsum dolor sit amet " * 30})
+        else:
+            messages.append({"role": "assistant", "content": f"Answer {i}: " + "consectetur adipiscing elit " * 40})
+    return json.dumps(
+        {"model": "deepseek-r1-0528", "messages": messages[:num_messages], "temperature": 0.6, "max_tokens": 1024}
+    ).encode()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=100)
+    args = parser.parse_args()
+
+    print(f"{'messages':>8} {'pydantic us':>12} {'fast us':>10} {'speedup':>8} {'+make_ark_req us':>17}")
+    for num_messages in (1, 50, 500):
+        body = make_body(num_messages)
+        # keep the slow full validation of long conversations within a sane wall time
+        number = max(2, args.repeat * 10 // num_messages)
+        full = timeit.timeit(lambda: ChatCompletionRequest.model_validate_json(body), number=number)
+        fast = timeit.timeit(lambda: parse_chat_completion_request(body), number=number)
+        end_to_end = timeit.timeit(lambda: make_ark_req(parse_chat_completion_request(body)), number=number)
+        print(
+            f"{num_messages:>8} {full / number * 1e6:>12.1f} {fast / number * 1e6:>10.1f} "
+            f"{full / fast:>7.1f}x {end_to_end / number * 1e6:>17.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
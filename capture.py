@@ -0,0 +1,236 @@
+import gzip
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+from typing import Any, Dict, List, Optional, Sequence
+
+from metrics import Counter
+
+logger = logging.getLogger(__name__)
+
+CAPTURE_RECORDS = Counter("ark_capture_records_total", "Sampled request captures by outcome", ["result"])
+
+# keys kept verbatim when redacting a structure, so redacted requests still replay
+_STRUCTURAL_KEYS = frozenset(("type", "role"))
+
+
+def _mask(value: Any) -> Any:
+    if isinstance(value, str):
+        # same length, so prompt sizes survive for replay
+        return "x" * len(value)
+    if isinstance(value, list):
+        return [_mask(item) for item in value]
+    if isinstance(value, dict):
+        return {key: item if key in _STRUCTURAL_KEYS else _mask(item) for key, item in value.items()}
+    return value
+
+
+def _redact_path(value: Any, path: Sequence[str]) -> Any:
+    if isinstance(value, list):
+        return [_redact_path(item, path) for item in value]
+    if not path:
+        return _mask(value)
+    if isinstance(value, dict) and path[0] in value:
+        value = dict(value)
+        value[path[0]] = _redact_path(value[path[0]], path[1:])
+    return value
+
+
+def redact(body: Dict[str, Any], paths: Sequence[Sequence[str]]) -> Dict[str, Any]:
+    """
+    Copy of `body` with the strings under each dotted path masked; lists are walked through,
+    eg. ("messages", "content") masks the content of every message
+    """
+    for path in paths:
+        body = _redact_path(body, path)
+    return body
+
+
+class CaptureRecord:
+    """
+    Summary of one sampled request, filled in as its response streams.
+    """
+
+    __slots__ = ("capture", "body", "ts", "start", "first_chunk", "chunks", "usage", "finish_reasons", "error")
+
+    def __init__(self, capture: "Capture", body: Dict[str, Any]):
+        self.capture = capture
+        self.body = body
+        self.ts = time.time()
+        self.start = time.perf_counter()
+        self.first_chunk: Optional[float] = None
+        self.chunks = 0
+        self.usage: Dict[int, Dict[str, int]] = {}
+        self.finish_reasons: Dict[int, str] = {}
+        self.error: Optional[str] = None
+
+    def add(self, response) -> None:
+        """
+        Account one InferenceResponse
+        """
+        if self.first_chunk is None:
+            self.first_chunk = time.perf_counter()
+        self.chunks += 1
+        outputs = response.outputs
+        index = outputs["choice.index"].int64_
+        finish_reason = outputs["choice.finish_reason"].bytes_.decode()
+        if finish_reason:
+            self.finish_reasons[index] = finish_reason
+        if "usage" in outputs:
+            fields = outputs["usage"].struct_.fields
+            self.usage[index] = {
+                "prompt_tokens": fields["prompt_tokens"].int64_,
+                "completion_tokens": fields["completion_tokens"].int64_,
+                "reasoning_tokens": fields["completion_tokens_details"].struct_.fields["reasoning_tokens"].int64_,
+            }
+
+    def finish(self, status: int = 200, error: Optional[str] = None) -> None:
+        end = time.perf_counter()
+        usage = {}
+        if self.usage:
+            usage = {
+                # prompt tokens are shared by every choice of the request
+                "prompt_tokens": max(choice["prompt_tokens"] for choice in self.usage.values()),
+                "completion_tokens": sum(choice["completion_tokens"] for choice in self.usage.values()),
+                "reasoning_tokens": sum(choice["reasoning_tokens"] for choice in self.usage.values()),
+            }
+        self.capture.writer.submit(
+            {
+                "ts": self.ts,
+                "request": self.body,
+                "response": {
+                    "status": status,
+                    "error": error or self.error,
+                    "chunks": self.chunks,
+                    "ttft": None if self.first_chunk is None else self.first_chunk - self.start,
+                    "e2e": end - self.start,
+                    "usage": usage,
+                    "finish_reason": {str(index): reason for index, reason in sorted(self.finish_reasons.items())},
+                },
+            }
+        )
+
+
+class CaptureWriter:
+    """
+    Appends capture records as JSON lines to gzip files from a daemon thread.
+
+    Files are named capture-<start time>-<pid>-<seq>.jsonl.gz, so every worker writes
+    its own. Each batch is appended as a complete gzip member, so a file is readable
+    while it is still being written. A new file is started once one holds `max_bytes`
+    and only the newest `max_files` of this worker are kept. When the queue is full
+    new records are dropped.
+    """
+
+    def __init__(self, directory: str, max_bytes: int, max_files: int = 0, max_queue: int = 4096):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self._queue: "queue.Queue[Optional[Dict[str, Any]]]" = queue.Queue(maxsize=max_queue)
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self._file = None
+        self._files: List[str] = []
+        self._seq = 0
+
+    def submit(self, record: Dict[str, Any]) -> None:
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="capture-writer", daemon=True)
+                    self._thread.start()
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            CAPTURE_RECORDS.labels("dropped").inc()
+
+    def _open(self) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        self._seq += 1
+        path = os.path.join(
+            self.directory, "capture-{}-{}-{:04d}.jsonl.gz".format(time.strftime("%Y%m%d-%H%M%S"), os.getpid(), self._seq)
+        )
+        self._file = open(path, "wb")
+        self._files.append(path)
+        while self.max_files and len(self._files) > self.max_files:
+            try:
+                os.remove(self._files.pop(0))
+            except OSError as e:
+                logger.warning("cannot remove old capture file: %s", e)
+
+    def _close_file(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _write(self, batch: List[Dict[str, Any]]) -> None:
+        if self._file is None:
+            self._open()
+        data = "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in batch).encode()
+        self._file.write(gzip.compress(data))
+        self._file.flush()
+        if self._file.tell() >= self.max_bytes:
+            self._close_file()
+
+    def _run(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < 256:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = batch[-1] is None
+            batch = [record for record in batch if record is not None]
+            try:
+                if batch:
+                    self._write(batch)
+                CAPTURE_RECORDS.labels("written").inc(len(batch))
+            except Exception as e:
+                CAPTURE_RECORDS.labels("error").inc(len(batch))
+                logger.warning("capture write failed: %s", e)
+                self._close_file()
+            if stop:
+                self._close_file()
+                return
+
+    def close(self, timeout: float = 5.0) -> None:
+        """
+        Write what is queued and close the current file
+        """
+        thread = self._thread
+        if thread is None:
+            return
+        try:
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        thread.join(timeout)
+        self._thread = None
+
+
+class Capture:
+    """
+    Samples chat completion requests for capture; `start` costs one random draw when not sampled.
+    """
+
+    def __init__(self, sample_rate: float, writer: Optional[CaptureWriter], redact_fields: str = ""):
+        self.sample_rate = sample_rate if writer is not None else 0.0
+        self.writer = writer
+        self.redact_paths = [tuple(field.strip().split(".")) for field in redact_fields.split(",") if field.strip()]
+
+    def start(self, request) -> Optional[CaptureRecord]:
+        if not self.sample_rate or random.random() >= self.sample_rate:
+            return None
+        body = request.model_dump(mode="json", exclude_unset=True)
+        if self.redact_paths:
+            body = redact(body, self.redact_paths)
+        return CaptureRecord(self, body)
+
+    def close(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
@@ -0,0 +1,182 @@
+import collections
+import time
+from typing import Deque, Dict, Iterable, Optional, Tuple
+
+import grpc
+
+from metrics import Counter, Gauge
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+_STATE_VALUES = {CLOSED: 0, OPEN: 1, HALF_OPEN: 2}
+
+BREAKER_STATE = Gauge("ark_breaker_state", "Circuit breaker state per backend, 0 closed, 1 open, 2 half open", ["backend"])
+BREAKER_TRANSITIONS = Counter("ark_breaker_transitions_total", "Circuit breaker state changes", ["backend", "state"])
+BREAKER_REJECTIONS = Counter("ark_breaker_rejections_total", "Calls kept off a backend by its breaker", ["backend"])
+
+
+def parse_status_codes(names: str) -> Tuple[grpc.StatusCode, ...]:
+    return tuple(grpc.StatusCode[name.strip().upper()] for name in names.split(",") if name.strip())
+
+
+class CircuitBreaker:
+    """
+    Closed / open / half-open breaker of one backend over a rolling window of calls.
+
+    A call fails when it ends with one of `trip_codes` and is slow when its first
+    response took longer than `slow_call_seconds`. Once the window holds `min_calls`
+    and the failure or slow ratio crosses its threshold the breaker opens; after
+    `open_seconds` it lets `half_open_calls` probes through and closes again if they
+    all succeed. A probe that is neither recorded nor released within `probe_timeout`,
+    by default `slow_call_seconds`, is taken as lost and frees its slot.
+    """
+
+    def __init__(
+        self,
+        target: str,
+        trip_codes: Iterable[grpc.StatusCode],
+        window: float = 30.0,
+        min_calls: int = 10,
+        error_rate: float = 0.5,
+        slow_call_seconds: float = 30.0,
+        slow_call_rate: float = 0.8,
+        open_seconds: float = 15.0,
+        half_open_calls: int = 2,
+        probe_timeout: Optional[float] = None,
+    ):
+        self.target = target
+        self.trip_codes = frozenset(trip_codes)
+        self.window = window
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.slow_call_rate = slow_call_rate
+        self.open_seconds = open_seconds
+        self.half_open_calls = half_open_calls
+        self.probe_timeout = probe_timeout if probe_timeout is not None else slow_call_seconds
+        self.state = CLOSED
+        self.opened_at = 0.0
+        # grant times of the probes still out
+        self._probes: Deque[float] = collections.deque()
+        self._probe_successes = 0
+        # (timestamp, failed, slow)
+        self._calls: Deque[Tuple[float, bool, bool]] = collections.deque()
+        self._failures = 0
+        self._slow = 0
+        BREAKER_STATE.labels(target).set(_STATE_VALUES[CLOSED])
+
+    def _transition(self, state: str) -> None:
+        self.state = state
+        if state == OPEN:
+            self.opened_at = time.monotonic()
+        if state != CLOSED:
+            self._probes.clear()
+            self._probe_successes = 0
+        if state == CLOSED:
+            self._calls.clear()
+            self._failures = self._slow = 0
+        BREAKER_STATE.labels(self.target).set(_STATE_VALUES[state])
+        BREAKER_TRANSITIONS.labels(self.target, state).inc()
+
+    def allow(self) -> bool:
+        """
+        Whether a new call may go to this backend; a granted half-open probe must be recorded,
+        or released when the call is not made
+        """
+        if self.state == CLOSED:
+            return True
+        now = time.monotonic()
+        if self.state == OPEN:
+            if now - self.opened_at < self.open_seconds:
+                BREAKER_REJECTIONS.labels(self.target).inc()
+                return False
+            self._transition(HALF_OPEN)
+        while self._probes and self._probes[0] < now - self.probe_timeout:
+            self._probes.popleft()
+        if len(self._probes) < self.half_open_calls:
+            self._probes.append(now)
+            return True
+        BREAKER_REJECTIONS.labels(self.target).inc()
+        return False
+
+    def available(self) -> bool:
+        """
+        Whether allow() could pass now, without granting a probe
+        """
+        return self.state != OPEN or time.monotonic() - self.opened_at >= self.open_seconds
+
+    def release(self) -> None:
+        """
+        Give back a probe granted by allow() for a call that was not made or ended without a verdict
+        """
+        if self.state == HALF_OPEN and self._probes:
+            self._probes.pop()
+
+    def _record(self, failed: bool, slow: bool) -> None:
+        if self.state == HALF_OPEN:
+            if self._probes:
+                self._probes.popleft()
+            if failed or slow:
+                self._transition(OPEN)
+            else:
+                self._probe_successes += 1
+                if self._probe_successes >= self.half_open_calls:
+                    self._transition(CLOSED)
+            return
+        if self.state == OPEN:
+            return
+
+        now = time.monotonic()
+        self._calls.append((now, failed, slow))
+        self._failures += failed
+        self._slow += slow
+        while self._calls and self._calls[0][0] < now - self.window:
+            _, old_failed, old_slow = self._calls.popleft()
+            self._failures -= old_failed
+            self._slow -= old_slow
+        total = len(self._calls)
+        if total >= self.min_calls and (
+            self._failures / total >= self.error_rate or self._slow / total >= self.slow_call_rate
+        ):
+            self._transition(OPEN)
+
+    def record_success(self, first_response_seconds: float) -> None:
+        self._record(False, first_response_seconds > self.slow_call_seconds)
+
+    def record_failure(self, code: grpc.StatusCode) -> bool:
+        """
+        Record a call that ended with `code`; returns whether the code counts against the backend
+        """
+        failed = code in self.trip_codes
+        self._record(failed, False)
+        return failed
+
+
+class BreakerRegistry:
+    def __init__(self, enabled: bool = True, **breaker_kwargs):
+        self.enabled = enabled
+        self._breaker_kwargs = breaker_kwargs
+        self._breakers: Dict[str, CircuitBreaker] = {}
+
+    def get(self, target: str) -> CircuitBreaker:
+        breaker = self._breakers.get(target)
+        if breaker is None:
+            breaker = self._breakers[target] = CircuitBreaker(target, **self._breaker_kwargs)
+        return breaker
+
+    def allow(self, target: str) -> bool:
+        return not self.enabled or self.get(target).allow()
+
+    def available(self, target: str) -> bool:
+        return not self.enabled or self.get(target).available()
+
+    def release(self, target: str) -> None:
+        if self.enabled:
+            self.get(target).release()
+
+    def remove(self, target: str) -> None:
+        if self._breakers.pop(target, None) is not None:
+            BREAKER_STATE.remove(target)
+
+    def on_backends_changed(self, added, removed) -> None:
+        for target in removed:
+            self.remove(target)
@@ -0,0 +1,256 @@
+import json
+import logging
+import zlib
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import grpc
+from starlette.exceptions import HTTPException
+from starlette.responses import JSONResponse
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from metrics import Counter
+
+logger = logging.getLogger(__name__)
+
+HTTP_COMPRESSION_BYTES = Counter(
+    "ark_http_compression_bytes_total",
+    "Compressed HTTP body bytes on the wire and decoded, by direction and encoding",
+    ["direction", "encoding", "kind"],
+)
+GRPC_COMPRESSED_CALLS = Counter("ark_grpc_compressed_calls_total", "Backend calls whose request was sent gzip compressed")
+
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+
+def supported_encodings() -> List[str]:
+    return ["zstd", "gzip"] if zstandard is not None else ["gzip"]
+
+
+class _GzipDecoder:
+    def __init__(self):
+        self._decoder = zlib.decompressobj(zlib.MAX_WBITS | 16)
+
+    def decompress(self, data: bytes, limit: int) -> bytes:
+        out = self._decoder.decompress(data, limit + 1)
+        # concatenated gzip members are one body
+        while self._decoder.eof and self._decoder.unused_data and len(out) <= limit:
+            rest = self._decoder.unused_data
+            self._decoder = zlib.decompressobj(zlib.MAX_WBITS | 16)
+            out += self._decoder.decompress(rest, limit + 1 - len(out))
+        return out
+
+    def flush(self) -> bytes:
+        return self._decoder.flush()
+
+
+class _OutputLimitReached(Exception):
+    pass
+
+
+class _ZstdDecoder:
+    """
+    zstd decompression objects decode a whole chunk at once, so output is pushed through a
+    stream writer into a sink that stops it one write past `limit`
+    """
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+        self._size = 0
+        self._limit = 0
+        self._writer = zstandard.ZstdDecompressor().stream_writer(self)
+
+    def write(self, data: bytes) -> int:
+        self._chunks.append(data)
+        self._size += len(data)
+        if self._size > self._limit:
+            raise _OutputLimitReached()
+        return len(data)
+
+    def decompress(self, data: bytes, limit: int) -> bytes:
+        self._chunks, self._size, self._limit = [], 0, limit
+        try:
+            self._writer.write(data)
+        except _OutputLimitReached:
+            pass
+        return b"".join(self._chunks)
+
+    def flush(self) -> bytes:
+        return b""
+
+
+def _decoder(encoding: str):
+    if encoding in ("gzip", "x-gzip"):
+        return _GzipDecoder()
+    if encoding == "zstd" and zstandard is not None:
+        return _ZstdDecoder()
+    return None
+
+
+class BodyDecodeError(HTTPException):
+    """
+    Raised while the app reads a body that does not decode; FastAPI lets HTTP exceptions
+    through its body parsing
+    """
+
+
+async def body_decode_error_handler(request, exc: BodyDecodeError) -> JSONResponse:
+    return JSONResponse(status_code=exc.status_code, content={"error": {"code": exc.status_code, "message": exc.detail}})
+
+
+class RequestDecompressionMiddleware:
+    """
+    Pure ASGI middleware decoding gzip and zstd `Content-Encoding` request bodies chunk
+    by chunk as the app reads them, so a compressed body is never held twice. Bodies
+    decoding to more than `max_bytes` are refused with a 413 through BodyDecodeError;
+    their decoded size is left on the request state as `decoded_body_bytes`.
+    """
+
+    def __init__(self, app, max_bytes: int = 64 * 1024 * 1024):
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        encoding = ""
+        for name, value in scope["headers"]:
+            if name == b"content-encoding":
+                encoding = value.decode("latin-1").strip().lower()
+        if not encoding or encoding == "identity":
+            return await self.app(scope, receive, send)
+        decoder = _decoder(encoding)
+        if decoder is None:
+            return await self._error(send, 415, f"unsupported content-encoding {encoding}, use one of {supported_encodings()}")
+
+        scope = dict(scope)
+        scope["headers"] = [(k, v) for k, v in scope["headers"] if k not in (b"content-encoding", b"content-length")]
+        state = scope.setdefault("state", {})
+        state["decoded_body_bytes"] = 0
+        wire_bytes = HTTP_COMPRESSION_BYTES.labels("request", encoding, "wire")
+        decoded_bytes = HTTP_COMPRESSION_BYTES.labels("request", encoding, "decoded")
+
+        async def decoded_receive():
+            message = await receive()
+            if message["type"] != "http.request":
+                return message
+            body = message.get("body", b"")
+            limit = self.max_bytes - state["decoded_body_bytes"]
+            try:
+                data = decoder.decompress(body, limit)
+                if not message.get("more_body", False):
+                    data += decoder.flush()
+            except zlib.error as e:
+                raise BodyDecodeError(400, f"invalid {encoding} request body: {e}")
+            except Exception as e:
+                if zstandard is not None and isinstance(e, zstandard.ZstdError):
+                    raise BodyDecodeError(400, f"invalid {encoding} request body: {e}")
+                raise
+            if len(data) > limit:
+                raise BodyDecodeError(413, f"decoded request body is larger than {self.max_bytes} bytes")
+            state["decoded_body_bytes"] += len(data)
+            wire_bytes.inc(len(body))
+            decoded_bytes.inc(len(data))
+            return {**message, "body": data}
+
+        await self.app(scope, decoded_receive, send)
+
+    @staticmethod
+    async def _error(send, status: int, message: str) -> None:
+        body = json.dumps({"error": {"code": status, "message": message}}, separators=(",", ":")).encode()
+        await send(
+            {
+                "type": "http.response.start",
+                "status": status,
+                "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+            }
+        )
+        await send({"type": "http.response.body", "body": body})
+
+
+def parse_accept_encoding(header: str) -> Dict[str, float]:
+    """
+    Quality value of each coding in an Accept-Encoding header
+    """
+    accepted = {}
+    for entry in header.split(","):
+        coding, *params = entry.strip().split(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        quality = 1.0
+        for param in params:
+            name, _, value = param.strip().partition("=")
+            if name.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[coding] = quality
+    return accepted
+
+
+def compress(data: bytes, encoding: str) -> bytes:
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    encoder = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    return encoder.compress(data) + encoder.flush()
+
+
+class ResponseCompressor:
+    """
+    Compresses response bodies of at least `min_bytes` with the first of `encodings`
+    the client accepts with the highest quality.
+    """
+
+    def __init__(self, encodings: Sequence[str], min_bytes: int = 16 * 1024):
+        self.encodings = []
+        for encoding in encodings:
+            if encoding not in supported_encodings():
+                logger.warning("response compression %s is not available, skipping it", encoding)
+            else:
+                self.encodings.append(encoding)
+        self.min_bytes = min_bytes
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.encodings)
+
+    def negotiate(self, accept_encoding: str) -> Optional[str]:
+        accepted = parse_accept_encoding(accept_encoding)
+        best, best_quality = None, 0.0
+        for encoding in self.encodings:
+            quality = accepted.get(encoding, accepted.get("*", 0.0))
+            if quality > best_quality:
+                best, best_quality = encoding, quality
+        return best
+
+    def encode(self, body: bytes, accept_encoding: str) -> Tuple[bytes, Dict[str, str]]:
+        """
+        `body` compressed if worth it and accepted, and the headers to send with it
+        """
+        if not self.enabled:
+            return body, {}
+        headers = {"vary": "Accept-Encoding"}
+        encoding = self.negotiate(accept_encoding) if len(body) >= self.min_bytes else None
+        if encoding is None:
+            return body, headers
+        compressed = compress(body, encoding)
+        HTTP_COMPRESSION_BYTES.labels("response", encoding, "decoded").inc(len(body))
+        HTTP_COMPRESSION_BYTES.labels("response", encoding, "wire").inc(len(compressed))
+        headers["content-encoding"] = encoding
+        return compressed, headers
+
+
+def grpc_compression(request, threshold_bytes: int) -> Optional[grpc.Compression]:
+    """
+    gzip for backend requests of at least `threshold_bytes`, 0 to never compress
+    """
+    if threshold_bytes > 0 and request.ByteSize() >= threshold_bytes:
+        GRPC_COMPRESSED_CALLS.inc()
+        return grpc.Compression.Gzip
+    return None
@@ -0,0 +1,117 @@
+import asyncio
+import logging
+import os
+import socket
+from typing import List, Optional, Sequence
+
+from backend_pool import BackendPool
+from metrics import Counter
+
+try:
+    import dns.asyncresolver
+except ImportError:
+    dns = None
+
+logger = logging.getLogger(__name__)
+
+DISCOVERY_EVENTS = Counter("ark_discovery_events_total", "Backend discovery refreshes and failures", ["source", "result"])
+
+
+def parse_targets(text: str, default_port: str) -> List[str]:
+    """
+    Parse `host` or `host:port` entries separated by commas, whitespace or newlines; `#` starts a comment
+    """
+    targets = []
+    for line in text.splitlines():
+        line = line.split("#", 1)[0]
+        for entry in line.replace(",", " ").split():
+            targets.append(entry if ":" in entry else f"{entry}:{default_port}")
+    return targets
+
+
+class BackendDiscovery:
+    """
+    Periodically rebuild the backend set of a BackendPool from a local file and/or DNS.
+
+    The file is re-read only when its mtime changes; A records are resolved with the
+    default gRPC port, SRV records carry their own (those need dnspython). A source that
+    fails keeps its previous result, so a transient error never empties the pool.
+    """
+
+    def __init__(
+        self,
+        pool: BackendPool,
+        default_port: str,
+        file_path: str = "",
+        dns_name: str = "",
+        dns_srv: str = "",
+        interval: float = 5.0,
+    ):
+        if dns_srv and dns is None:
+            raise RuntimeError("SRV discovery requires dnspython, pip install dnspython")
+        self.pool = pool
+        self.default_port = default_port
+        self.file_path = file_path
+        self.dns_name = dns_name
+        self.dns_srv = dns_srv
+        self.interval = interval
+        self._file_mtime: Optional[float] = None
+        self._file_targets: List[str] = []
+        self._dns_targets: List[str] = []
+        self._srv_targets: List[str] = []
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.file_path or self.dns_name or self.dns_srv)
+
+    def _refresh_file(self) -> None:
+        try:
+            mtime = os.stat(self.file_path).st_mtime
+            if mtime == self._file_mtime:
+                return
+            with open(self.file_path, encoding="utf-8") as f:
+                self._file_targets = parse_targets(f.read(), self.default_port)
+            self._file_mtime = mtime
+            DISCOVERY_EVENTS.labels("file", "updated").inc()
+        except OSError as e:
+            DISCOVERY_EVENTS.labels("file", "error").inc()
+            logger.warning("backend discovery cannot read %s: %s", self.file_path, e)
+
+    async def _resolve_a(self) -> None:
+        try:
+            infos = await asyncio.get_running_loop().getaddrinfo(
+                self.dns_name, self.default_port, family=socket.AF_INET, type=socket.SOCK_STREAM
+            )
+            self._dns_targets = sorted({f"{info[4][0]}:{self.default_port}" for info in infos})
+            DISCOVERY_EVENTS.labels("dns", "updated").inc()
+        except OSError as e:
+            DISCOVERY_EVENTS.labels("dns", "error").inc()
+            logger.warning("backend discovery cannot resolve %s: %s", self.dns_name, e)
+
+    async def _resolve_srv(self) -> None:
+        try:
+            answer = await dns.asyncresolver.resolve(self.dns_srv, "SRV")
+            self._srv_targets = sorted({f"{str(record.target).rstrip('.')}:{record.port}" for record in answer})
+            DISCOVERY_EVENTS.labels("srv", "updated").inc()
+        except Exception as e:
+            DISCOVERY_EVENTS.labels("srv", "error").inc()
+            logger.warning("backend discovery cannot resolve SRV %s: %s", self.dns_srv, e)
+
+    async def refresh(self) -> Sequence[str]:
+        if self.file_path:
+            self._refresh_file()
+        if self.dns_name:
+            await self._resolve_a()
+        if self.dns_srv:
+            await self._resolve_srv()
+        targets = self._file_targets + self._dns_targets + self._srv_targets
+        self.pool.update(targets)
+        return targets
+
+    async def run(self) -> None:
+        while True:
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.warning("backend discovery failed: %s", e)
+            await asyncio.sleep(self.interval)
@@ -0,0 +1,70 @@
+import collections
+import hashlib
+import threading
+from typing import Callable
+
+from metrics import Counter, Gauge
+from proto import ark_pb2
+from rpc_method import UnboxedValue, encode_value
+
+ENCODE_CACHE_REQUESTS = Counter(
+    "ark_encode_cache_requests_total", "Lookups of the encoded payload cache", ["cache", "result"]
+)
+ENCODE_CACHE_ENTRIES = Gauge("ark_encode_cache_entries", "Entries held by the encoded payload cache", ["cache"])
+ENCODE_CACHE_HIT_RATE = Gauge("ark_encode_cache_hit_rate", "Hit rate of the encoded payload cache", ["cache"])
+
+
+class EncodedValueCache:
+    """
+    Bounded LRU of encoded `ark_pb2.Value`s keyed by a digest of the JSON payload.
+
+    Agent workloads resend the same `tools` list and `response_format` schema on every
+    turn; hashing their JSON is far cheaper than the recursive encode_value, and a hit
+    is served with a single CopyFrom into the request.
+    """
+
+    def __init__(self, name: str, maxsize: int):
+        self.name = name
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries: "collections.OrderedDict[bytes, ark_pb2.Value]" = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._hit_counter = ENCODE_CACHE_REQUESTS.labels(name, "hit")
+        self._miss_counter = ENCODE_CACHE_REQUESTS.labels(name, "miss")
+        ENCODE_CACHE_ENTRIES.labels(name).set_function(lambda: len(self._entries))
+        ENCODE_CACHE_HIT_RATE.labels(name).set_function(lambda: self.hit_rate)
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def copy_into(self, target: ark_pb2.Value, payload_json: bytes, build: Callable[[], UnboxedValue]) -> None:
+        """
+        Fill `target` with the encoding of `build()`, reusing a cached encoding when
+        `payload_json` was seen before.
+        """
+        if self.maxsize <= 0:
+            target.MergeFrom(encode_value(build()))
+            return
+
+        key = hashlib.blake2b(payload_json, digest_size=16).digest()
+        with self._lock:
+            cached = self._entries.get(key)
+            if cached is not None:
+                self._entries.move_to_end(key)
+        if cached is not None:
+            self.hits += 1
+            self._hit_counter.inc()
+            target.CopyFrom(cached)
+            return
+
+        self.misses += 1
+        self._miss_counter.inc()
+        value = encode_value(build())
+        target.CopyFrom(value)
+        with self._lock:
+            self._entries[key] = value
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
@@ -0,0 +1,265 @@
+import asyncio
+import collections
+import hashlib
+import time
+from typing import Callable, Deque, Dict, Mapping, Optional, Tuple
+
+from metrics import Counter, Gauge, Histogram
+from proto import ark_pb2
+
+FAIR_QUEUE_DEPTH = Gauge("ark_fair_queue_depth", "Requests waiting in the fair queue per tenant", ["tenant"])
+FAIR_QUEUE_INFLIGHT = Gauge("ark_fair_queue_inflight", "Requests dispatched and not finished per tenant", ["tenant"])
+FAIR_QUEUE_WAIT = Histogram("ark_fair_queue_wait_seconds", "Time requests waited for a dispatch slot", ["tenant"])
+FAIR_QUEUE_REQUESTS = Counter("ark_fair_queue_requests_total", "Fair queue outcomes per tenant", ["tenant", "result"])
+FAIR_QUEUE_TOKENS = Counter(
+    "ark_fair_queue_tokens_total", "Tokens charged per tenant, estimated at dispatch and actual from usage", ["tenant", "kind"]
+)
+
+# smoothing of the per-tenant ratio of used to requested completion tokens
+_RATIO_ALPHA = 0.2
+
+
+def tenant_id(headers: Mapping[str, str], header: str = "") -> str:
+    """
+    Tenant of a request: the `header` value if set, else a digest of the bearer API key
+    """
+    if header:
+        tenant = headers.get(header)
+        if tenant:
+            return tenant
+    authorization = headers.get("authorization", "")
+    if authorization.lower().startswith("bearer "):
+        # never expose keys as metric labels
+        return "key-" + hashlib.sha256(authorization[7:].strip().encode()).hexdigest()[:12]
+    return "anonymous"
+
+
+def prompt_tokens_estimate(request: ark_pb2.InferenceRequest) -> int:
+    # about 4 bytes per token over everything the backend has to prefill
+    return request.ByteSize() // 4
+
+
+class Ticket:
+    __slots__ = ("tenant", "cost", "requested_tokens", "enqueued_at", "future", "released")
+
+    def __init__(self, tenant: str, cost: float, requested_tokens: int):
+        self.tenant = tenant
+        self.cost = cost
+        self.requested_tokens = requested_tokens
+        self.enqueued_at = time.perf_counter()
+        self.future: Optional[asyncio.Future] = None
+        self.released = False
+
+
+class FairQueue:
+    """
+    Deficit round-robin over per-tenant queues in front of backend dispatch.
+
+    At most `slots` requests of this worker are dispatched at once. When a slot frees
+    up the tenant at the head of the round gets `quantum * weight` tokens of credit and
+    dispatches while its head request costs no more than its credit; then the round
+    moves on. A request costs its prompt estimate plus its expected completion tokens,
+    `max_tokens` scaled by the ratio of used to requested tokens the tenant showed so
+    far. The difference between estimate and actual usage is settled against the
+    tenant's credit when the request finishes, so under-estimates become debt.
+    """
+
+    def __init__(
+        self,
+        slots: int,
+        quantum: float = 1024,
+        weights: Optional[Dict[str, float]] = None,
+        default_max_tokens: int = 1024,
+        timeout: float = 60.0,
+    ):
+        self.slots = slots
+        self.quantum = quantum
+        self.weights = weights or {}
+        self.default_max_tokens = default_max_tokens
+        self.timeout = timeout
+        self.inflight = 0
+        # tenants with queued requests, in round order
+        self._active: "collections.OrderedDict[str, Deque[Ticket]]" = collections.OrderedDict()
+        self._deficit: Dict[str, float] = {}
+        self._credited = False
+        self._ratio: Dict[str, float] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.slots > 0
+
+    @staticmethod
+    def parse_weights(spec: str) -> Dict[str, float]:
+        """
+        Parse `tenant=weight` pairs separated by commas
+        """
+        weights = {}
+        for entry in spec.split(","):
+            if entry.strip():
+                tenant, _, weight = entry.partition("=")
+                weights[tenant.strip()] = float(weight)
+        return weights
+
+    def estimate(self, tenant: str, prompt_tokens: int, max_tokens: Optional[int], n: int = 1) -> Ticket:
+        requested = (max_tokens if max_tokens is not None else self.default_max_tokens) * max(1, n)
+        return Ticket(tenant, prompt_tokens + requested * self._ratio.get(tenant, 1.0), requested)
+
+    async def acquire(self, ticket: Ticket) -> bool:
+        """
+        Wait for a dispatch slot; False when `timeout` passed first
+        """
+        if self.inflight < self.slots and not self._active:
+            self._dispatched(ticket)
+            return True
+        loop = asyncio.get_running_loop()
+        ticket.future = loop.create_future()
+        queue = self._active.get(ticket.tenant)
+        if queue is None:
+            queue = self._active[ticket.tenant] = collections.deque()
+        queue.append(ticket)
+        FAIR_QUEUE_DEPTH.labels(ticket.tenant).inc()
+        self._schedule()
+        try:
+            await asyncio.wait_for(asyncio.shield(ticket.future), self.timeout)
+            return True
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if ticket.future.done() and not ticket.future.cancelled():
+                # dispatched while timing out, hand the slot back
+                self.release(ticket)
+            else:
+                ticket.future.cancel()
+                self._remove(ticket)
+            FAIR_QUEUE_REQUESTS.labels(ticket.tenant, "timeout" if isinstance(e, asyncio.TimeoutError) else "cancelled").inc()
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            return False
+
+    def _remove(self, ticket: Ticket) -> None:
+        queue = self._active.get(ticket.tenant)
+        if queue is None or ticket not in queue:
+            return
+        at_head = next(iter(self._active)) == ticket.tenant
+        queue.remove(ticket)
+        FAIR_QUEUE_DEPTH.labels(ticket.tenant).dec()
+        if not queue:
+            self._retire(ticket.tenant)
+            if at_head:
+                self._credited = False
+
+    def _retire(self, tenant: str) -> None:
+        # an idle tenant keeps its debt but not its credit
+        del self._active[tenant]
+        if self._deficit.get(tenant, 0.0) >= 0.0:
+            self._deficit.pop(tenant, None)
+
+    def _dispatched(self, ticket: Ticket) -> None:
+        self.inflight += 1
+        FAIR_QUEUE_INFLIGHT.labels(ticket.tenant).inc()
+        FAIR_QUEUE_WAIT.labels(ticket.tenant).observe(time.perf_counter() - ticket.enqueued_at)
+        FAIR_QUEUE_REQUESTS.labels(ticket.tenant, "dispatched").inc()
+        FAIR_QUEUE_TOKENS.labels(ticket.tenant, "estimated").inc(ticket.cost)
+
+    def _next(self) -> Optional[Ticket]:
+        while self._active:
+            tenant, queue = next(iter(self._active.items()))
+            if not self._credited:
+                self._deficit[tenant] = self._deficit.get(tenant, 0.0) + self.quantum * self.weights.get(tenant, 1.0)
+                self._credited = True
+            ticket = queue[0]
+            if ticket.cost <= self._deficit[tenant]:
+                queue.popleft()
+                FAIR_QUEUE_DEPTH.labels(tenant).dec()
+                self._deficit[tenant] -= ticket.cost
+                if not queue:
+                    self._retire(tenant)
+                    self._credited = False
+                return ticket
+            # credit exhausted, the round moves on
+            self._active.move_to_end(tenant)
+            self._credited = False
+        return None
+
+    def _schedule(self) -> None:
+        while self.inflight < self.slots:
+            ticket = self._next()
+            if ticket is None:
+                return
+            self._dispatched(ticket)
+            ticket.future.set_result(None)
+
+    def release(self, ticket: Ticket, prompt_tokens: Optional[int] = None, completion_tokens: Optional[int] = None) -> None:
+        """
+        Free the slot of a dispatched request, settling its estimate against actual usage when known
+        """
+        if ticket.released:
+            return
+        ticket.released = True
+        self.inflight -= 1
+        FAIR_QUEUE_INFLIGHT.labels(ticket.tenant).dec()
+        if prompt_tokens is not None and completion_tokens is not None:
+            actual = prompt_tokens + completion_tokens
+            FAIR_QUEUE_TOKENS.labels(ticket.tenant, "actual").inc(actual)
+            deficit = self._deficit.get(ticket.tenant, 0.0) + ticket.cost - actual
+            # refunds of over-estimates never add up to more than one round of credit
+            deficit = min(deficit, self.quantum * self.weights.get(ticket.tenant, 1.0) if ticket.tenant in self._active else 0.0)
+            if deficit:
+                self._deficit[ticket.tenant] = deficit
+            else:
+                self._deficit.pop(ticket.tenant, None)
+            if ticket.requested_tokens > 0:
+                ratio = min(1.0, completion_tokens / ticket.requested_tokens)
+                previous = self._ratio.get(ticket.tenant, 1.0)
+                self._ratio[ticket.tenant] = previous + _RATIO_ALPHA * (ratio - previous)
+        self._schedule()
+
+    def dispatch(self, ticket: Ticket, responses) -> "UsageStream":
+        """
+        Wrap `responses` so the slot of `ticket` is released with their usage once they are done
+        """
+        return UsageStream(responses, lambda prompt, completion: self.release(ticket, prompt, completion))
+
+
+class UsageStream:
+    """
+    Passes InferenceResponses through and calls `on_done(prompt_tokens, completion_tokens)`
+    once they end or fail; both are None when the responses never reported usage. Whoever
+    may drop the responses unread calls finish() in its cleanup.
+    """
+
+    def __init__(self, responses, on_done: Callable[[Optional[int], Optional[int]], None]):
+        self.responses = responses
+        # async iterables like FanoutStream only define __aiter__
+        self._iterator = responses.__aiter__()
+        self.on_done = on_done
+        self.done = False
+        self.usage: Dict[int, Tuple[int, int]] = {}
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> ark_pb2.InferenceResponse:
+        try:
+            response = await self._iterator.__anext__()
+        except BaseException:
+            self.finish()
+            raise
+        if "usage" in response.outputs:
+            fields = response.outputs["usage"].struct_.fields
+            self.usage[response.outputs["choice.index"].int64_] = (
+                fields["prompt_tokens"].int64_,
+                fields["completion_tokens"].int64_,
+            )
+        return response
+
+    def finish(self) -> None:
+        if self.done:
+            return
+        self.done = True
+        if self.usage:
+            # prompt tokens are shared by every choice of the request
+            self.on_done(
+                max(prompt for prompt, _ in self.usage.values()),
+                sum(completion for _, completion in self.usage.values()),
+            )
+        else:
+            self.on_done(None, None)
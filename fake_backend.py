@@ -0,0 +1,165 @@
+"""
+Fake ARK `Inference` backend streaming synthetic tokens, for running the proxy,
+load tests and benchmarks without GPUs.
+
+    python fake_backend.py --port 50050 --ttft 0.2 --itl 0.02 --tokens 128
+"""
+import argparse
+import asyncio
+import random
+
+import grpc
+
+from proto import ark_pb2, ark_pb2_grpc
+from rpc_method import encode_value
+
+
+class FakeInference(ark_pb2_grpc.InferenceServicer):
+    def __init__(
+        self,
+        ttft: float,
+        itl: float,
+        tokens: int,
+        reasoning_tokens: int,
+        error_rate: float,
+        jitter: float,
+        logprob_tokens: bool = False,
+    ):
+        self.ttft = ttft
+        self.itl = itl
+        self.tokens = tokens
+        self.reasoning_tokens = reasoning_tokens
+        self.error_rate = error_rate
+        self.jitter = jitter
+        self.logprob_tokens = logprob_tokens
+        self.prompt_cache = set()
+
+    def _sleep_time(self, base: float) -> float:
+        return max(0.0, base * (1.0 + random.uniform(-self.jitter, self.jitter)))
+
+    @staticmethod
+    def _prompt_tokens(request: ark_pb2.InferenceRequest) -> int:
+        # rough 4 bytes per token estimate over every message
+        size = 0
+        if "messages.content" in request.inputs:
+            size += sum(len(content) for content in request.inputs["messages.content"].bytes_list.values)
+        if "messages" in request.inputs:
+            size += request.inputs["messages"].ByteSize()
+        return max(1, size // 4)
+
+    def _prompt_cache(self, request: ark_pb2.InferenceRequest) -> dict:
+        # leading messages seen before count as cached, reported like the real backend
+        if "messages.content" in request.inputs:
+            roles = request.inputs["messages.role"].bytes_list.values
+            contents = request.inputs["messages.content"].bytes_list.values
+            messages = [role + b"\x00" + content for role, content in zip(roles, contents)]
+        else:
+            values = request.inputs["messages"].value_list.values if "messages" in request.inputs else []
+            messages = [message.SerializeToString() for message in values]
+        hit = size = 0
+        for i, message in enumerate(messages):
+            size += len(message)
+            key = b"\x01".join(messages[: i + 1])
+            if key in self.prompt_cache:
+                hit = size
+            self.prompt_cache.add(key)
+        hit_tokens, prompt_tokens = hit // 4, max(1, size // 4)
+        return {
+            "cache.prompt_cache_hit_tokens": ark_pb2.Value(int64_=hit_tokens),
+            "cache.prompt_cache_miss_tokens": ark_pb2.Value(int64_=max(0, prompt_tokens - hit_tokens)),
+        }
+
+    def _logprobs(self, step: int, top: int) -> dict:
+        # packed like the real backend: one sampled token per chunk, then its `top` alternatives
+        rng = random.Random(step)
+        token_id = 1000 + step
+        top_ids = [token_id] + [rng.randrange(150000) for _ in range(top - 1)] if top else []
+        top_logprobs = sorted((-rng.expovariate(1.0) for _ in top_ids), reverse=True)
+        outputs = {
+            "choice.logprobs.token_ids": ark_pb2.Value(int64_list=ark_pb2.Int64List(values=[token_id])),
+            "choice.logprobs.logprobs": ark_pb2.Value(float_list=ark_pb2.FloatList(values=top_logprobs[:1] or [-0.5])),
+            "choice.logprobs.top_token_ids": ark_pb2.Value(int64_list=ark_pb2.Int64List(values=top_ids)),
+            "choice.logprobs.top_logprobs": ark_pb2.Value(float_list=ark_pb2.FloatList(values=top_logprobs)),
+        }
+        if self.logprob_tokens:
+            outputs["choice.logprobs.tokens"] = ark_pb2.Value(bytes_list=ark_pb2.BytesList(values=[f"tok{step} ".encode()]))
+            outputs["choice.logprobs.top_tokens"] = ark_pb2.Value(
+                bytes_list=ark_pb2.BytesList(values=[f"t{token} ".encode() for token in top_ids])
+            )
+        return outputs
+
+    async def StreamingCall(self, request, context):
+        if self.error_rate and random.random() < self.error_rate:
+            await context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, "fake backend is overloaded")
+
+        n = request.inputs["n"].int64_ if "n" in request.inputs else 1
+        max_tokens = request.inputs["max_new_tokens"].int64_ if "max_new_tokens" in request.inputs else self.tokens
+        completion_tokens = max(1, min(max_tokens, self.tokens))
+        reasoning_tokens = min(self.reasoning_tokens, completion_tokens - 1)
+        prompt_tokens = self._prompt_tokens(request)
+        cache = self._prompt_cache(request)
+
+        await asyncio.sleep(self._sleep_time(self.ttft))
+        for step in range(completion_tokens):
+            if step:
+                await asyncio.sleep(self._sleep_time(self.itl))
+            last = step == completion_tokens - 1
+            reasoning = step < reasoning_tokens
+            for index in range(n):
+                message = {"content": "" if reasoning else f"tok{step} ", "reasoning_content": f"think{step} " if reasoning else ""}
+                response = ark_pb2.InferenceResponse(
+                    req_id=request.req_id,
+                    model_name=request.model_name,
+                    outputs={
+                        "choice": encode_value({"message": message}),
+                        "choice.index": ark_pb2.Value(int64_=index),
+                        "choice.finish_reason": ark_pb2.Value(bytes_=b"length" if last and max_tokens <= self.tokens else b"stop" if last else b""),
+                        "usage": encode_value(
+                            {
+                                "prompt_tokens": prompt_tokens,
+                                "completion_tokens": step + 1,
+                                "total_tokens": prompt_tokens + step + 1,
+                                "completion_tokens_details": {"reasoning_tokens": min(step + 1, reasoning_tokens)},
+                            }
+                        ),
+                    },
+                )
+                if "logprobs" in request.inputs:
+                    for key, value in self._logprobs(step, request.inputs["logprobs"].int64_).items():
+                        response.outputs[key].CopyFrom(value)
+                if last:
+                    for key, value in cache.items():
+                        response.outputs[key].CopyFrom(value)
+                yield response
+
+
+async def serve(args) -> None:
+    server = grpc.aio.server()
+    ark_pb2_grpc.add_InferenceServicer_to_server(
+        FakeInference(
+            args.ttft, args.itl, args.tokens, args.reasoning_tokens, args.error_rate, args.jitter, args.logprob_tokens
+        ),
+        server,
+    )
+    server.add_insecure_port(f"{args.host}:{args.port}")
+    await server.start()
+    print(f"Fake inference backend listening on {args.host}:{args.port}")
+    await server.wait_for_termination()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=50050)
+    parser.add_argument("--ttft", type=float, default=0.2, help="seconds before the first token")
+    parser.add_argument("--itl", type=float, default=0.02, help="seconds between tokens")
+    parser.add_argument("--tokens", type=int, default=128, help="completion tokens unless max_tokens is lower")
+    parser.add_argument("--reasoning-tokens", type=int, default=0, help="leading tokens sent as reasoning_content")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of calls failing with RESOURCE_EXHAUSTED")
+    parser.add_argument("--logprob-tokens", action="store_true", help="send token strings along with logprobs")
+    parser.add_argument("--jitter", type=float, default=0.0, help="relative random jitter of ttft and itl")
+    asyncio.run(serve(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
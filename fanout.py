@@ -0,0 +1,103 @@
+import asyncio
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+from proto import ark_pb2
+
+
+def split_n(n: int, parts: int) -> List[int]:
+    """
+    Split `n` choices into `parts` near-equal positive counts, eg. split_n(8, 3) == [3, 3, 2]
+    """
+    parts = max(1, min(n, parts))
+    base, extra = divmod(n, parts)
+    return [base + (1 if i < extra else 0) for i in range(parts)]
+
+
+def make_fanout_requests(
+    request: ark_pb2.InferenceRequest, n: int, seed: Optional[int], parts: int
+) -> List[Tuple[int, ark_pb2.InferenceRequest]]:
+    """
+    Clone `request` into sub-requests that together generate `n` choices.
+
+    Each sub-request gets its own req_id. With a `seed`, each also gets that seed offset by
+    the global index of its first choice, so the sub-streams sample differently but
+    reproducibly; without one they sample like an unsplit request. Returns
+    (index_offset, sub_request) pairs.
+    """
+    sub_requests = []
+    offset = 0
+    for i, count in enumerate(split_n(n, parts)):
+        sub_request = ark_pb2.InferenceRequest()
+        sub_request.CopyFrom(request)
+        sub_request.req_id = f"{request.req_id}-{i}"
+        sub_request.inputs["n"].int64_ = count
+        if seed is not None:
+            sub_request.inputs["seed"].int64_ = seed + offset
+        sub_requests.append((offset, sub_request))
+        offset += count
+    return sub_requests
+
+
+class FanoutStream:
+    """
+    Merge the response streams of fanned-out sub-requests into one stream.
+
+    Responses are yielded in arrival order with `choice.index` rewritten to the global
+    choice index, so consumers see what a single backend generating all `n` choices
+    would have sent. The latest per-choice usage is kept for `usage()`.
+    """
+
+    _DONE = object()
+
+    def __init__(self, streams: List[Tuple[int, AsyncIterator[ark_pb2.InferenceResponse]]]):
+        self._streams = streams
+        self._usage: Dict[int, Tuple[int, int, int]] = {}
+
+    async def _pump(self, offset: int, stream: AsyncIterator[ark_pb2.InferenceResponse], queue: asyncio.Queue):
+        try:
+            async for response in stream:
+                await queue.put((offset, response))
+            await queue.put((offset, self._DONE))
+        except BaseException as e:
+            await queue.put((offset, e))
+            raise
+
+    async def __aiter__(self) -> AsyncIterator[ark_pb2.InferenceResponse]:
+        queue: asyncio.Queue = asyncio.Queue()
+        tasks = [asyncio.create_task(self._pump(offset, stream, queue)) for offset, stream in self._streams]
+        pending = len(tasks)
+        try:
+            while pending:
+                offset, item = await queue.get()
+                if item is self._DONE:
+                    pending -= 1
+                    continue
+                if isinstance(item, BaseException):
+                    raise item
+                index = offset + item.outputs["choice.index"].int64_
+                item.outputs["choice.index"].int64_ = index
+                usage = item.outputs.get("usage")
+                if usage is not None:
+                    fields = usage.struct_.fields
+                    self._usage[index] = (
+                        fields["prompt_tokens"].int64_,
+                        fields["completion_tokens"].int64_,
+                        fields["completion_tokens_details"].struct_.fields["reasoning_tokens"].int64_,
+                    )
+                yield item
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def usage(self) -> Dict:
+        prompt_tokens = max((usage[0] for usage in self._usage.values()), default=0)
+        completion_tokens = sum(usage[1] for usage in self._usage.values())
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "completion_tokens_details": {
+                "reasoning_tokens": sum(usage[2] for usage in self._usage.values()),
+            },
+        }
@@ -0,0 +1,131 @@
+import json
+from typing import Any, Dict, List, Optional
+
+from fastapi.exceptions import RequestValidationError
+from pydantic import ValidationError
+
+from openai_protocol import ChatCompletionRequest
+
+try:
+    import orjson
+
+    _loads = orjson.loads
+except ImportError:
+    _loads = json.loads
+
+# roles whose messages carry nothing but role/content/name in the OpenAI schema
+_SIMPLE_ROLES = frozenset(["system", "developer", "user", "assistant"])
+_SIMPLE_KEYS = frozenset(["role", "content", "name"])
+
+
+def _is_simple_part(part: Any, allow_image: bool) -> bool:
+    if type(part) is not dict:
+        return False
+    kind = part.get("type")
+    if kind == "text":
+        return len(part) == 2 and type(part.get("text")) is str
+    if kind == "image_url" and allow_image and len(part) == 2:
+        image_url = part.get("image_url")
+        return (
+            type(image_url) is dict
+            and type(image_url.get("url")) is str
+            and image_url.keys() <= {"url", "detail"}
+            and image_url.get("detail", "auto") in ("auto", "low", "high")
+        )
+    return False
+
+
+def _is_simple_messages(messages: Any) -> bool:
+    """
+    Structural check of what make_ark_req reads: role, and content as a string or as
+    text/image_url parts. Anything fancier is left to the full pydantic validation.
+    """
+    if type(messages) is not list:
+        return False
+    for msg in messages:
+        if type(msg) is not dict or not msg.keys() <= _SIMPLE_KEYS:
+            return False
+        role = msg.get("role")
+        if role not in _SIMPLE_ROLES or "name" in msg and type(msg["name"]) is not str:
+            return False
+        content = msg.get("content")
+        if type(content) is str:
+            continue
+        if type(content) is not list:
+            return False
+        allow_image = role == "user"
+        for part in content:
+            if not _is_simple_part(part, allow_image):
+                return False
+    return True
+
+
+def _validation_error(e: ValidationError) -> RequestValidationError:
+    # same shape FastAPI produces when it validates the body itself
+    errors = [{**error, "loc": ("body",) + tuple(error["loc"])} for error in e.errors(include_url=False)]
+    return RequestValidationError(errors)
+
+
+def parse_chat_completion_request(body: bytes) -> ChatCompletionRequest:
+    """
+    Parse a raw /v1/chat/completions body, skipping the pydantic validation of the
+    OpenAI message union when `messages` only holds what make_ark_req consumes.
+
+    Errors are raised as RequestValidationError exactly as FastAPI would: whenever the
+    fast structural check fails, the body goes through the full model validation. Bodies
+    that are not UTF-8 are invalid JSON, a 422 like any other.
+    """
+    try:
+        obj = _loads(body)
+    except json.JSONDecodeError as e:
+        raise RequestValidationError(
+            [
+                {
+                    "type": "json_invalid",
+                    "loc": ("body", e.pos),
+                    "msg": "JSON decode error",
+                    "input": {},
+                    "ctx": {"error": e.msg},
+                }
+            ],
+            body=e.doc,
+        )
+    except UnicodeDecodeError as e:
+        # json.loads decodes the bytes before parsing them; orjson reports this as a JSONDecodeError
+        raise RequestValidationError(
+            [
+                {
+                    "type": "json_invalid",
+                    "loc": ("body", e.start),
+                    "msg": "JSON decode error",
+                    "input": {},
+                    "ctx": {"error": f"invalid {e.encoding}: {e.reason}"},
+                }
+            ],
+            body=body,
+        )
+
+    if type(obj) is not dict:
+        raise RequestValidationError(
+            [
+                {
+                    "type": "model_attributes_type",
+                    "loc": ("body",),
+                    "msg": "Input should be a valid dictionary or object to extract fields from",
+                    "input": obj,
+                }
+            ]
+        )
+
+    messages: Optional[List[Dict[str, Any]]] = None
+    if _is_simple_messages(obj.get("messages")):
+        messages = obj["messages"]
+        obj = {**obj, "messages": []}
+
+    try:
+        request = ChatCompletionRequest.model_validate(obj)
+    except ValidationError as e:
+        raise _validation_error(e)
+    if messages is not None:
+        request.messages = messages
+    return request
@@ -0,0 +1,245 @@
+"""
+Replay recorded chat completion requests against the proxy and report latency percentiles.
+
+Each line of the log is a request body, or an object holding the body under "request"
+and its arrival time under "ts" (unix seconds), as the proxy capture writes them.
+Logs may be gzip compressed.
+
+    # original inter-arrival times, then twice as fast
+    python loadgen.py traffic.jsonl --url http://127.0.0.1:8080
+    python loadgen.py traffic.jsonl --speed 2
+    # open loop at 20 requests per second for 60 seconds, cycling through the log
+    python loadgen.py traffic.jsonl --qps 20 --duration 60 --poisson
+    # every file of a capture directory
+    python loadgen.py captures/*.jsonl.gz
+"""
+import argparse
+import asyncio
+import collections
+import gzip
+import itertools
+import json
+import random
+import sys
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+
+
+class Result:
+    __slots__ = ("start", "ttft", "itl", "e2e", "completion_tokens", "error", "lag")
+
+    def __init__(self, start: float, lag: float):
+        self.start = start
+        self.lag = lag
+        self.ttft: Optional[float] = None
+        self.itl: List[float] = []
+        self.e2e: Optional[float] = None
+        self.completion_tokens = 0
+        self.error: Optional[str] = None
+
+
+def load_records(path: str) -> List[Tuple[Optional[float], Dict[str, Any]]]:
+    opener = gzip.open if path.endswith(".gz") else open
+    records = []
+    with opener(path, "rt", encoding="utf-8") as f:
+        for lineno, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError as e:
+                print(f"Skipping line {lineno}: {e}", file=sys.stderr)
+                continue
+            if isinstance(record.get("request"), dict):
+                records.append((record.get("ts"), record["request"]))
+            elif "messages" in record:
+                records.append((None, record))
+            else:
+                print(f"Skipping line {lineno}: no request body", file=sys.stderr)
+    return records
+
+
+def make_schedule(
+    records: List[Tuple[Optional[float], Dict[str, Any]]],
+    speed: float,
+    qps: Optional[float],
+    poisson: bool,
+    duration: Optional[float],
+    count: Optional[int],
+) -> List[Tuple[float, Dict[str, Any]]]:
+    """
+    (send offset in seconds, request body) pairs
+    """
+    if qps:
+        if count is None:
+            count = int(duration * qps) if duration else len(records)
+        schedule, offset = [], 0.0
+        for _, body in itertools.islice(itertools.cycle(records), count):
+            schedule.append((offset, body))
+            offset += random.expovariate(qps) if poisson else 1.0 / qps
+        return schedule
+
+    if any(ts is None for ts, _ in records):
+        raise SystemExit("Some records have no timestamp, replay them open loop with --qps")
+    records = sorted(records, key=lambda record: record[0])
+    first = records[0][0]
+    schedule = [((ts - first) / speed, body) for ts, body in records]
+    if duration:
+        schedule = [(offset, body) for offset, body in schedule if offset < duration]
+    return schedule[:count] if count is not None else schedule
+
+
+async def send(client: httpx.AsyncClient, url: str, body: Dict[str, Any], result: Result) -> None:
+    try:
+        async with client.stream("POST", url, json=body) as response:
+            if response.status_code != 200:
+                await response.aread()
+                result.error = f"http_{response.status_code}"
+                return
+            if not body.get("stream"):
+                data = json.loads(await response.aread())
+                usage = data.get("usage") or {}
+                # the proxy reports completion_len, OpenAI-compatible servers completion_tokens
+                result.completion_tokens = usage.get("completion_len", usage.get("completion_tokens", 0))
+                return
+            last_token = None
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                payload = line[5:].strip()
+                if payload == "[DONE]":
+                    break
+                chunk = json.loads(payload)
+                if "error" in chunk:
+                    result.error = "stream_error"
+                    return
+                if chunk.get("usage"):
+                    result.completion_tokens = max(result.completion_tokens, chunk["usage"].get("completion_tokens", 0))
+                if any(
+                    choice["delta"].get("content") or choice["delta"].get("reasoning_content")
+                    for choice in chunk.get("choices", ())
+                ):
+                    now = time.perf_counter()
+                    if last_token is None:
+                        result.ttft = now - result.start
+                    else:
+                        result.itl.append(now - last_token)
+                    last_token = now
+    except (httpx.HTTPError, json.JSONDecodeError, KeyError) as e:
+        result.error = type(e).__name__
+    finally:
+        result.e2e = time.perf_counter() - result.start
+
+
+async def run(args, schedule: List[Tuple[float, Dict[str, Any]]]) -> Tuple[List[Result], float]:
+    url = args.url.rstrip("/") + "/v1/chat/completions"
+    headers = {"Authorization": f"Bearer {args.api_key}"} if args.api_key else {}
+    limits = httpx.Limits(max_connections=args.max_connections, max_keepalive_connections=args.max_connections)
+    timeout = httpx.Timeout(args.timeout, connect=10.0)
+    results, tasks = [], []
+    async with httpx.AsyncClient(headers=headers, limits=limits, timeout=timeout) as client:
+        started = time.perf_counter()
+        for offset, body in schedule:
+            delay = started + offset - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if args.stream and not body.get("stream"):
+                body = dict(body, stream=True, stream_options={"include_usage": True})
+            if args.model:
+                body = dict(body, model=args.model)
+            now = time.perf_counter()
+            # open loop: send on schedule whether or not earlier requests have finished
+            result = Result(now, now - started - offset)
+            results.append(result)
+            tasks.append(asyncio.create_task(send(client, url, body, result)))
+        await asyncio.gather(*tasks)
+        return results, time.perf_counter() - started
+
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {}
+    values = sorted(values)
+
+    def rank(q: float) -> float:
+        return values[min(len(values) - 1, int(q * len(values)))]
+
+    return {
+        "mean": sum(values) / len(values),
+        "p50": rank(0.50),
+        "p90": rank(0.90),
+        "p95": rank(0.95),
+        "p99": rank(0.99),
+        "max": values[-1],
+    }
+
+
+def summarize(results: List[Result], wall: float) -> Dict[str, Any]:
+    ok = [result for result in results if result.error is None]
+    tokens = sum(result.completion_tokens for result in ok)
+    return {
+        "requests": len(results),
+        "succeeded": len(ok),
+        "errors": dict(collections.Counter(result.error for result in results if result.error is not None)),
+        "wall_seconds": wall,
+        "achieved_qps": len(results) / wall if wall else 0.0,
+        "output_tokens_per_second": tokens / wall if wall else 0.0,
+        "max_send_lag_seconds": max((result.lag for result in results), default=0.0),
+        "ttft": percentiles([result.ttft for result in ok if result.ttft is not None]),
+        "itl": percentiles([gap for result in ok for gap in result.itl]),
+        "e2e": percentiles([result.e2e for result in ok]),
+    }
+
+
+def print_summary(summary: Dict[str, Any]) -> None:
+    print(
+        "requests {requests}  ok {succeeded}  wall {wall_seconds:.2f}s  "
+        "qps {achieved_qps:.2f}  output tok/s {output_tokens_per_second:.1f}  "
+        "max send lag {:.1f}ms".format(summary["max_send_lag_seconds"] * 1000, **summary)
+    )
+    print(f"{'ms':<6}" + "".join(f"{name:>10}" for name in ("mean", "p50", "p90", "p95", "p99", "max")))
+    for metric in ("ttft", "itl", "e2e"):
+        stats = summary[metric]
+        if stats:
+            print(f"{metric:<6}" + "".join(f"{stats[name] * 1000:>10.1f}" for name in ("mean", "p50", "p90", "p95", "p99", "max")))
+    for error, count in sorted(summary["errors"].items(), key=lambda item: -item[1]):
+        print(f"error {error}: {count}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("logs", nargs="+", help="JSONL request logs, optionally .gz")
+    parser.add_argument("--url", default="http://127.0.0.1:8080", help="proxy base url")
+    parser.add_argument("--api-key", default="", help="sent as a bearer token")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed factor over the recorded inter-arrival times")
+    parser.add_argument("--qps", type=float, help="ignore timestamps and send open loop at this rate")
+    parser.add_argument("--poisson", action="store_true", help="exponential inter-arrival times at --qps")
+    parser.add_argument("--duration", type=float, help="stop scheduling after this many seconds")
+    parser.add_argument("--count", type=int, help="number of requests to send")
+    parser.add_argument("--model", help="override the model of every request")
+    parser.add_argument("--stream", action="store_true", help="force streaming with usage so TTFT and ITL are measured")
+    parser.add_argument("--timeout", type=float, default=600.0, help="per request read timeout in seconds")
+    parser.add_argument("--max-connections", type=int, default=1000)
+    parser.add_argument("--seed", type=int, help="seed for --poisson")
+    parser.add_argument("--json", dest="json_path", help="also write the summary to this file")
+    args = parser.parse_args()
+
+    if args.speed <= 0:
+        parser.error("--speed must be positive")
+    random.seed(args.seed)
+    records = [record for path in args.logs for record in load_records(path)]
+    if not records:
+        raise SystemExit(f"No requests in {' '.join(args.logs)}")
+    schedule = make_schedule(records, args.speed, args.qps, args.poisson, args.duration, args.count)
+    results, wall = asyncio.run(run(args, schedule))
+    summary = summarize(results, wall)
+    print_summary(summary)
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+import functools
+import json
+import logging
+import math
+import uuid
+from typing import Dict, List, Optional, Sequence, Tuple, TypeVar
+
+try:
+    import tokenizers
+except ImportError:
+    tokenizers = None
+
+from metrics import Counter
+
+logger = logging.getLogger(__name__)
+
+TOKEN_CACHE = Counter("ark_logprobs_token_cache_total", "Token string lookups of logprobs by cache outcome", ["result"])
+
+# packed per-chunk outputs of the backend; the top_* lists hold top_logprobs entries per
+# sampled token back to back, the token strings are optional
+TOKEN_IDS = "choice.logprobs.token_ids"
+LOGPROBS = "choice.logprobs.logprobs"
+TOP_TOKEN_IDS = "choice.logprobs.top_token_ids"
+TOP_LOGPROBS = "choice.logprobs.top_logprobs"
+TOKENS = "choice.logprobs.tokens"
+TOP_TOKENS = "choice.logprobs.top_tokens"
+
+# what ChatCompletionLogProb uses for tokens the model rules out
+LOGPROB_FLOOR = "-9999.0"
+
+_SENTINEL = f"\x00logprobs-{uuid.uuid4().hex}-"
+
+
+def format_logprobs(values: Sequence[float], count: int) -> List[str]:
+    """
+    JSON numbers of `values`, in the shortest round-trip form json.dumps uses, padded to `count`
+    """
+    if all(map(math.isfinite, values)):
+        formatted = list(map(repr, values))
+    else:
+        formatted = [repr(value) if math.isfinite(value) else LOGPROB_FLOOR for value in values]
+    return formatted[:count] + [LOGPROB_FLOOR] * (count - len(formatted))
+
+
+class TokenTable:
+    """
+    JSON fragments of tokens by model and id, `{"token":"...","logprob":` and
+    `,"bytes":[...]`, so every token is escaped and encoded once per worker.
+
+    Strings come from the backend when it sends them, else from a `tokenizers`
+    tokenizer.json, else they are `token_id:<id>` with null bytes. Entries of strings the
+    backend sent are kept apart from the others, so a string sent for an id always wins.
+    """
+
+    def __init__(self, tokenizer_path: str = "", max_entries: int = 1 << 18):
+        self.max_entries = max_entries
+        self._entries: Dict[Tuple[str, int, Optional[bytes]], Tuple[str, str]] = {}
+        self._tokenizer = None
+        if tokenizer_path:
+            if tokenizers is None:
+                logger.warning("tokenizers is not installed, logprobs tokens are sent as token ids")
+            else:
+                self._tokenizer = tokenizers.Tokenizer.from_file(tokenizer_path)
+        self.misses = 0
+        self._misses = TOKEN_CACHE.labels("miss")
+        self._synthesized = False
+
+    def _token_bytes(self, token_id: int) -> Optional[bytes]:
+        if self._tokenizer is not None:
+            return self._tokenizer.decode([token_id], skip_special_tokens=False).encode()
+        return None
+
+    def entry(self, model: str, token_id: int, token: Optional[bytes] = None) -> Tuple[str, str]:
+        key = (model, token_id, token)
+        entry = self._entries.get(key)
+        if entry is not None:
+            return entry
+        self.misses += 1
+        self._misses.inc()
+        if token is None:
+            token = self._token_bytes(token_id)
+        if token is None:
+            if not self._synthesized:
+                self._synthesized = True
+                logger.warning(
+                    "logprobs tokens are synthesized as token_id:<id> with null bytes; "
+                    "have the backend send token strings or set a tokenizer"
+                )
+            # the placeholder is not the token, so it gets no bytes
+            entry = ('{"token":"token_id:' + str(token_id) + '","logprob":', ',"bytes":null')
+        else:
+            text = token.decode("utf-8", errors="replace")
+            entry = (
+                '{"token":' + json.dumps(text, ensure_ascii=False) + ',"logprob":',
+                ',"bytes":[' + ",".join(map(str, token)) + "]",
+            )
+        if len(self._entries) >= self.max_entries:
+            self._entries.clear()
+        self._entries[key] = entry
+        return entry
+
+
+def _values(outputs, key: str) -> Sequence:
+    value = outputs.get(key)
+    if value is None:
+        return ()
+    kind = value.WhichOneof("kind")
+    # one bulk copy beats indexing the repeated field per token
+    return list(getattr(value, kind).values) if kind in ("int64_list", "float_list", "bytes_list") else ()
+
+
+class LogprobsEncoder:
+    """
+    Serializes the packed logprobs of backend responses straight to the JSON of OpenAI's
+    `logprobs.content` entries, one string per sampled token, without building objects
+    per token.
+    """
+
+    def __init__(self, table: TokenTable):
+        self.table = table
+        self._hits = TOKEN_CACHE.labels("hit")
+
+    def encode(self, outputs, model: str = "") -> Optional[List[str]]:
+        """
+        JSON object of every sampled token in `outputs` of `model`, None when it carries no logprobs
+        """
+        token_ids = _values(outputs, TOKEN_IDS)
+        if not token_ids:
+            return None
+        logprobs = _values(outputs, LOGPROBS)
+        tokens = _values(outputs, TOKENS)
+        top_ids = _values(outputs, TOP_TOKEN_IDS)
+        top_logprobs = _values(outputs, TOP_LOGPROBS)
+        top_tokens = _values(outputs, TOP_TOKENS)
+        k = len(top_ids) // len(token_ids)
+        entry = functools.partial(self.table.entry, model)
+        misses = self.table.misses
+        # every alternative of the chunk rendered in one pass, then grouped per sampled token
+        top_values = format_logprobs(top_logprobs, len(top_ids))
+        tops = [
+            f"{prefix}{value}{token_bytes}}}"
+            for (prefix, token_bytes), value in zip(
+                [entry(token_id, token) for token_id, token in zip(top_ids, top_tokens or [None] * len(top_ids))],
+                top_values,
+            )
+        ]
+        values = format_logprobs(logprobs, len(token_ids))
+        result = []
+        for i, token_id in enumerate(token_ids):
+            prefix, token_bytes = entry(token_id, tokens[i] if tokens else None)
+            result.append(f'{prefix}{values[i]}{token_bytes},"top_logprobs":[{",".join(tops[i * k : i * k + k])}]}}')
+        self._hits.inc(len(token_ids) * (k + 1) - (self.table.misses - misses))
+        return result
+
+    @staticmethod
+    def content(entries: List[str]) -> str:
+        return '{"content":[' + ",".join(entries) + "]}"
+
+
+def placeholder(index: int) -> str:
+    """
+    Stand-in value for the logprobs of choice `index` in a response dict, replaced by
+    splice() once the dict is serialized
+    """
+    return f"{_SENTINEL}{index}\x00"
+
+
+Text = TypeVar("Text", str, bytes)
+
+
+def splice(body: Text, logprobs: Dict[int, Optional[str]]) -> Text:
+    """
+    Replace the placeholder of each choice index in serialized `body` with its logprobs JSON
+    """
+    for index, content in logprobs.items():
+        quoted = json.dumps(placeholder(index))
+        content = content if content is not None else "null"
+        if isinstance(body, bytes):
+            body = body.replace(quoted.encode(), content.encode(), 1)
+        else:
+            body = body.replace(quoted, content, 1)
+    return body
@@ -0,0 +1,105 @@
+import asyncio
+import concurrent.futures
+import json
+import logging
+import multiprocessing
+import time
+from typing import Any, Callable, Optional
+
+from metrics import Counter, Histogram
+
+logger = logging.getLogger(__name__)
+
+OFFLOAD_TASKS = Counter("ark_offload_tasks_total", "CPU-heavy request work by where it ran", ["pool"])
+EVENT_LOOP_LAG = Histogram(
+    "ark_event_loop_lag_seconds",
+    "Delay of event loop ticks past their scheduled time",
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5),
+)
+
+
+def render_json(content: Any) -> bytes:
+    # same encoding as starlette's JSONResponse
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")).encode("utf-8")
+
+
+class Offloader:
+    """
+    Runs work on inputs of at least `threshold_bytes` in a thread pool, so one large
+    request does not stall every stream of the worker; smaller work runs inline, where
+    it is cheaper than the hand-off.
+
+    Threads still share the GIL, but it is switched every few milliseconds, which bounds
+    how long the event loop waits. Work marked `process_safe` (a picklable top-level
+    function of picklable arguments) goes to a process pool instead when one is
+    configured; that one is spawned rather than forked, since the worker runs gRPC threads.
+    """
+
+    def __init__(self, threshold_bytes: int, threads: int = 4, processes: int = 0):
+        self.threshold_bytes = threshold_bytes
+        self.threads = threads
+        self.processes = processes
+        self._thread_pool: Optional[concurrent.futures.ThreadPoolExecutor] = None
+        self._process_pool: Optional[concurrent.futures.ProcessPoolExecutor] = None
+        self._inline = OFFLOAD_TASKS.labels("inline")
+        self._threaded = OFFLOAD_TASKS.labels("thread")
+        self._processed = OFFLOAD_TASKS.labels("process")
+
+    @property
+    def enabled(self) -> bool:
+        return self.threshold_bytes > 0 and (self.threads > 0 or self.processes > 0)
+
+    def _pool(self, process_safe: bool) -> Optional[concurrent.futures.Executor]:
+        if process_safe and self.processes > 0:
+            if self._process_pool is None:
+                self._process_pool = concurrent.futures.ProcessPoolExecutor(
+                    self.processes, mp_context=multiprocessing.get_context("spawn")
+                )
+            self._processed.inc()
+            return self._process_pool
+        if self.threads <= 0:
+            return None
+        if self._thread_pool is None:
+            self._thread_pool = concurrent.futures.ThreadPoolExecutor(self.threads, thread_name_prefix="offload")
+        self._threaded.inc()
+        return self._thread_pool
+
+    async def run(self, size: int, fn: Callable, *args, process_safe: bool = False) -> Any:
+        pool = self._pool(process_safe) if self.enabled and size >= self.threshold_bytes else None
+        if pool is None:
+            self._inline.inc()
+            return fn(*args)
+        return await asyncio.get_running_loop().run_in_executor(pool, fn, *args)
+
+    def close(self) -> None:
+        for pool in (self._thread_pool, self._process_pool):
+            if pool is not None:
+                pool.shutdown(wait=False, cancel_futures=True)
+        self._thread_pool = self._process_pool = None
+
+
+class LoopLagMonitor:
+    """
+    Measures how late a periodic tick of the event loop wakes up; anything past
+    `slow_seconds` means some callback held the loop and is logged. With `debug` the
+    loop runs in asyncio debug mode, which logs the slow callbacks themselves at a
+    noticeable cost.
+    """
+
+    def __init__(self, interval: float = 0.1, slow_seconds: float = 0.1, debug: bool = False):
+        self.interval = interval
+        self.slow_seconds = slow_seconds
+        self.debug = debug
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        if self.debug:
+            loop.set_debug(True)
+            loop.slow_callback_duration = self.slow_seconds
+        while True:
+            scheduled = time.perf_counter() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.perf_counter() - scheduled)
+            EVENT_LOOP_LAG.observe(lag)
+            if lag >= self.slow_seconds:
+                logger.warning("event loop was blocked for %.3fs", lag)
@@ -1,14 +1,17 @@
-import base64
-import collections
+import asyncio
+import hmac
 import json
+import os
+import math
 import random
+import sqlite3
 import time
-import uuid
-from typing import AsyncGenerator
+from contextlib import asynccontextmanager
+from typing import AsyncGenerator, Literal, Optional
 
 import grpc
-from fastapi import FastAPI
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
 from sse_starlette.sse import EventSourceResponse
 
 try:
@@ -16,10 +19,45 @@ try:
 except ImportError:
     from pydantic_settings import BaseSettings
 
-from rpc_method import decode_value, encode_value
+from backend_pool import Backend, BackendPool
+from capture import Capture, CaptureWriter
+from circuit_breaker import OPEN, BreakerRegistry, parse_status_codes
+from compression import (
+    BodyDecodeError,
+    RequestDecompressionMiddleware,
+    ResponseCompressor,
+    body_decode_error_handler,
+    compress,
+    grpc_compression,
+)
+from discovery import BackendDiscovery
+from encode_cache import EncodedValueCache
+from fair_queue import FairQueue, UsageStream, prompt_tokens_estimate, tenant_id
+from fanout import FanoutStream, make_fanout_requests
+from fast_parser import parse_chat_completion_request
+from logprobs import LogprobsEncoder, TokenTable, placeholder, splice
+from metrics import REGISTRY, Counter, Histogram
+from offload import LoopLagMonitor, Offloader, render_json
+from prewarm import Prefix, PromptPrewarmer
+from profiler import StackSampler
+from rate_limit import RateLimiter
+from request_builder import RequestBuilder
+from resumable import (
+    STREAM_RESUMES,
+    EventsDropped,
+    ResumableStreamStore,
+    StreamLost,
+    parse_last_event_id,
+    token_hash,
+)
+from rpc_method import decode_value
+from sessions import SessionStore
+from stream_writer import IDLE, StreamBuffer, WorkerBudget
 
 from proto import ark_pb2, ark_pb2_grpc
 from openai_protocol import ChatCompletionRequest
+from tracing import Trace, TraceExporter, Tracer, TraceStartMiddleware
+from warmup import Warmup, record_import, synthetic_request, synthetic_response
 
 
 class XLLMServerSettings(BaseSettings):
@@ -27,107 +65,561 @@ class XLLMServerSettings(BaseSettings):
     grpc_port: str = "50050"
     # eg. export http_forward_grpc_host_list=0.0.0.1,0.0.0.2,0.0.0.3
     grpc_host_list: str = ""
+    # appended to each backend host:port when dialing; empty for a plain address, eg. fake_backend.py
+    grpc_target_suffix: str = "/generate"
     sse_data_prefix: bool = False
 
     compat_llmserver_vlm_v1: bool = False
 
+    # backend discovery, replacing grpc_host_list at runtime when any source is set
+    # eg. export http_forward_discovery_file=/etc/ark/backends  (host[:port] per line)
+    discovery_file: str = ""
+    # A records resolved with grpc_port, eg. decoder.ark.svc.cluster.local
+    discovery_dns_name: str = ""
+    # SRV records, eg. _grpc._tcp.decoder.ark.svc.cluster.local, needs dnspython
+    discovery_dns_srv: str = ""
+    discovery_interval: float = 5.0
+
+    # per-backend circuit breaker over a rolling window of calls, with retries on
+    # another backend for calls that fail with breaker_codes before their first token
+    breaker_enabled: bool = True
+    breaker_codes: str = "UNAVAILABLE,RESOURCE_EXHAUSTED,DEADLINE_EXCEEDED"
+    breaker_window: float = 30.0
+    breaker_min_calls: int = 10
+    breaker_error_rate: float = 0.5
+    # slow calls are judged by the time to the first response
+    breaker_slow_call_seconds: float = 60.0
+    breaker_slow_call_rate: float = 0.8
+    breaker_open_seconds: float = 15.0
+    breaker_half_open_calls: int = 2
+    breaker_max_retries: int = 2
+    # parse request bodies with fast_parser instead of full pydantic validation of messages
+    fast_parse: bool = False
+    # entries of the encoded `tools`/`response_format` caches, 0 to disable
+    encode_cache_size: int = 256
+    # split requests with n >= fanout_min_n across up to fanout_max_backends backends, 0 to disable
+    fanout_min_n: int = 0
+    fanout_max_backends: int = 8
+
+    # server-side chat sessions, see /v1/sessions; the SQLite file holding them is shared by the
+    # workers of a host, so keep it on a tmpfs
+    session_db: str = "/dev/shm/ark-sessions.sqlite"
+    session_max_bytes: int = 256 * 1024 * 1024
+    session_max_count: int = 10000
+    session_ttl: float = 1800.0
+
+    # chunks buffered for a slow streaming client, per stream and for the whole worker
+    stream_buffer_bytes: int = 1024 * 1024
+    stream_worker_buffer_bytes: int = 256 * 1024 * 1024
+    # block: stop reading the backend, coalesce: merge pending chunks, disconnect: end the stream
+    slow_client_policy: Literal["block", "coalesce", "disconnect"] = "block"
+    # streams open with a role-only chunk per choice as soon as the request is accepted, and
+    # get an SSE comment whenever the backend stays silent this many seconds, eg. during a long
+    # prefill, so idle timeouts of clients and load balancers do not fire; 0 for none
+    stream_role_chunk: bool = True
+    stream_heartbeat_seconds: float = 10.0
+
+    # deficit round-robin across tenants in front of backend dispatch, at most fair_queue_slots
+    # requests of a worker run at once, 0 to disable; costs are estimated tokens
+    # tenants are told apart by tenant_header when set, else by API key
+    fair_queue_slots: int = 0
+    fair_queue_quantum: float = 1024
+    # eg. export http_forward_fair_queue_weights=interactive=4,eval-sweep=0.5
+    fair_queue_weights: str = ""
+    fair_queue_default_max_tokens: int = 1024
+    fair_queue_timeout: float = 60.0
+    tenant_header: str = ""
+
+    # requests and tokens per minute of each API key, 0 to disable; the SQLite file holding the
+    # buckets is shared by the workers of a host, so keep it on a tmpfs
+    rate_limit_rpm: int = 0
+    rate_limit_tpm: int = 0
+    rate_limit_db: str = "/dev/shm/ark-rate-limit.sqlite"
+    rate_limit_default_max_tokens: int = 1024
+
+    # streaming requests that set req_id keep generating for resume_grace_seconds after the client
+    # is gone; reconnecting with the same req_id, its x-resume-token and Last-Event-ID replays the
+    # missed events, 0 to disable. The SQLite event log is shared by the workers of a host, keep it on a tmpfs
+    resume_grace_seconds: float = 0.0
+    resume_buffer_bytes: int = 4 * 1024 * 1024
+    resume_max_streams: int = 1000
+    resume_db: str = "/dev/shm/ark-resumable.sqlite"
+
+    # request parsing and encoding and response serialization of bodies of at least
+    # offload_threshold_bytes run in a thread pool, JSON work in spawned processes when
+    # offload_processes is set; 0 threshold to run everything on the event loop
+    offload_threshold_bytes: int = 256 * 1024
+    offload_threads: int = 4
+    offload_processes: int = 0
+    # event loop lag monitor, ticks delayed past loop_slow_seconds are logged; loop_debug makes
+    # asyncio name the slow callbacks at a cost
+    loop_lag_interval: float = 0.1
+    loop_slow_seconds: float = 0.1
+    loop_debug: bool = False
+
+    # gzip and zstd (needs zstandard) Content-Encoding request bodies are decoded up to
+    # request_max_decoded_bytes; non-streaming responses of at least
+    # response_compression_min_bytes are compressed with the first of response_compression
+    # the client accepts, eg. export http_forward_response_compression=zstd,gzip
+    request_max_decoded_bytes: int = 64 * 1024 * 1024
+    response_compression: str = ""
+    response_compression_min_bytes: int = 16 * 1024
+    # backend requests of at least this many bytes are sent gzip compressed, 0 never
+    grpc_compression_threshold_bytes: int = 0
+
+    # bearer token of the /debug endpoints, which are off without one
+    admin_token: str = ""
+    # longest on-demand profile; always-on samples per second of the event loop thread
+    # into ark_profile_samples_total, 0 for none
+    profile_max_seconds: float = 60.0
+    profile_sample_hz: float = 0.0
+
+    # before taking traffic each worker builds validators, connects to the backends and
+    # runs a synthetic request of each warmup_models through encoding and serialization;
+    # /ready answers 200 once that is done and a backend is available
+    warmup_enabled: bool = True
+    warmup_timeout: float = 30.0
+    warmup_models: str = "deepseek-r1-0528"
+
+    # token strings of logprobs: sent by the backend, else from this tokenizer.json (needs
+    # tokenizers), else token_id:<id> with null bytes; encoded tokens kept per worker
+    logprobs_tokenizer: str = ""
+    logprobs_cache_size: int = 1 << 18
+
+    # prompt prefixes kept in the backends' prompt cache: a JSON list of system prompts or
+    # {"name", "model", "messages"}, sent as one-token requests on start, every prewarm_interval
+    # seconds (0 only on start) and to added backends, by one worker of the host (the one holding
+    # prewarm_lock); with prewarm_affinity each prefix goes to one backend by rendezvous hashing
+    # and requests starting with it are routed there; prefixes kept or deleted through
+    # /admin/prewarm and warming results are shared by the workers through prewarm_state
+    prewarm_file: str = ""
+    prewarm_affinity: bool = False
+    prewarm_interval: float = 600.0
+    prewarm_concurrency: int = 4
+    prewarm_timeout: float = 60.0
+    prewarm_lock: str = "/dev/shm/ark-prewarm.lock"
+    prewarm_state: str = "/dev/shm/ark-prewarm.json"
+
+    # seconds to wait for a backend connection before issuing the call anyway
+    grpc_connect_timeout: float = 5.0
+
+    # request tracing, sampled traces go to a JSONL file and/or an OTLP/HTTP endpoint
+    # eg. export http_forward_trace_otlp_endpoint=http://127.0.0.1:4318/v1/traces
+    server_timing: bool = True
+    trace_sample_rate: float = 0.0
+    trace_export_path: str = ""
+    trace_otlp_endpoint: str = ""
+
+    # sampled request/response capture to size-rotated gzip JSONL files, replayable by loadgen.py
+    # eg. export http_forward_capture_redact=messages.content,user
+    capture_sample_rate: float = 0.0
+    capture_dir: str = ""
+    capture_max_bytes: int = 64 * 1024 * 1024
+    capture_max_files: int = 50
+    capture_redact: str = ""
+
     class Config:
         env_prefix = "http_forward_"
 
 
-def lookup_service(service_settings: XLLMServerSettings):
+def lookup_services(service_settings: XLLMServerSettings):
+    # backends configured by env, discovery may replace them at runtime
     if service_settings.grpc_host_list:
         hosts = service_settings.grpc_host_list.split(",")
-        return f"{hosts[random.randint(0, len(hosts) - 1)]}:{service_settings.grpc_port}"
-    return f"{service_settings.grpc_host}:{service_settings.grpc_port}"
+        return [f"{host}:{service_settings.grpc_port}" for host in hosts]
+    return [f"{service_settings.grpc_host}:{service_settings.grpc_port}"]
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    discovery_task = asyncio.create_task(discovery.run()) if discovery.enabled else None
+    lag_task = asyncio.create_task(loop_lag_monitor.run()) if settings.loop_lag_interval > 0 else None
+    stack_sampler.start(settings.profile_sample_hz)
+    await warmup.run()
+    prewarm_task = asyncio.create_task(prewarmer.run())
+    yield
+    stack_sampler.stop()
+    for task in (discovery_task, lag_task, prewarm_task):
+        if task is not None:
+            task.cancel()
+    await backend_pool.close()
+    capture.close()
+    offloader.close()
 
 
 settings = XLLMServerSettings()
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(RequestDecompressionMiddleware, max_bytes=settings.request_max_decoded_bytes)
+app.add_exception_handler(BodyDecodeError, body_decode_error_handler)
+app.add_middleware(TraceStartMiddleware)
+
+BACKEND_RETRIES = Counter("ark_backend_retries_total", "Calls retried on another backend", ["backend"])
+STREAM_OPEN_SECONDS = Histogram(
+    "ark_stream_open_seconds",
+    "Time from request arrival until the first event of a stream was written",
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0),
+)
+STREAM_FIRST_TOKEN_SECONDS = Histogram(
+    "ark_stream_first_token_seconds", "Time from request arrival until the first backend response of a stream"
+)
+STREAM_HEARTBEATS = Counter("ark_stream_heartbeats_total", "SSE comments sent while a backend was silent")
+
+tools_cache = EncodedValueCache("tools", settings.encode_cache_size)
+response_format_cache = EncodedValueCache("response_format", settings.encode_cache_size)
+request_builder = RequestBuilder(tools_cache, response_format_cache, settings.compat_llmserver_vlm_v1)
+
+backend_pool = BackendPool(
+    lookup_services(settings), lambda target: grpc.aio.insecure_channel(target + settings.grpc_target_suffix)
+)
+breakers = BreakerRegistry(
+    enabled=settings.breaker_enabled,
+    trip_codes=parse_status_codes(settings.breaker_codes),
+    window=settings.breaker_window,
+    min_calls=settings.breaker_min_calls,
+    error_rate=settings.breaker_error_rate,
+    slow_call_seconds=settings.breaker_slow_call_seconds,
+    slow_call_rate=settings.breaker_slow_call_rate,
+    open_seconds=settings.breaker_open_seconds,
+    half_open_calls=settings.breaker_half_open_calls,
+)
+backend_pool.add_listener(breakers.on_backends_changed)
+discovery = BackendDiscovery(
+    backend_pool,
+    settings.grpc_port,
+    file_path=settings.discovery_file,
+    dns_name=settings.discovery_dns_name,
+    dns_srv=settings.discovery_dns_srv,
+    interval=settings.discovery_interval,
+)
+fair_queue = FairQueue(
+    settings.fair_queue_slots,
+    quantum=settings.fair_queue_quantum,
+    weights=FairQueue.parse_weights(settings.fair_queue_weights),
+    default_max_tokens=settings.fair_queue_default_max_tokens,
+    timeout=settings.fair_queue_timeout,
+)
+
+rate_limiter = RateLimiter(settings.rate_limit_db, settings.rate_limit_rpm, settings.rate_limit_tpm)
+
+
+offloader = Offloader(settings.offload_threshold_bytes, settings.offload_threads, settings.offload_processes)
+loop_lag_monitor = LoopLagMonitor(settings.loop_lag_interval, settings.loop_slow_seconds, settings.loop_debug)
+stack_sampler = StackSampler()
+logprobs_encoder = LogprobsEncoder(TokenTable(settings.logprobs_tokenizer, settings.logprobs_cache_size))
+response_compressor = ResponseCompressor(
+    [encoding.strip() for encoding in settings.response_compression.split(",") if encoding.strip()],
+    settings.response_compression_min_bytes,
+)
+
+stream_budget = WorkerBudget(settings.stream_worker_buffer_bytes)
+resumable_streams = ResumableStreamStore(
+    settings.resume_db,
+    settings.resume_grace_seconds,
+    settings.resume_buffer_bytes,
+    settings.resume_max_streams,
+    stream_budget,
+)
+session_store = SessionStore(
+    settings.session_db, settings.session_max_bytes, settings.session_ttl, settings.session_max_count
+)
+
+tracer = Tracer(
+    sample_rate=settings.trace_sample_rate,
+    exporter=(
+        TraceExporter(path=settings.trace_export_path, otlp_endpoint=settings.trace_otlp_endpoint)
+        if settings.trace_export_path or settings.trace_otlp_endpoint
+        else None
+    ),
+)
+
+capture = Capture(
+    settings.capture_sample_rate,
+    CaptureWriter(settings.capture_dir, settings.capture_max_bytes, settings.capture_max_files)
+    if settings.capture_dir
+    else None,
+    settings.capture_redact,
+)
+
+
+warmup = Warmup(settings.warmup_enabled, settings.warmup_timeout)
 
 
 def make_ark_req(args: ChatCompletionRequest) -> ark_pb2.InferenceRequest:
-    request = ark_pb2.InferenceRequest()
-
-    if args.messages is not None:
-        for msg in args.messages:
-            content = msg["content"]
-            if isinstance(content, str):
-                request.inputs["messages.role"].bytes_list.values.extend([msg["role"].encode()])
-                request.inputs["messages.content"].bytes_list.values.extend([content.encode()])
-            elif isinstance(content, collections.abc.Iterable):
-                if settings.compat_llmserver_vlm_v1:
-                    struct = ark_pb2.Struct()
-                    struct.fields["role"].string_ = msg["role"]
-                    for entry in msg["content"]:
-                        if entry["type"] == "text":
-                            struct.fields["content"].string_ = entry["text"]
-                        elif entry["type"] == "image_url":
-                            b64_image = entry["image_url"]["url"].split(",")[-1]
-                            struct.fields["image"].bytes_list.values.extend([base64.b64decode(b64_image)])
-                        else:
-                            raise ValueError(f"type {entry['type']} is not supported in content")
-                    request.inputs["messages"].value_list.values.append(ark_pb2.Value(struct_=struct))
-                else:
-                    request.inputs["messages.role"].bytes_list.values.extend([msg["role"].encode()])
-                    payloads = []
-                    for entry in msg["content"]:
-                        if entry["type"] == "text":
-                            text = ark_pb2.Struct()
-                            text.fields["type"].string_ = "text"
-                            text.fields["text"].string_ = entry["text"]
-                            payloads.append(text)
-                        elif entry["type"] == "image_url":
-                            image = ark_pb2.Struct()
-                            image.fields["type"].string_ = "image_url"
-                            image.fields["image_url"].struct_.fields["url"].string_ = entry["image_url"]["url"]
-                            image.fields["image_url"].struct_.fields["detail"].string_ = entry["image_url"].get(
-                                "detail", "high"
-                            )
-                            payloads.append(image)
-                        else:
-                            raise ValueError(f"type {entry['type']} is not supported in content")
+    return request_builder.build(args)
+
+
+async def wait_for_connection(channel: grpc.aio.Channel) -> None:
+    # unlike channel_ready(), give up on the first failed attempt so errors surface as before
+    state = channel.get_state(try_to_connect=True)
+    while state not in (
+        grpc.ChannelConnectivity.READY,
+        grpc.ChannelConnectivity.TRANSIENT_FAILURE,
+        grpc.ChannelConnectivity.SHUTDOWN,
+    ):
+        await channel.wait_for_state_change(state)
+        state = channel.get_state()
+
+
+async def stream_backend(
+    backend: Backend, requestData: ark_pb2.InferenceRequest, trace: Trace
+) -> AsyncGenerator[ark_pb2.InferenceResponse, None]:
+    async with backend_pool.lease(backend) as channel:
+        with trace.span("channel"):
+            try:
+                await asyncio.wait_for(wait_for_connection(channel), settings.grpc_connect_timeout)
+            except asyncio.TimeoutError:
+                pass  # let the call itself surface the connection error
+        ultraman_chat_stub = ark_pb2_grpc.InferenceStub(channel)
+        call_start_ns = time.perf_counter_ns()
+        response_iterator = ultraman_chat_stub.StreamingCall(
+            requestData,
+            metadata=trace.grpc_metadata(requestData.req_id),
+            compression=grpc_compression(requestData, settings.grpc_compression_threshold_bytes),
+        )
+        async for response in response_iterator:
+            trace.token(call_start_ns)
+            yield response
+
+
+async def stream_with_failover(
+    backend: Backend, requestData: ark_pb2.InferenceRequest, trace: Trace
+) -> AsyncGenerator[ark_pb2.InferenceResponse, None]:
+    """
+    stream_backend, feeding the backend's circuit breaker and retrying on another backend
+    when the call fails with a breaker code before anything was sent to the client
+    """
+    tried = []
+    while True:
+        breaker = breakers.get(backend.target)
+        start = time.perf_counter()
+        sent = recorded = False
+        try:
+            async for response in stream_backend(backend, requestData, trace):
+                if not sent:
+                    sent = recorded = True
+                    breaker.record_success(time.perf_counter() - start)
+                yield response
+            if not sent:
+                recorded = True
+                breaker.record_success(time.perf_counter() - start)
+            return
+        except grpc.aio.AioRpcError as e:
+            recorded = True
+            counted = breaker.record_failure(e.code())
+            tried.append(backend.target)
+            if sent or not counted or len(tried) > settings.breaker_max_retries:
+                raise
+            retry_backend = backend_pool.pick(exclude=tried, allow=breakers.allow)
+            if retry_backend is None:
+                raise
+            print(f"Retrying {requestData.req_id} on {retry_backend.target} after {e.code().name} from {backend.target}")
+            BACKEND_RETRIES.labels(backend.target).inc()
+            backend = retry_backend
+        finally:
+            if not recorded:
+                # cancelled, eg. by a client disconnect, or failed in the proxy before a response:
+                # no verdict on the backend, so a half-open probe goes back
+                breaker.release()
+
+
+@warmup.step("validators")
+def warm_validators():
+    body = json.dumps(synthetic_request("warmup")).encode()
+    ChatCompletionRequest.model_validate_json(body)
+    parse_chat_completion_request(body)
+
+
+@warmup.step("make_ark_req")
+def warm_make_ark_req():
+    for model in settings.warmup_models.split(","):
+        if model.strip():
+            requestData = make_ark_req(ChatCompletionRequest.model_validate(synthetic_request(model.strip())))
+            requestData.SerializeToString()
+            prompt_tokens_estimate(requestData)
+
+
+@warmup.step("serialize")
+def warm_serialize():
+    response = synthetic_response()
+    choice = decode_value(response.outputs["choice"])
+    chunk = {"id": "warmup", "choices": [{"index": 0, "delta": choice["message"], "finish_reason": "stop"}]}
+    json.dumps(chunk, ensure_ascii=False)
+    body = render_json(chunk)
+    for encoding in response_compressor.encodings:
+        compress(body, encoding)
+
+
+@warmup.step("offload_pools")
+async def warm_offload_pools():
+    if offloader.enabled:
+        # spawned processes import the app modules, pay for that now
+        await offloader.run(offloader.threshold_bytes, render_json, {}, process_safe=True)
+        await offloader.run(offloader.threshold_bytes, render_json, {})
+
+
+@warmup.step("backends")
+async def warm_backends():
+    async def connect(backend: Backend) -> bool:
+        try:
+            await asyncio.wait_for(wait_for_connection(backend.channel), settings.grpc_connect_timeout)
+        except asyncio.TimeoutError:
+            pass
+        return backend.channel.get_state() == grpc.ChannelConnectivity.READY
+
+    backends = [backend_pool.get(target) for target in backend_pool.targets]
+    connected = await asyncio.gather(*(connect(backend) for backend in backends if backend is not None))
+    if not all(connected):
+        raise ConnectionError(f"{connected.count(False)} of {len(connected)} backends are not reachable")
+
+
+def backend_reachable(backend: Backend) -> bool:
+    # without taking a half-open probe from the breaker
+    if breakers.enabled and breakers.get(backend.target).state == OPEN:
+        return False
+    return backend.channel.get_state() not in (
+        grpc.ChannelConnectivity.TRANSIENT_FAILURE,
+        grpc.ChannelConnectivity.SHUTDOWN,
+    )
+
+
+def target_reachable(target: str) -> bool:
+    backend = backend_pool.get(target)
+    return backend is not None and backend_reachable(backend)
+
+
+def make_prewarm_req(prefix: Prefix) -> ark_pb2.InferenceRequest:
+    return make_ark_req(
+        ChatCompletionRequest.model_validate({"model": prefix.model, "messages": prefix.messages, "max_tokens": 1})
+    )
+
+
+prewarm_default_model = settings.warmup_models.split(",")[0].strip()
+prewarmer = PromptPrewarmer(
+    backend_pool,
+    make_prewarm_req,
+    target_reachable,
+    affinity=settings.prewarm_affinity,
+    interval=settings.prewarm_interval,
+    concurrency=settings.prewarm_concurrency,
+    timeout=settings.prewarm_timeout,
+    lock_path=settings.prewarm_lock,
+    state_path=settings.prewarm_state,
+)
+if settings.prewarm_file:
+    prewarmer.load(settings.prewarm_file, prewarm_default_model)
+
+
+@app.get("/ready")
+async def ready():
+    if not warmup.ready:
+        return JSONResponse(status_code=503, content={"status": "warming up"})
+    backends = [backend_pool.get(target) for target in backend_pool.targets]
+    if not any(backend is not None and backend_reachable(backend) for backend in backends):
+        return JSONResponse(status_code=503, content={"status": "no backend available"})
+    return JSONResponse(content={"status": "ready", "warmup": warmup.results})
+
+
+@app.get("/metrics")
+async def metrics():
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+
+def admin_denied(raw_request: Request):
+    """
+    Error response unless the request carries the admin token
+    """
+    if not settings.admin_token:
+        return JSONResponse(status_code=404, content={"error": {"code": 404, "message": "Not Found"}})
+    scheme, _, token = raw_request.headers.get("authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not hmac.compare_digest(token.strip().encode(), settings.admin_token.encode()):
+        return JSONResponse(status_code=401, content={"error": {"code": 401, "message": "invalid admin token"}})
+    return None
+
+
+@app.get("/debug/profile")
+async def debug_profile(raw_request: Request, seconds: float = 10.0, hz: float = 100.0, all_threads: bool = False):
+    """
+    Collapsed stacks of this worker over `seconds`, for flamegraph.pl or speedscope
+    """
+    denied = admin_denied(raw_request)
+    if denied is not None:
+        return denied
+    seconds = min(max(seconds, 0.1), settings.profile_max_seconds)
+    hz = min(max(hz, 1.0), 1000.0)
+    stacks = await stack_sampler.profile(seconds, hz, all_threads)
+    if stacks is None:
+        return JSONResponse(status_code=409, content={"error": {"code": 409, "message": "a profile is already running"}})
+    filename = f"profile-{os.getpid()}-{int(time.time())}.collapsed"
+    return PlainTextResponse(
+        stack_sampler.collapsed(stacks), headers={"content-disposition": f'attachment; filename="{filename}"'}
+    )
+
+
+@app.get("/admin/prewarm")
+async def prewarm_status(raw_request: Request):
+    """
+    Known prefixes, the backends each is warmed on and the last warming of each
+    """
+    denied = admin_denied(raw_request)
+    if denied is not None:
+        return denied
+    await prewarmer.refresh()
+    return JSONResponse(
+        content={
+            "affinity": prewarmer.affinity,
+            "prefixes": [
+                {**prefix.to_dict(), "backends": prewarmer.targets(prefix)} for prefix in prewarmer.prefixes.values()
+            ],
+            "results": list(prewarmer.results.values()),
+        }
+    )
+
+
+@app.post("/admin/prewarm")
+async def prewarm(raw_request: Request):
+    """
+    Warm {"prefixes": [...]} now, kept and warmed on schedule too with "keep": true; every
+    known prefix without any
+    """
+    denied = admin_denied(raw_request)
+    if denied is not None:
+        return denied
+    body = await raw_request.body()
+    try:
+        spec = json.loads(body) if body else {}
+        prefixes = [Prefix.parse(prefix, prewarm_default_model) for prefix in spec.get("prefixes", [])]
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        return JSONResponse(status_code=400, content={"error": {"code": 400, "message": f"invalid prefixes: {e}"}})
+    if spec.get("keep"):
+        await prewarmer.keep(prefixes)
+    results = await prewarmer.warm(prefixes or None)
+    return JSONResponse(content={"results": results})
+
+
+@app.delete("/admin/prewarm/{name}")
+async def delete_prewarm(name: str, raw_request: Request):
+    denied = admin_denied(raw_request)
+    if denied is not None:
+        return denied
+    if not await prewarmer.forget(name):
+        return JSONResponse(status_code=404, content={"error": {"code": 404, "message": "unknown prefix"}})
+    return JSONResponse(content={"deleted": name})
+
+
+@app.post("/v1/sessions")
+async def create_session():
+    # no call is made here, so no probe is taken
+    backend = backend_pool.pick(allow=breakers.available) or backend_pool.pick()
+    session = await asyncio.to_thread(session_store.create, backend.target)
+    return JSONResponse(content={"id": session.session_id, "object": "session", "ttl": settings.session_ttl})
+
+
+@app.delete("/v1/sessions/{session_id}")
+async def delete_session(session_id: str):
+    if not await asyncio.to_thread(session_store.delete, session_id):
+        return JSONResponse(status_code=404, content={"error": {"code": 404, "message": f"session {session_id} not found"}})
+    return JSONResponse(content={"id": session_id, "object": "session", "deleted": True})
 
-                        struct = ark_pb2.Struct()
-                        struct.fields["role"].string_ = msg["role"]
-                        struct.fields["content"].value_list.values.extend(
-                            [ark_pb2.Value(struct_=payload) for payload in payloads]
-                        )
-                        request.inputs["messages"].value_list.values.append(ark_pb2.Value(struct_=struct))
-            else:
-                raise Exception("Unknown message.content type")
-
-    request.req_id = str(uuid.uuid4())
-    request.model_name = args.model
-
-    if args.stop is not None:
-        request.inputs["stop"].MergeFrom(encode_value(args.stop))
-    if args.max_tokens is not None:
-        request.inputs["max_new_tokens"].int64_ = args.max_tokens
-    if args.n is not None:
-        request.inputs["n"].int64_ = args.n
-    if args.temperature is not None:
-        request.inputs["temperature"].float_ = args.temperature
-    if args.top_p is not None:
-        request.inputs["top_p"].float_ = args.top_p
-    if args.presence_penalty is not None:
-        request.inputs["presence_penalty"].float_ = args.presence_penalty
-    if args.frequency_penalty is not None:
-        request.inputs["frequency_penalty"].float_ = args.frequency_penalty
-    if args.logprobs == True:
-        request.inputs["logprobs"].int64_ = args.top_logprobs if args.top_logprobs is not None else 1
-    if args.logit_bias is not None:
-        for key, value in args.logit_bias.items():
-            request.inputs["logit_bias"].int64_dict.fields[int(key)].int64_ = value
-    if args.response_format is not None:
-        request.inputs["response_format"].MergeFrom(encode_value(args.response_format.dict(by_alias=True)))
-    if args.guided_grammar is not None:
-        request.inputs["guided_grammar"].string_ = args.guided_grammar
-
-    if args.tools is not None:
-        request.inputs["tools"].MergeFrom(encode_value([tool.dict(by_alias=True) for tool in args.tools]))
-
-    return request
 
 @app.get("/v1/models")
 async def list_models():
@@ -159,9 +651,116 @@ async def list_models():
         }]
     })
 
-@app.post("/v1/chat/completions")
-async def create_chat_completion(request: ChatCompletionRequest):
-    requestData = make_ark_req(request)
+
+class DispatchError(Exception):
+    """
+    A streaming request that was already answered found no dispatch slot or backend
+    """
+
+
+def settle_rate_limit(key: str, estimated_tokens: int, actual_tokens: Optional[int]) -> None:
+    # in a thread and not awaited, so requests being cancelled still settle
+    asyncio.get_running_loop().run_in_executor(None, rate_limiter.settle, key, estimated_tokens, actual_tokens)
+
+
+def heartbeat_event():
+    STREAM_HEARTBEATS.inc()
+    return dict(comment="keep-alive") if settings.sse_data_prefix else b": keep-alive\n\n"
+
+
+def stream_opened(trace: Trace) -> None:
+    now_ns = time.perf_counter_ns()
+    trace.add_span("open", trace.start_ns, now_ns)
+    STREAM_OPEN_SECONDS.observe((now_ns - trace.start_ns) / 1e9)
+
+
+def event_stream_response(events, headers=None):
+    if settings.sse_data_prefix:
+        return EventSourceResponse(events, headers=headers)
+    return StreamingResponse(events, media_type="text/event-stream", headers=headers)
+
+
+async def resumable_events(events, trace: Optional[Trace] = None):
+    """
+    SSE events of a resumable stream from its `events`; the first one marks the stream open on `trace`
+    """
+    try:
+        async for event in events:
+            if event is IDLE:
+                yield heartbeat_event()
+                continue
+            if trace is not None:
+                stream_opened(trace)
+                trace = None
+            event_id, data = event
+            if settings.sse_data_prefix:
+                yield dict(id=str(event_id), data=data)
+            else:
+                yield b"id: %d\ndata: %s\n\n" % (event_id, data.encode())
+    except (EventsDropped, StreamLost) as e:
+        data = json.dumps({"error": str(e)})
+        yield dict(data=data) if settings.sse_data_prefix else b"data: " + data.encode() + b"\n\n"
+
+
+async def resume_stream(req_id: str, raw_request: Request):
+    """
+    Response continuing the resumable stream `req_id` after Last-Event-ID, None to start it
+    """
+    last_event_id = parse_last_event_id(raw_request.headers.get("last-event-id"))
+    try:
+        found = await asyncio.to_thread(resumable_streams.lookup, req_id)
+    except sqlite3.Error as e:
+        print(f"Error: resumable stream lookup failed: {e}")
+        found = None
+    if found is None:
+        if not last_event_id:
+            return None
+        STREAM_RESUMES.labels("gone").inc()
+        return JSONResponse(
+            status_code=410, content={"error": {"code": 410, "message": f"stream {req_id} is no longer available"}}
+        )
+    expected_hash, _ = found
+    token = raw_request.headers.get("x-resume-token", "")
+    if not hmac.compare_digest(token_hash(token), expected_hash):
+        STREAM_RESUMES.labels("conflict").inc()
+        return JSONResponse(
+            status_code=409, content={"error": {"code": 409, "message": f"request id {req_id} is in use"}}
+        )
+    STREAM_RESUMES.labels("resumed").inc()
+    idle_timeout = settings.stream_heartbeat_seconds or None
+    stream = resumable_streams.get(req_id)
+    if stream is not None:
+        return event_stream_response(resumable_events(stream.events(last_event_id, idle_timeout)))
+    # generated by another worker
+    return event_stream_response(resumable_events(resumable_streams.shared_events(req_id, last_event_id, idle_timeout)))
+
+
+async def create_chat_completion(request: ChatCompletionRequest, raw_request: Request):
+    if resumable_streams.enabled and request.stream and "req_id" in request.model_fields_set:
+        resumed = await resume_stream(request.req_id, raw_request)
+        if resumed is not None:
+            return resumed
+    trace = tracer.start(raw_request.headers.get("traceparent"), getattr(raw_request.state, "trace_start_ns", None))
+    trace.add_span("parse", trace.start_ns, time.perf_counter_ns())
+    with trace.span("make_ark_req"):
+        # compressed bodies have no content-length, the decompression middleware counts them
+        request_size = int(raw_request.headers.get("content-length") or 0) or getattr(
+            raw_request.state, "decoded_body_bytes", 0
+        )
+        requestData = await offloader.run(request_size, make_ark_req, request)
+    trace.attributes.update(req_id=requestData.req_id, model=request.model, stream=bool(request.stream))
+    capture_record = capture.start(request)
+    session = None
+    if request.session_id is not None:
+        session = await asyncio.to_thread(session_store.get, request.session_id)
+        if session is None:
+            trace.finish(error="session not found")
+            if capture_record is not None:
+                capture_record.finish(404, "session not found")
+            return JSONResponse(
+                status_code=404, content={"error": {"code": 404, "message": f"session {request.session_id} not found"}}
+            )
+        session_turn = session.extend_request(requestData)
     response_role = "assistant"
     chunk_id = "chatcmpl-" + str(time.time_ns())  # Unique identifier for the chat completion
     timestamp = int(time.time())  # Current Unix timestamp in seconds
@@ -169,8 +768,138 @@ async def create_chat_completion(request: ChatCompletionRequest):
     system_fp = "fp"  # System fingerprint, should be generated or retrieved from a config
     usage_flag = False
 
-    service = lookup_service(settings)
-    url = "{}/generate".format(service)
+    rate_key = None
+    rate_headers = None
+    if rate_limiter.enabled:
+        rate_key = tenant_id(raw_request.headers)
+        max_tokens = request.max_tokens if request.max_tokens is not None else settings.rate_limit_default_max_tokens
+        estimated_tokens = prompt_tokens_estimate(requestData) + max_tokens * request.n
+        rate_limit = await asyncio.to_thread(rate_limiter.check, rate_key, estimated_tokens)
+        rate_headers = rate_limit.headers
+        if not rate_limit.allowed:
+            trace.finish(error="rate limited")
+            if capture_record is not None:
+                capture_record.finish(429, "rate limited")
+            return JSONResponse(
+                status_code=429,
+                content=RateLimiter.error_body(rate_limit),
+                headers={
+                    **rate_headers,
+                    "retry-after": str(math.ceil(rate_limit.retry_after)),
+                    "retry-after-ms": str(math.ceil(rate_limit.retry_after * 1000)),
+                },
+            )
+
+    fair_ticket = None
+    if fair_queue.enabled:
+        fair_ticket = fair_queue.estimate(
+            tenant_id(raw_request.headers, settings.tenant_header),
+            prompt_tokens_estimate(requestData),
+            request.max_tokens,
+            request.n,
+        )
+
+    def open_responses():
+        """
+        Responses of the backend or the fanned-out backends picked for the request, None when none is available
+        """
+        nonlocal fanout
+        if session is None and settings.fanout_min_n > 0 and request.n >= settings.fanout_min_n:
+            backends = backend_pool.pick_many(min(request.n, settings.fanout_max_backends), allow=breakers.allow)
+            if len(backends) > 1:
+                # without an explicit seed the sub-requests sample like one unsplit request
+                seed = request.seed if "seed" in request.model_fields_set else None
+                sub_requests = make_fanout_requests(requestData, request.n, seed, len(backends))
+                fanout = FanoutStream(
+                    [
+                        (offset, stream_with_failover(backend, sub_request, trace))
+                        for backend, (offset, sub_request) in zip(backends, sub_requests)
+                    ]
+                )
+                return fanout
+            for backend in backends:
+                breakers.release(backend.target)
+        backend = None
+        if session is not None:
+            # sessions stick to one backend so its prompt cache holds their history
+            backend = backend_pool.get(session.backend)
+            if backend is not None and not breakers.allow(backend.target):
+                backend = None
+        if backend is None and prewarmer.affinity:
+            # the backend whose prompt cache holds the known prefix the request starts with
+            backend = prewarmer.route(request.model or "", request.messages)
+            if backend is not None and not breakers.allow(backend.target):
+                backend = None
+        if backend is None:
+            backend = backend_pool.pick(allow=breakers.allow)
+            if backend is None:
+                return None
+            if session is not None:
+                session.backend = backend.target
+        return stream_with_failover(backend, requestData, trace)
+
+    async def queued_responses():
+        with trace.span("fair_queue"):
+            admitted = await fair_queue.acquire(fair_ticket)
+        if not admitted:
+            if rate_key is not None:
+                settle_rate_limit(rate_key, estimated_tokens, 0)
+            raise DispatchError("timed out waiting for a dispatch slot")
+        responses = open_responses()
+        if responses is None:
+            fair_queue.release(fair_ticket)
+            if rate_key is not None:
+                settle_rate_limit(rate_key, estimated_tokens, 0)
+            raise DispatchError("no backend available")
+        responses = fair_queue.dispatch(fair_ticket, responses)
+        usage_streams.append(responses)
+        async for response in responses:
+            yield response
+
+    # settle the fair queue and the rate limiter even when the responses are dropped unread
+    usage_streams = []
+    fanout = None
+    if fair_ticket is not None and request.stream:
+        # the stream opens at once and sends heartbeats while the request waits for a slot
+        responses = queued_responses()
+    else:
+        if fair_ticket is not None:
+            with trace.span("fair_queue"):
+                admitted = await fair_queue.acquire(fair_ticket)
+            if not admitted:
+                trace.finish(error="fair queue timeout")
+                if capture_record is not None:
+                    capture_record.finish(503, "fair queue timeout")
+                if rate_key is not None:
+                    settle_rate_limit(rate_key, estimated_tokens, 0)
+                return JSONResponse(
+                    status_code=503, content={"error": {"code": 503, "message": "timed out waiting for a dispatch slot"}}
+                )
+        responses = open_responses()
+        if responses is None:
+            trace.finish(error="no backend available")
+            if fair_ticket is not None:
+                fair_queue.release(fair_ticket)
+            if rate_key is not None:
+                settle_rate_limit(rate_key, estimated_tokens, 0)
+            if capture_record is not None:
+                capture_record.finish(503, "no backend available")
+            return JSONResponse(status_code=503, content={"error": {"code": 503, "message": "no backend available"}})
+        if fair_ticket is not None:
+            responses = fair_queue.dispatch(fair_ticket, responses)
+            usage_streams.append(responses)
+    if rate_key is not None:
+        responses = UsageStream(
+            responses,
+            lambda prompt, completion: settle_rate_limit(
+                rate_key, estimated_tokens, None if prompt is None else prompt + completion
+            ),
+        )
+        usage_streams.append(responses)
+
+    def finish_usage() -> None:
+        for usage_stream in usage_streams:
+            usage_stream.finish()
 
     if request.stream and request.stream_options is not None and request.stream_options.include_usage == True:
         usage_flag = True
@@ -180,159 +909,320 @@ async def create_chat_completion(request: ChatCompletionRequest):
         try:
             object_type = "chat.completion.chunk"
 
+            def role_chunk(index: int) -> str:
+                # serialized, so the slow client policy never merges content into it
+                chunk = {
+                    "id": chunk_id,
+                    "choices": [
+                        {
+                            "index": index,
+                            "delta": {"role": response_role, "content": ""},
+                            "finish_reason": None,
+                            **({"logprobs": None} if request.logprobs else {}),
+                        }
+                    ],
+                    "created": timestamp,
+                    "model": model_name,
+                    "system_fingerprint": system_fp,
+                    "object": object_type,
+                    **({"usage": None} if usage_flag else {}),
+                }
+                return json.dumps(chunk, ensure_ascii=False)
+
+            async def ProduceResults(buffer: StreamBuffer) -> None:
+                reply = {"content": [], "tool_calls": []}
+                first_response = True
+                try:
+                    if settings.stream_role_chunk:
+                        for index in range(request.n or 1):
+                            await buffer.put(role_chunk(index))
+                    async for response in responses:
+                        if first_response:
+                            first_response = False
+                            STREAM_FIRST_TOKEN_SECONDS.observe((time.perf_counter_ns() - trace.start_ns) / 1e9)
+                        if capture_record is not None:
+                            capture_record.add(response)
+                        # Extract the data from the response
+                        choice = decode_value(response.outputs["choice"])
+                        if session is not None and response.outputs["choice.index"].int64_ == 0:
+                            reply["content"].append(choice["message"]["content"])
+                            reply["tool_calls"].extend(choice["message"].get("tool_calls", []))
+                        # generated_text = response.outputs["choice.message.content"].bytes_.decode()
+                        if response.outputs.get("usage") is not None:
+                            usage = response.outputs.get("usage")
+                            output_len = usage.struct_.fields["completion_tokens"].int64_
+                            prompt_len = usage.struct_.fields["prompt_tokens"].int64_
+                            reasoning_tokens_len = (
+                                usage.struct_.fields["completion_tokens_details"]
+                                .struct_.fields["reasoning_tokens"]
+                                .int64_
+                            )
+                        converted_response = {
+                            "id": chunk_id,
+                            "choices": [
+                                {
+                                    "index": response.outputs["choice.index"].int64_,
+                                    "delta": {
+                                        "role": response_role,
+                                        "content": choice["message"]["content"],
+                                        "reasoning_content": choice["message"].get("reasoning_content", ""),
+                                        "tool_calls": choice["message"].get("tool_calls", []),
+                                    },
+                                    "finish_reason": response.outputs["choice.finish_reason"].bytes_.decode(),
+                                }
+                            ],
+                            "created": timestamp,
+                            "model": model_name,
+                            "system_fingerprint": system_fp,
+                            "object": object_type,
+                            "usage": (
+                                {
+                                    "prompt_tokens": prompt_len,
+                                    "completion_tokens": output_len,
+                                    "total_tokens": output_len + prompt_len,
+                                    "completion_tokens_details": {
+                                        "reasoning_tokens": reasoning_tokens_len,
+                                    },
+                                }
+                                if not usage_flag or response.outputs["choice.finish_reason"].bytes_.decode() != ""
+                                else None
+                            ),  # This would be populated with usage info on the last chunk if applicable
+                        }
+                        item = converted_response
+                        if request.logprobs:
+                            # token logprobs are serialized in bulk and spliced into the chunk
+                            entries = logprobs_encoder.encode(response.outputs, model_name or "")
+                            converted_response["choices"][0]["logprobs"] = placeholder(0)
+                            item = splice(
+                                json.dumps(converted_response, ensure_ascii=False),
+                                {0: None if entries is None else logprobs_encoder.content(entries)},
+                            )
+                        if not await buffer.put(item):
+                            return  # dropped by the slow client policy, this cancels the backend call
+
+                    if fanout is not None and usage_flag:
+                        # usage over every fanned-out choice, in a final chunk without choices
+                        converted_response = {
+                            "id": chunk_id,
+                            "choices": [],
+                            "created": timestamp,
+                            "model": model_name,
+                            "system_fingerprint": system_fp,
+                            "object": object_type,
+                            "usage": fanout.usage(),
+                        }
+                        await buffer.put(converted_response)
+
+                    if session is not None:
+                        reply_message = request_builder.encode_reply(
+                            {"content": "".join(reply["content"]), "tool_calls": reply["tool_calls"]}
+                        )
+                        await asyncio.to_thread(session_store.commit, session, session_turn, reply_message)
+
+                    # Send the final [DONE] message
+                    await buffer.put("[DONE]")
+
+                except DispatchError as e:
+                    trace.attributes["error"] = str(e)
+                    if capture_record is not None:
+                        capture_record.error = str(e)
+                    await buffer.put(json.dumps({"error": {"code": 503, "message": str(e)}}))
+                except grpc.aio.AioRpcError as e:
+                    print(f"Error: {e}")
+                    trace.attributes["grpc_status"] = e.code().name
+                    if capture_record is not None:
+                        capture_record.error = e.code().name
+                    await buffer.put(json.dumps({"status": e.code().value, "error": str(e)}))
+                except Exception as e:
+                    print(f"Error: {e}")
+                    if capture_record is not None:
+                        capture_record.error = str(e)
+                    await buffer.put(json.dumps({"error": str(e)}))
+                finally:
+                    buffer.close()
+                    finish_usage()
+
+            def FinishStream() -> None:
+                trace.finish()
+                if capture_record is not None:
+                    capture_record.finish()
+
             async def StreamResults() -> AsyncGenerator[bytes, None]:
-                async with grpc.aio.insecure_channel(url) as channel:
-                    ultraman_chat_stub = ark_pb2_grpc.InferenceStub(channel)
-                    response_iterator = ultraman_chat_stub.StreamingCall(requestData)
-                    try:
-                        async for response in response_iterator:
-                            # Extract the data from the response
-                            choice = decode_value(response.outputs["choice"])
-                            # generated_text = response.outputs["choice.message.content"].bytes_.decode()
-                            if response.outputs.get("usage") is not None:
-                                usage = response.outputs.get("usage")
-                                output_len = usage.struct_.fields["completion_tokens"].int64_
-                                prompt_len = usage.struct_.fields["prompt_tokens"].int64_
-                                reasoning_tokens_len = (
-                                    usage.struct_.fields["completion_tokens_details"]
-                                    .struct_.fields["reasoning_tokens"]
-                                    .int64_
-                                )
-                            converted_response = {
-                                "id": chunk_id,
-                                "choices": [
-                                    {
-                                        "index": response.outputs["choice.index"].int64_,
-                                        "delta": {
-                                            "role": response_role,
-                                            "content": choice["message"]["content"],
-                                            "reasoning_content": choice["message"].get("reasoning_content", ""),
-                                            "tool_calls": choice["message"].get("tool_calls", []),
-                                        },
-                                        "finish_reason": response.outputs["choice.finish_reason"].bytes_.decode(),
-                                    }
-                                ],
-                                "created": timestamp,
-                                "model": model_name,
-                                "system_fingerprint": system_fp,
-                                "object": object_type,
-                                "usage": (
-                                    {
-                                        "prompt_tokens": prompt_len,
-                                        "completion_tokens": output_len,
-                                        "total_tokens": output_len + prompt_len,
-                                        "completion_tokens_details": {
-                                            "reasoning_tokens": reasoning_tokens_len,
-                                        },
-                                    }
-                                    if not usage_flag or response.outputs["choice.finish_reason"].bytes_.decode() != ""
-                                    else None
-                                ),  # This would be populated with usage info on the last chunk if applicable
-                            }
-                            if settings.sse_data_prefix:
-                                yield dict(data=json.dumps(converted_response, ensure_ascii=False))
-                            else:
-                                yield b"data: " + json.dumps(converted_response, ensure_ascii=False).encode() + b"\n\n"
-                        
-                        # Send the final [DONE] message
+                buffer = StreamBuffer(
+                    stream_budget,
+                    settings.stream_buffer_bytes,
+                    settings.slow_client_policy,
+                    settings.stream_heartbeat_seconds or None,
+                )
+                producer = asyncio.create_task(ProduceResults(buffer))
+                opened = False
+                try:
+                    async for item in buffer:
+                        if item is IDLE:
+                            yield heartbeat_event()
+                            continue
+                        if not opened:
+                            opened = True
+                            stream_opened(trace)
+                        data = item if isinstance(item, str) else json.dumps(item, ensure_ascii=False)
                         if settings.sse_data_prefix:
-                            yield dict(data="[DONE]")
+                            yield dict(data=data)
                         else:
-                            yield b"data: [DONE]\n\n"
-                            
-                    except grpc.aio.AioRpcError as e:
-                        print(f"Error: {e}")
-                        if settings.sse_data_prefix:
-                            yield dict(data=json.dumps({"status": e.code().value, "error": str(e)}))
-                        else:
-                            yield b"data: " + json.dumps({"status": e.code().value, "error": str(e)}).encode() + b"\n\n"
+                            yield b"data: " + data.encode() + b"\n\n"
+                finally:
+                    producer.cancel()
+                    buffer.release()
+                    FinishStream()
+                    # the producer may be cancelled before it ever ran
+                    finish_usage()
 
-            if settings.sse_data_prefix:
-                return EventSourceResponse(StreamResults())
-            else:
-                return StreamingResponse(StreamResults(), media_type="text/event-stream")
+            resumable = None
+            if resumable_streams.enabled and "req_id" in request.model_fields_set:
+                resumable = await resumable_streams.create(request.req_id)
+            if resumable is not None:
+                # generation runs on its own and outlives the connection by the grace period
+                resumable.task = asyncio.create_task(ProduceResults(resumable))
+                resumable.task.add_done_callback(lambda _: FinishStream())
+                events = resumable.events(0, settings.stream_heartbeat_seconds or None)
+                headers = {**(rate_headers or {}), "x-resume-token": resumable.token}
+                return event_stream_response(resumable_events(events, trace), headers)
+            return event_stream_response(StreamResults(), rate_headers)
         except Exception as e:
             print(f"Error: {e}")
+            finish_usage()
             return JSONResponse(status_code=500, content={"error": {"code": 500, "message": str(e)}})
     # Non-streaming case
     else:
         try:
             object_type = "chat.completion"
-            async with grpc.aio.insecure_channel(url) as channel:
-                ultraman_chat_stub = ark_pb2_grpc.InferenceStub(channel)
-                response_iterator = ultraman_chat_stub.StreamingCall(requestData)
-                index_choices = {}
-                async for response in response_iterator:
-                    # Extract the data from the response
-                    choice = decode_value(response.outputs["choice"])
-                    index = response.outputs["choice.index"].int64_
-                    if index not in index_choices:
-                        index_choices[index] = {
-                            "role": response_role,
-                            "content": choice["message"]["content"],
-                            "reasoning_content": choice["message"].get("reasoning_content", ""),
-                            "tool_calls": choice["message"].get("tool_calls", []),
+            index_choices = {}
+            async for response in responses:
+                if capture_record is not None:
+                    capture_record.add(response)
+                # Extract the data from the response
+                choice = decode_value(response.outputs["choice"])
+                index = response.outputs["choice.index"].int64_
+                if index not in index_choices:
+                    index_choices[index] = {
+                        "role": response_role,
+                        "content": choice["message"]["content"],
+                        "reasoning_content": choice["message"].get("reasoning_content", ""),
+                        "tool_calls": choice["message"].get("tool_calls", []),
+                    }
+                else:
+                    index_choices[index]["content"] += choice["message"]["content"]
+                    index_choices[index]["reasoning_content"] += choice["message"].get("reasoning_content", "")
+                    index_choices[index]["tool_calls"].extend(choice["message"].get("tool_calls", []))
+                index_choices[index]["finish_reason"] = response.outputs["choice.finish_reason"].bytes_.decode()
+                if request.logprobs:
+                    entries = logprobs_encoder.encode(response.outputs, model_name or "")
+                    index_choices[index].setdefault("logprobs", []).extend(entries or ())
+
+                if response.outputs.get("usage") is not None:
+                    usage = response.outputs.get("usage")
+                    output_len = usage.struct_.fields["completion_tokens"].int64_
+                    prompt_len = usage.struct_.fields["prompt_tokens"].int64_
+                    reasoning_tokens_len = (
+                        usage.struct_.fields["completion_tokens_details"].struct_.fields["reasoning_tokens"].int64_
+                    )
+                    if index_choices[index].get("usage") is None:
+                        index_choices[index]["usage"] = {
+                            "prompt_tokens": prompt_len,
                         }
-                    else:
-                        index_choices[index]["content"] += choice["message"]["content"]
-                        index_choices[index]["reasoning_content"] += choice["message"].get("reasoning_content", "")
-                        index_choices[index]["tool_calls"].extend(choice["message"].get("tool_calls", []))
-                    index_choices[index]["finish_reason"] = response.outputs["choice.finish_reason"].bytes_.decode()
-
-                    if response.outputs.get("usage") is not None:
-                        usage = response.outputs.get("usage")
-                        output_len = usage.struct_.fields["completion_tokens"].int64_
-                        prompt_len = usage.struct_.fields["prompt_tokens"].int64_
-                        reasoning_tokens_len = (
-                            usage.struct_.fields["completion_tokens_details"].struct_.fields["reasoning_tokens"].int64_
+
+                    index_choices[index]["usage"]["completion_tokens"] = output_len
+                    index_choices[index]["usage"]["total_tokens"] = output_len + prompt_len
+                    index_choices[index]["usage"]["completion_tokens_details"] = {
+                        "reasoning_tokens": reasoning_tokens_len,
+                    }
+            if session is not None:
+                reply_message = None
+                if 0 in index_choices:
+                    reply_message = request_builder.encode_reply(
+                        {key: index_choices[0][key] for key in ("content", "tool_calls")}
+                    )
+                await asyncio.to_thread(session_store.commit, session, session_turn, reply_message)
+            converted_response = {
+                "id": chunk_id,
+                "object": object_type,
+                "created": timestamp,
+                "model": model_name,
+                "system_fingerprint": system_fp,
+                "choices": [
+                    {
+                        "index": index,
+                        "message": {
+                            "role": response_role,
+                            "content": choice["content"],
+                            "reasoning_content": choice["reasoning_content"],
+                            "tool_calls": choice["tool_calls"],
+                        },
+                        "finish_reason": choice["finish_reason"],
+                        **({"logprobs": placeholder(index)} if request.logprobs else {}),
+                    }
+                    for index, choice in sorted(index_choices.items())
+                ],
+                "usage": {
+                    "completion_len": sum(
+                        [choice["usage"]["completion_tokens"] for choice in index_choices.values()]
+                    ),
+                    "prompt_len": index_choices[0]["usage"]["prompt_tokens"],
+                    "total_len": index_choices[0]["usage"]["prompt_tokens"]
+                    + sum([choice["usage"]["completion_tokens"] for choice in index_choices.values()]),
+                    "completion_tokens_details": {
+                        "reasoning_tokens": sum(
+                            [
+                                choice["usage"]["completion_tokens_details"]["reasoning_tokens"]
+                                for choice in index_choices.values()
+                            ]
                         )
-                        if index_choices[index].get("usage") is None:
-                            index_choices[index]["usage"] = {
-                                "prompt_tokens": prompt_len,
-                            }
-
-                        index_choices[index]["usage"]["completion_tokens"] = output_len
-                        index_choices[index]["usage"]["total_tokens"] = output_len + prompt_len
-                        index_choices[index]["usage"]["completion_tokens_details"] = {
-                            "reasoning_tokens": reasoning_tokens_len,
-                        }
-                converted_response = {
-                    "id": chunk_id,
-                    "object": object_type,
-                    "created": timestamp,
-                    "model": model_name,
-                    "system_fingerprint": system_fp,
-                    "choices": [
+                    },
+                },
+            }
+            with trace.span("serialize"):
+                response_size = sum(
+                    len(choice["content"]) + len(choice["reasoning_content"]) for choice in index_choices.values()
+                )
+                body = await offloader.run(response_size, render_json, converted_response, process_safe=True)
+                if request.logprobs:
+                    body = splice(
+                        body,
                         {
-                            "index": index,
-                            "message": {
-                                "role": response_role,
-                                "content": choice["content"],
-                                "reasoning_content": choice["reasoning_content"],
-                                "tool_calls": choice["tool_calls"],
-                            },
-                            "finish_reason": choice["finish_reason"],
-                        }
-                        for index, choice in index_choices.items()
-                    ],
-                    "usage": {
-                        "completion_len": sum(
-                            [choice["usage"]["completion_tokens"] for choice in index_choices.values()]
-                        ),
-                        "prompt_len": index_choices[0]["usage"]["prompt_tokens"],
-                        "total_len": index_choices[0]["usage"]["prompt_tokens"]
-                        + sum([choice["usage"]["completion_tokens"] for choice in index_choices.values()]),
-                        "completion_tokens_details": {
-                            "reasoning_tokens": sum(
-                                [
-                                    choice["usage"]["completion_tokens_details"]["reasoning_tokens"]
-                                    for choice in index_choices.values()
-                                ]
-                            )
+                            index: logprobs_encoder.content(choice.get("logprobs", []))
+                            for index, choice in index_choices.items()
                         },
-                    },
-                }
-            return JSONResponse(converted_response)
+                    )
+                body, encoding_headers = await offloader.run(
+                    len(body), response_compressor.encode, body, raw_request.headers.get("accept-encoding", "")
+                )
+                json_response = Response(body, media_type="application/json", headers=encoding_headers)
+            trace.finish()
+            if capture_record is not None:
+                capture_record.finish()
+            if settings.server_timing:
+                json_response.headers["Server-Timing"] = trace.server_timing()
+            if rate_headers is not None:
+                json_response.headers.update(rate_headers)
+            return json_response
         except Exception as e:
             print(f"Error: {e}")
+            trace.finish(error=str(e))
+            if capture_record is not None:
+                capture_record.finish(500, str(e))
             return JSONResponse(status_code=500, content={"error": {"code": 500, "message": str(e)}})
+        finally:
+            finish_usage()
+
+
+async def create_chat_completion_fast(raw_request: Request):
+    body = await raw_request.body()
+    request = await offloader.run(len(body), parse_chat_completion_request, body, process_safe=True)
+    return await create_chat_completion(request, raw_request)
+
+
+if settings.fast_parse:
+    app.post("/v1/chat/completions")(create_chat_completion_fast)
+else:
+    app.post("/v1/chat/completions")(create_chat_completion)
+
+record_import()
@@ -106,6 +106,8 @@ class ChatCompletionRequest(OpenAIBaseModel):
 
     # Custom extended parameters
     guided_grammar: Optional[str] = None
+    # send only the new turn, the proxy prepends the history kept for this session
+    session_id: Optional[str] = None
 
 
 class FunctionCall(OpenAIBaseModel):
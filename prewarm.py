@@ -0,0 +1,409 @@
+import asyncio
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+import grpc
+
+from backend_pool import Backend, BackendPool
+from metrics import Counter, Gauge
+from proto import ark_pb2, ark_pb2_grpc
+
+logger = logging.getLogger(__name__)
+
+PREWARM_REQUESTS = Counter("ark_prewarm_requests_total", "Prompt cache warming calls by outcome", ["result"])
+PREWARM_CACHE_TOKENS = Gauge(
+    "ark_prewarm_cache_tokens",
+    "Prompt cache tokens the backend reported for the last warming of each prefix",
+    ["prefix", "backend", "kind"],
+)
+
+CACHE_STATS = ("prompt_cache_hit_tokens", "prompt_cache_miss_tokens", "prompt_cache_initial_tokens")
+
+
+class Prefix:
+    """
+    Leading messages shared by many requests of a model, eg. a system prompt
+    """
+
+    __slots__ = ("name", "model", "messages", "key")
+
+    def __init__(self, name: str, model: str, messages: List[Dict[str, str]]):
+        self.name = name
+        self.model = model
+        self.messages = messages
+        self.key = messages_key(model, messages)
+
+    @classmethod
+    def parse(cls, spec: Any, default_model: str) -> "Prefix":
+        """
+        From a system prompt string or {"name", "model", "messages"}
+        """
+        if isinstance(spec, str):
+            spec = {"messages": [{"role": "system", "content": spec}]}
+        messages = [{"role": m["role"], "content": m["content"]} for m in spec["messages"]]
+        if not messages or not all(isinstance(m["content"], str) for m in messages):
+            raise ValueError("prefix messages must be non-empty and text only")
+        model = spec.get("model") or default_model
+        return cls(spec.get("name") or messages_key(model, messages)[:12], model, messages)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"name": self.name, "model": self.model, "messages": self.messages}
+
+
+def messages_key(model: str, messages: Iterable[Dict[str, Any]]) -> str:
+    digest = hashlib.sha1(model.encode())
+    for message in messages:
+        digest.update(b"\x00" + message["role"].encode() + b"\x00" + message["content"].encode())
+    return digest.hexdigest()
+
+
+def rendezvous(key: str, targets: Sequence[str]) -> Optional[str]:
+    """
+    Highest random weight target of `key`; only keys of a removed target move
+    """
+    if not targets:
+        return None
+    return max(targets, key=lambda target: hashlib.blake2b(f"{key}/{target}".encode(), digest_size=8).digest())
+
+
+def cache_stats(response: ark_pb2.InferenceResponse) -> Dict[str, int]:
+    # backends send the cache struct or its flattened cache.* outputs
+    stats = {}
+    cache = response.outputs.get("cache")
+    for name in CACHE_STATS:
+        if cache is not None and name in cache.struct_.fields:
+            stats[name] = cache.struct_.fields[name].int64_
+        elif f"cache.{name}" in response.outputs:
+            stats[name] = response.outputs[f"cache.{name}"].int64_
+    if "usage" in response.outputs:
+        stats["prompt_tokens"] = response.outputs["usage"].struct_.fields["prompt_tokens"].int64_
+    return stats
+
+
+def parse_state(data: str, path: str = "") -> Dict[str, Any]:
+    """
+    The shared state of PromptPrewarmer: prefixes added and names removed at runtime, and
+    the latest warming results
+    """
+    state = {"added": [], "removed": [], "results": []}
+    try:
+        state.update(json.loads(data) if data else {})
+    except ValueError:
+        logger.warning("ignoring the invalid prompt cache warming state %s", path)
+    return state
+
+
+class PromptPrewarmer:
+    """
+    Keeps the prompt prefix cache of the backends warm for known prefixes by sending each
+    one as a request generating a single token, to every backend or only to the backend
+    the prefix has affinity to. With affinity, requests starting with a known prefix are
+    routed to that backend too, so one backend holds each prefix.
+
+    Prefixes are warmed on start, every `interval` seconds and when backends are added.
+    Only the worker holding `lock_path` runs the schedule, so a host warms each backend
+    once rather than once per worker.
+
+    Prefixes kept or deleted at runtime and the latest warming results go to the JSON
+    file `state_path`, shared by the workers of a host; each worker reloads it when it
+    changes, so every worker routes, schedules and reports the same prefixes.
+    """
+
+    def __init__(
+        self,
+        pool: BackendPool,
+        build: Callable[[Prefix], ark_pb2.InferenceRequest],
+        healthy: Callable[[str], bool],
+        affinity: bool = False,
+        interval: float = 600.0,
+        concurrency: int = 4,
+        timeout: float = 60.0,
+        lock_path: str = "",
+        state_path: str = "",
+    ):
+        self.pool = pool
+        self.build = build
+        self.healthy = healthy
+        self.affinity = affinity
+        self.interval = interval
+        self.timeout = timeout
+        self.lock_path = lock_path
+        self.state_path = state_path
+        self.prefixes: Dict[str, Prefix] = {}
+        self.results: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        # prefixes of the prefix file, and the runtime changes to them as last read from the state
+        self._configured: Dict[str, Prefix] = {}
+        self._state = parse_state("")
+        self._state_version: Optional[Tuple[int, int, int]] = None
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._lengths: Set[int] = set()
+        self._by_key: Dict[str, Prefix] = {}
+        self._lock_file = None
+        self._tasks: Set[asyncio.Task] = set()
+        pool.add_listener(self.on_backends_changed)
+
+    def load(self, path: str, default_model: str) -> None:
+        with open(path) as f:
+            for spec in json.load(f):
+                prefix = Prefix.parse(spec, default_model)
+                self._configured[prefix.name] = prefix
+        self._apply(self._state)
+
+    def _forget_stats(self, name: str) -> None:
+        for target in self.pool.targets:
+            for kind in CACHE_STATS:
+                PREWARM_CACHE_TOKENS.remove(name, target, kind)
+
+    def _read_state(self) -> Optional[Dict[str, Any]]:
+        """
+        The shared state if it changed since it was last read; blocks
+        """
+        try:
+            with open(self.state_path) as f:
+                fcntl.flock(f, fcntl.LOCK_SH)
+                stat = os.fstat(f.fileno())
+                version = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+                if version == self._state_version:
+                    return None
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        self._state_version = version
+        return parse_state(data, self.state_path)
+
+    def _update_state(self, update: Callable[[Dict[str, Any]], Any]) -> Tuple[Dict[str, Any], Any]:
+        """
+        Apply `update` to the shared state under its file lock, returning the new state and
+        the result of `update`; blocks
+        """
+        if not self.state_path:
+            state = parse_state(json.dumps(self._state))
+            return state, update(state)
+        with open(self.state_path, "a+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            state = parse_state(f.read(), self.state_path)
+            result = update(state)
+            f.seek(0)
+            f.truncate()
+            json.dump(state, f)
+        return state, result
+
+    def _apply(self, state: Dict[str, Any]) -> None:
+        """
+        Make the prefixes and results of this worker those of `state`
+        """
+        self._state = state
+        prefixes = {name: prefix for name, prefix in self._configured.items() if name not in state["removed"]}
+        for spec in state["added"]:
+            prefixes[spec["name"]] = Prefix(spec["name"], spec["model"], spec["messages"])
+        for name, prefix in self.prefixes.items():
+            if name not in prefixes or prefixes[name].key != prefix.key:
+                self._forget_stats(name)
+        self.prefixes = prefixes
+        self._index()
+        self.results = {
+            (result["prefix"], result["backend"]): result for result in state["results"] if result["prefix"] in prefixes
+        }
+
+    async def refresh(self) -> None:
+        """
+        Reload the shared state if another worker changed it
+        """
+        if not self.state_path:
+            return
+        state = await asyncio.to_thread(self._read_state)
+        if state is not None:
+            self._apply(state)
+
+    async def keep(self, prefixes: Iterable[Prefix]) -> None:
+        """
+        Add `prefixes` to the prefixes of every worker, replacing those of the same name
+        """
+        specs = [prefix.to_dict() for prefix in prefixes]
+        names = {spec["name"] for spec in specs}
+
+        def update(state: Dict[str, Any]) -> None:
+            state["added"] = [spec for spec in state["added"] if spec["name"] not in names] + specs
+            state["removed"] = [name for name in state["removed"] if name not in names]
+
+        state, _ = await asyncio.to_thread(self._update_state, update)
+        self._apply(state)
+
+    async def forget(self, name: str) -> bool:
+        """
+        Delete the prefix `name` on every worker, False if no worker knows it
+        """
+
+        def update(state: Dict[str, Any]) -> bool:
+            added = [spec for spec in state["added"] if spec["name"] != name]
+            found = len(added) < len(state["added"])
+            state["added"] = added
+            if name in self._configured and name not in state["removed"]:
+                state["removed"].append(name)
+                found = True
+            state["results"] = [result for result in state["results"] if result["prefix"] != name]
+            return found
+
+        state, found = await asyncio.to_thread(self._update_state, update)
+        self._apply(state)
+        return found
+
+    async def _record(self, results: List[Dict[str, Any]]) -> None:
+        keys = {(result["prefix"], result["backend"]) for result in results}
+        targets = set(self.pool.targets)
+
+        def update(state: Dict[str, Any]) -> None:
+            # results of prefixes deleted and of backends removed meanwhile are dropped
+            names = {name for name in self._configured if name not in state["removed"]}
+            names.update(spec["name"] for spec in state["added"])
+            kept = [result for result in state["results"] if (result["prefix"], result["backend"]) not in keys]
+            state["results"] = [
+                result for result in kept + results if result["prefix"] in names and result["backend"] in targets
+            ]
+
+        try:
+            state, _ = await asyncio.to_thread(self._update_state, update)
+        except OSError as e:
+            logger.warning("prompt cache warming results were not shared: %s", e)
+            return
+        self._apply(state)
+
+    def _index(self) -> None:
+        self._by_key = {prefix.key: prefix for prefix in self.prefixes.values()}
+        self._lengths = {len(prefix.messages) for prefix in self.prefixes.values()}
+
+    def match(self, model: str, messages: Sequence[Dict[str, Any]]) -> Optional[Prefix]:
+        """
+        The known prefix `messages` of `model` start with, if any
+        """
+        for length in self._lengths:
+            if len(messages) < length:
+                continue
+            head = messages[:length]
+            if not all(isinstance(message.get("content"), str) for message in head):
+                continue
+            prefix = self._by_key.get(messages_key(model, head))
+            if prefix is not None:
+                return prefix
+        return None
+
+    def route(self, model: str, messages: Sequence[Dict[str, Any]]) -> Optional[Backend]:
+        """
+        Affinity backend of the prefix the request starts with, if affinity is on and it is healthy
+        """
+        if not self.affinity or not self.prefixes:
+            return None
+        prefix = self.match(model, messages)
+        if prefix is None:
+            return None
+        target = rendezvous(prefix.key, [target for target in self.pool.targets if self.healthy(target)])
+        return self.pool.get(target) if target is not None else None
+
+    def targets(self, prefix: Prefix) -> List[str]:
+        targets = [target for target in self.pool.targets if self.healthy(target)]
+        if self.affinity:
+            target = rendezvous(prefix.key, targets)
+            return [target] if target is not None else []
+        return targets
+
+    async def _warm_one(self, prefix: Prefix, target: str) -> Dict[str, Any]:
+        backend = self.pool.get(target)
+        result: Dict[str, Any] = {"prefix": prefix.name, "backend": target, "at": time.time()}
+        start = time.perf_counter()
+        try:
+            if backend is None:
+                raise LookupError("backend is gone")
+            async with self._semaphore, self.pool.lease(backend) as channel:
+                stats: Dict[str, int] = {}
+                call = ark_pb2_grpc.InferenceStub(channel).StreamingCall(self.build(prefix), timeout=self.timeout)
+                async for response in call:
+                    stats.update(cache_stats(response))
+            result.update(status="ok", **stats)
+            PREWARM_REQUESTS.labels("ok").inc()
+            for kind in CACHE_STATS:
+                if kind in stats:
+                    PREWARM_CACHE_TOKENS.labels(prefix.name, target, kind).set(stats[kind])
+        except (grpc.aio.AioRpcError, LookupError) as e:
+            result.update(status="error", error=e.code().name if isinstance(e, grpc.aio.AioRpcError) else str(e))
+            PREWARM_REQUESTS.labels("error").inc()
+        result["seconds"] = round(time.perf_counter() - start, 4)
+        self.results[(prefix.name, target)] = result
+        return result
+
+    async def warm(self, prefixes: Optional[Iterable[Prefix]] = None, targets: Optional[Iterable[str]] = None):
+        """
+        Warm `prefixes`, all known by default, on their targets, limited to `targets` if given
+        """
+        only = set(targets) if targets is not None else None
+        calls = [
+            self._warm_one(prefix, target)
+            for prefix in (list(prefixes) if prefixes is not None else list(self.prefixes.values()))
+            for target in self.targets(prefix)
+            if only is None or target in only
+        ]
+        results = await asyncio.gather(*calls)
+        await self._record(results)
+        return results
+
+    def _leader(self) -> bool:
+        if not self.lock_path:
+            return True
+        if self._lock_file is None:
+            lock_file = open(self.lock_path, "a")
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                return False
+            self._lock_file = lock_file
+            logger.info("worker %d runs the prompt cache warming schedule", os.getpid())
+        return True
+
+    async def run(self) -> None:
+        await self.refresh()
+        await asyncio.gather(self._schedule(), self._watch())
+
+    async def _watch(self) -> None:
+        if not self.state_path:
+            return
+        while True:
+            await asyncio.sleep(1.0)
+            try:
+                await self.refresh()
+            except OSError as e:
+                logger.warning("cannot read the prompt cache warming state: %s", e)
+
+    async def _schedule(self) -> None:
+        while True:
+            if self.prefixes and self._leader():
+                results = await self.warm()
+                failed = sum(result["status"] != "ok" for result in results)
+                if failed:
+                    logger.warning("prompt cache warming failed for %d of %d calls", failed, len(results))
+            if self.interval <= 0:
+                return
+            await asyncio.sleep(self.interval)
+
+    def on_backends_changed(self, added: List[str], removed: List[str]) -> None:
+        for key in [key for key in self.results if key[1] in removed]:
+            del self.results[key]
+        for prefix in self.prefixes.values():
+            for target in removed:
+                for kind in CACHE_STATS:
+                    PREWARM_CACHE_TOKENS.remove(prefix.name, target, kind)
+        if not self.prefixes or not self._lock_file and self.lock_path:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        # with affinity, prefixes of a removed backend move and any may move to an added one
+        task = loop.create_task(self.warm() if self.affinity else self.warm(targets=added))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
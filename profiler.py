@@ -0,0 +1,183 @@
+import asyncio
+import collections
+import os
+import sys
+import sysconfig
+import threading
+import time
+from typing import Dict, Iterable, List, Optional
+
+from metrics import Counter
+
+PROFILE_SAMPLES = Counter(
+    "ark_profile_samples_total",
+    "Always-on stack samples of the event loop thread, by request path function; self for the "
+    "innermost one on the stack, total for every one on it",
+    ["function", "kind"],
+)
+
+_APP_DIR = os.path.dirname(os.path.abspath(__file__)) + os.sep
+_STDLIB_DIR = os.path.abspath(sysconfig.get_paths()["stdlib"]) + os.sep
+# innermost frames of an event loop thread waiting for I/O, for asyncio and uvloop
+_IDLE_LEAVES = {("selectors", "select"), ("runners", "run"), ("uvloop", "run")}
+
+APP, LIBRARY, STDLIB = "app", "library", "stdlib"
+
+
+def _module(filename: str) -> str:
+    base = os.path.splitext(os.path.basename(filename))[0]
+    if base == "__init__":
+        return os.path.basename(os.path.dirname(filename))
+    return base
+
+
+def _package(filename: str) -> str:
+    # top-level package below site-packages, eg. starlette
+    for marker in ("site-packages" + os.sep, "dist-packages" + os.sep):
+        _, found, rest = filename.partition(marker)
+        if found:
+            return os.path.splitext(rest.split(os.sep, 1)[0])[0]
+    return _module(filename)
+
+
+class _CodeInfo:
+    __slots__ = ("name", "origin", "package", "idle")
+
+    def __init__(self, code):
+        filename = os.path.abspath(code.co_filename)
+        module = _module(filename)
+        self.name = f"{module}:{code.co_name}"
+        if filename.startswith(_APP_DIR):
+            self.origin = APP
+        elif filename.startswith(_STDLIB_DIR) and "-packages" + os.sep not in filename:
+            self.origin = STDLIB
+        else:
+            self.origin = LIBRARY
+        self.package = _package(filename)
+        self.idle = (module, code.co_name) in _IDLE_LEAVES
+
+
+class StackSampler:
+    """
+    Statistical profiler reading the Python stacks of other threads through
+    sys._current_frames() from a thread of its own, so nothing is instrumented and the
+    sampled threads only pay for the GIL hand-off of each sample.
+
+    Samples are wall clock: a thread blocked on I/O is sampled where it waits. On the
+    event loop thread that is the selector, so everything else there is CPU spent on
+    the loop.
+    """
+
+    def __init__(self):
+        self._codes: Dict[object, _CodeInfo] = {}
+        self.profiling = False
+        self.loop_thread_id: Optional[int] = None
+        self._continuous: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+
+    def _info(self, code) -> _CodeInfo:
+        info = self._codes.get(code)
+        if info is None:
+            info = self._codes[code] = _CodeInfo(code)
+        return info
+
+    def _stack(self, frame) -> List[_CodeInfo]:
+        # innermost first
+        stack = []
+        while frame is not None:
+            stack.append(self._info(frame.f_code))
+            frame = frame.f_back
+        return stack
+
+    def _threads(self, all_threads: bool) -> Optional[Iterable[int]]:
+        if all_threads:
+            return None
+        return (self.loop_thread_id,) if self.loop_thread_id is not None else None
+
+    def sample(self, seconds: float, hz: float, all_threads: bool = False) -> Dict[str, int]:
+        """
+        Collapsed stacks, `thread;outer:function;...;inner:function` to sample count,
+        of the event loop thread or every thread; blocks for `seconds`
+        """
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        own = threading.get_ident()
+        wanted = self._threads(all_threads)
+        stacks: Dict[str, int] = collections.Counter()
+        interval = 1.0 / hz
+        deadline = time.perf_counter() + seconds
+        next_sample = time.perf_counter()
+        while next_sample < deadline:
+            frames = sys._current_frames()
+            for thread_id in wanted if wanted is not None else frames:
+                frame = frames.get(thread_id)
+                if frame is None or thread_id == own:
+                    continue
+                stack = self._stack(frame)
+                thread = names.get(thread_id, str(thread_id)).replace(";", "_").replace(" ", "_")
+                stacks[";".join([thread] + [info.name for info in reversed(stack)])] += 1
+            del frames
+            next_sample += interval
+            time.sleep(max(0.0, next_sample - time.perf_counter()))
+        return stacks
+
+    async def profile(self, seconds: float, hz: float, all_threads: bool = False) -> Optional[Dict[str, int]]:
+        """
+        sample() off the event loop; None while another profile of this worker runs
+        """
+        if self.profiling:
+            return None
+        self.profiling = True
+        try:
+            return await asyncio.to_thread(self.sample, seconds, hz, all_threads)
+        finally:
+            self.profiling = False
+
+    @staticmethod
+    def collapsed(stacks: Dict[str, int]) -> str:
+        """
+        Stacks in the collapsed format of flamegraph.pl, speedscope and inferno
+        """
+        return "".join(f"{stack} {count}\n" for stack, count in sorted(stacks.items()))
+
+    def _attribute(self, stack: List[_CodeInfo]) -> None:
+        if not stack or stack[0].idle:
+            PROFILE_SAMPLES.labels("idle", "self").inc()
+            return
+        # stdlib time, eg. json or uuid, is charged to its caller; library time, eg. pydantic
+        # validating or uvicorn parsing HTTP, to the library
+        innermost = "other"
+        for info in stack:
+            if info.origin != STDLIB:
+                innermost = info.name if info.origin == APP else info.package
+                break
+        PROFILE_SAMPLES.labels(innermost, "self").inc()
+        seen = set()
+        for info in stack:
+            if info.origin == APP and info.name not in seen:
+                seen.add(info.name)
+                PROFILE_SAMPLES.labels(info.name, "total").inc()
+
+    def _run_continuous(self, hz: float) -> None:
+        interval = 1.0 / hz
+        while not self._stopped.wait(interval):
+            if self.loop_thread_id is None:
+                continue
+            frame = sys._current_frames().get(self.loop_thread_id)
+            if frame is not None:
+                self._attribute(self._stack(frame))
+            del frame
+
+    def start(self, hz: float) -> None:
+        """
+        Sample the event loop thread `hz` times a second for good, into ark_profile_samples_total
+        """
+        self.loop_thread_id = threading.get_ident()
+        if hz <= 0 or self._continuous is not None:
+            return
+        self._stopped.clear()
+        self._continuous = threading.Thread(target=self._run_continuous, args=(hz,), name="profiler", daemon=True)
+        self._continuous.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self._continuous = None
@@ -0,0 +1,176 @@
+import logging
+import math
+import os
+import random
+import sqlite3
+import threading
+import time
+from typing import Dict, Optional
+
+from metrics import Counter
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMIT_DECISIONS = Counter("ark_rate_limit_decisions_total", "Rate limit checks by outcome", ["result"])
+
+REQUESTS, TOKENS = "requests", "tokens"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS buckets (
+    key TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    tokens REAL NOT NULL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (key, kind)
+)
+"""
+_UPSERT = (
+    "INSERT INTO buckets (key, kind, tokens, updated) VALUES (?, ?, ?, ?) "
+    "ON CONFLICT (key, kind) DO UPDATE SET tokens = excluded.tokens, updated = excluded.updated"
+)
+
+
+def format_duration(seconds: float) -> str:
+    """
+    Duration in the style of OpenAI's x-ratelimit-reset-* headers, eg. 20ms, 1.5s, 6m0s
+    """
+    if seconds < 1:
+        return f"{int(seconds * 1000)}ms"
+    if seconds < 60:
+        return f"{seconds:.3g}s"
+    minutes, seconds = divmod(int(math.ceil(seconds)), 60)
+    return f"{minutes}m{seconds}s"
+
+
+class RateLimitResult:
+    __slots__ = ("allowed", "kind", "retry_after", "headers")
+
+    def __init__(self, allowed: bool, kind: Optional[str], retry_after: float, headers: Dict[str, str]):
+        self.allowed = allowed
+        self.kind = kind
+        self.retry_after = retry_after
+        self.headers = headers
+
+
+class RateLimiter:
+    """
+    Requests-per-minute and tokens-per-minute token buckets per API key.
+
+    Buckets live in a SQLite database, by default on /dev/shm, so every uvicorn worker
+    of a host charges the same buckets; each check is one short IMMEDIATE transaction.
+    A request is charged one request and its estimated tokens up front, and the token
+    bucket is settled against actual usage when the response is done, which may leave
+    it in debt. Database errors fail open. check() and settle() block on the database and
+    are meant to run off the event loop.
+    """
+
+    def __init__(self, path: str, rpm: int = 0, tpm: int = 0, busy_timeout: float = 0.1):
+        self.path = path
+        self.limits = {REQUESTS: rpm, TOKENS: tpm}
+        self.busy_timeout = busy_timeout
+        self._conn: Optional[sqlite3.Connection] = None
+        self._pid = 0
+        # one connection per worker, its transactions must not interleave across threads
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return any(self.limits.values())
+
+    def _connection(self) -> sqlite3.Connection:
+        # connections must not cross a fork
+        if self._conn is None or self._pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF")
+            conn.execute(_SCHEMA)
+            self._conn, self._pid = conn, os.getpid()
+        return self._conn
+
+    def _refilled(self, kind: str, row, now: float) -> float:
+        capacity = self.limits[kind]
+        if row is None:
+            return float(capacity)
+        tokens, updated = row
+        return min(float(capacity), tokens + (now - updated) * capacity / 60.0)
+
+    def _headers(self, levels: Dict[str, float]) -> Dict[str, str]:
+        headers = {}
+        for kind, level in levels.items():
+            capacity = self.limits[kind]
+            headers[f"x-ratelimit-limit-{kind}"] = str(capacity)
+            headers[f"x-ratelimit-remaining-{kind}"] = str(max(0, int(level)))
+            headers[f"x-ratelimit-reset-{kind}"] = format_duration((capacity - level) * 60.0 / capacity)
+        return headers
+
+    def _transaction(self, key: str, charges: Dict[str, float], admit: bool) -> RateLimitResult:
+        with self._lock:
+            return self._locked_transaction(key, charges, admit)
+
+    def _locked_transaction(self, key: str, charges: Dict[str, float], admit: bool) -> RateLimitResult:
+        conn = self._connection()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = {
+                kind: (tokens, updated)
+                for kind, tokens, updated in conn.execute(
+                    "SELECT kind, tokens, updated FROM buckets WHERE key = ?", (key,)
+                )
+            }
+            levels = {kind: self._refilled(kind, rows.get(kind), now) for kind in charges}
+            for kind, charge in charges.items():
+                # a request larger than the whole bucket only needs a full one
+                needed = min(charge, self.limits[kind])
+                if admit and levels[kind] < needed:
+                    retry_after = (needed - levels[kind]) * 60.0 / self.limits[kind]
+                    conn.execute("COMMIT")
+                    return RateLimitResult(False, kind, retry_after, self._headers(levels))
+            for kind, charge in charges.items():
+                levels[kind] = min(float(self.limits[kind]), levels[kind] - charge)
+                conn.execute(_UPSERT, (key, kind, levels[kind], now))
+            if random.random() < 0.001:
+                # buckets untouched for a while are full again, forget them
+                conn.execute("DELETE FROM buckets WHERE updated < ?", (now - 600,))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return RateLimitResult(True, None, 0.0, self._headers(levels))
+
+    def check(self, key: str, estimated_tokens: int) -> RateLimitResult:
+        """
+        Charge one request and `estimated_tokens` to `key`, unless either bucket is short
+        """
+        charges = {kind: cost for kind, cost in ((REQUESTS, 1), (TOKENS, estimated_tokens)) if self.limits[kind]}
+        try:
+            result = self._transaction(key, charges, admit=True)
+        except sqlite3.Error as e:
+            RATE_LIMIT_DECISIONS.labels("error").inc()
+            logger.warning("rate limit check failed, allowing the request: %s", e)
+            return RateLimitResult(True, None, 0.0, {})
+        RATE_LIMIT_DECISIONS.labels("allowed" if result.allowed else f"rejected_{result.kind}").inc()
+        return result
+
+    def settle(self, key: str, estimated_tokens: int, actual_tokens: Optional[int]) -> None:
+        """
+        Correct the token bucket of `key` by the difference of actual and estimated usage
+        """
+        if actual_tokens is None or not self.limits[TOKENS] or actual_tokens == estimated_tokens:
+            return
+        try:
+            self._transaction(key, {TOKENS: actual_tokens - estimated_tokens}, admit=False)
+        except sqlite3.Error as e:
+            logger.warning("rate limit settlement failed: %s", e)
+
+    @staticmethod
+    def error_body(result: RateLimitResult) -> Dict:
+        unit = "requests per min (RPM)" if result.kind == REQUESTS else "tokens per min (TPM)"
+        return {
+            "error": {
+                "message": f"Rate limit reached for {unit}. Please try again in {format_duration(result.retry_after)}.",
+                "type": result.kind,
+                "param": None,
+                "code": "rate_limit_exceeded",
+            }
+        }
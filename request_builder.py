@@ -0,0 +1,216 @@
+import base64
+import collections.abc
+import threading
+import uuid
+from typing import Any, Dict, List
+
+from pydantic import TypeAdapter
+
+from encode_cache import EncodedValueCache
+from openai_protocol import ChatCompletionRequest, ChatCompletionToolsParam
+from proto import ark_pb2
+from rpc_method import encode_value
+
+# (request field, input key, Value field) of the sampling inputs whose defaults are always sent
+SAMPLING_FIELDS = (
+    ("n", "n", "int64_"),
+    ("temperature", "temperature", "float_"),
+    ("top_p", "top_p", "float_"),
+    ("presence_penalty", "presence_penalty", "float_"),
+    ("frequency_penalty", "frequency_penalty", "float_"),
+)
+
+
+def _field_default(name: str):
+    return ChatCompletionRequest.model_fields[name].get_default(call_default_factory=True)
+
+
+SAMPLING_DEFAULTS = {name: _field_default(name) for name, _, _ in SAMPLING_FIELDS}
+STOP_DEFAULT = _field_default("stop")
+
+tools_adapter = TypeAdapter(List[ChatCompletionToolsParam])
+
+
+def merge_tool_calls(deltas: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Complete `{id, type, function: {name, arguments}}` tool calls from the tool call deltas of
+    a streamed reply: deltas of one `index` are one call whose arguments arrive in pieces,
+    deltas without an index are whole calls
+    """
+    calls: Dict[Any, Dict[str, Any]] = {}
+    for position, delta in enumerate(deltas):
+        key = delta.get("index", ("whole", position))
+        function = delta.get("function") or {}
+        call = calls.get(key)
+        if call is None:
+            call = calls[key] = {
+                "id": delta.get("id", ""),
+                "type": delta.get("type") or "function",
+                "function": {"name": function.get("name") or "", "arguments": ""},
+            }
+        elif not call["id"]:
+            call["id"] = delta.get("id", "")
+        if not call["function"]["name"]:
+            call["function"]["name"] = function.get("name") or ""
+        call["function"]["arguments"] += function.get("arguments") or ""
+    return list(calls.values())
+
+
+class RequestBuilder:
+    """
+    Builds the `InferenceRequest` of a chat completion from a per-model template.
+
+    The default sampling inputs of a model are encoded and serialized once; every
+    request starts as a parse of those bytes and only writes the inputs that differ
+    from the defaults. Plain text messages are collected in one pass and written with
+    a single `extend` per key.
+    """
+
+    def __init__(
+        self,
+        tools_cache: EncodedValueCache,
+        response_format_cache: EncodedValueCache,
+        compat_llmserver_vlm_v1: bool = False,
+        max_templates: int = 64,
+    ):
+        self.tools_cache = tools_cache
+        self.response_format_cache = response_format_cache
+        self.compat_llmserver_vlm_v1 = compat_llmserver_vlm_v1
+        self.max_templates = max_templates
+        self._templates: Dict[str, bytes] = {}
+        self._lock = threading.Lock()
+
+    def template(self, model: str) -> bytes:
+        """
+        Serialized request holding `model` and the default sampling inputs
+        """
+        template = self._templates.get(model)
+        if template is not None:
+            return template
+        request = ark_pb2.InferenceRequest(model_name=model)
+        for name, key, kind in SAMPLING_FIELDS:
+            setattr(request.inputs[key], kind, SAMPLING_DEFAULTS[name])
+        if STOP_DEFAULT is not None:
+            request.inputs["stop"].MergeFrom(encode_value(STOP_DEFAULT))
+        template = request.SerializeToString()
+        with self._lock:
+            # model names come from clients, so never let them grow the cache unbounded
+            if len(self._templates) >= self.max_templates:
+                self._templates.clear()
+            self._templates[model] = template
+        return template
+
+    def encode_messages(self, request: ark_pb2.InferenceRequest, messages) -> None:
+        roles: List[bytes] = []
+        contents: List[bytes] = []
+        for msg in messages:
+            content = msg["content"]
+            if isinstance(content, str):
+                roles.append(msg["role"].encode())
+                contents.append(content.encode())
+            elif isinstance(content, collections.abc.Iterable):
+                if not self.compat_llmserver_vlm_v1:
+                    roles.append(msg["role"].encode())
+                self._encode_parts(request, msg)
+            else:
+                raise Exception("Unknown message.content type")
+        if roles:
+            request.inputs["messages.role"].bytes_list.values.extend(roles)
+        if contents:
+            request.inputs["messages.content"].bytes_list.values.extend(contents)
+
+    def encode_reply(self, message: Dict[str, Any]) -> ark_pb2.InferenceRequest:
+        """
+        Message inputs of an assistant reply as a client resending the history would send
+        it: plain role and content, without reasoning_content. A reply with tool calls is
+        kept whole as a struct, like the messages with content parts, with its streamed
+        tool call deltas merged into complete calls.
+        """
+        request = ark_pb2.InferenceRequest()
+        content = message.get("content") or ""
+        tool_calls = merge_tool_calls(message.get("tool_calls") or [])
+        if not tool_calls:
+            self.encode_messages(request, [{"role": "assistant", "content": content}])
+            return request
+        if not self.compat_llmserver_vlm_v1:
+            request.inputs["messages.role"].bytes_list.values.append(b"assistant")
+        request.inputs["messages"].value_list.values.append(
+            encode_value({"role": "assistant", "content": content, "tool_calls": tool_calls})
+        )
+        return request
+
+    def _encode_parts(self, request: ark_pb2.InferenceRequest, msg) -> None:
+        if self.compat_llmserver_vlm_v1:
+            struct = ark_pb2.Struct()
+            struct.fields["role"].string_ = msg["role"]
+            for entry in msg["content"]:
+                if entry["type"] == "text":
+                    struct.fields["content"].string_ = entry["text"]
+                elif entry["type"] == "image_url":
+                    b64_image = entry["image_url"]["url"].split(",")[-1]
+                    struct.fields["image"].bytes_list.values.extend([base64.b64decode(b64_image)])
+                else:
+                    raise ValueError(f"type {entry['type']} is not supported in content")
+            request.inputs["messages"].value_list.values.append(ark_pb2.Value(struct_=struct))
+            return
+
+        payloads = []
+        for entry in msg["content"]:
+            if entry["type"] == "text":
+                text = ark_pb2.Struct()
+                text.fields["type"].string_ = "text"
+                text.fields["text"].string_ = entry["text"]
+                payloads.append(text)
+            elif entry["type"] == "image_url":
+                image = ark_pb2.Struct()
+                image.fields["type"].string_ = "image_url"
+                image.fields["image_url"].struct_.fields["url"].string_ = entry["image_url"]["url"]
+                image.fields["image_url"].struct_.fields["detail"].string_ = entry["image_url"].get("detail", "high")
+                payloads.append(image)
+            else:
+                raise ValueError(f"type {entry['type']} is not supported in content")
+
+            struct = ark_pb2.Struct()
+            struct.fields["role"].string_ = msg["role"]
+            struct.fields["content"].value_list.values.extend([ark_pb2.Value(struct_=payload) for payload in payloads])
+            request.inputs["messages"].value_list.values.append(ark_pb2.Value(struct_=struct))
+
+    def build(self, args: ChatCompletionRequest) -> ark_pb2.InferenceRequest:
+        request = ark_pb2.InferenceRequest.FromString(self.template(args.model))
+        request.req_id = str(uuid.uuid4())
+        if args.messages is not None:
+            self.encode_messages(request, args.messages)
+
+        for name, key, kind in SAMPLING_FIELDS:
+            value = getattr(args, name)
+            if value is None:
+                del request.inputs[key]
+            elif value != SAMPLING_DEFAULTS[name]:
+                setattr(request.inputs[key], kind, value)
+        if args.stop is None:
+            del request.inputs["stop"]
+        elif args.stop != STOP_DEFAULT:
+            request.inputs["stop"].CopyFrom(encode_value(args.stop))
+
+        if args.max_tokens is not None:
+            request.inputs["max_new_tokens"].int64_ = args.max_tokens
+        if args.logprobs == True:
+            request.inputs["logprobs"].int64_ = args.top_logprobs if args.top_logprobs is not None else 1
+        if args.logit_bias is not None:
+            for key, value in args.logit_bias.items():
+                request.inputs["logit_bias"].int64_dict.fields[int(key)].int64_ = value
+        if args.response_format is not None:
+            self.response_format_cache.copy_into(
+                request.inputs["response_format"],
+                args.response_format.model_dump_json(by_alias=True).encode(),
+                lambda: args.response_format.dict(by_alias=True),
+            )
+        if args.guided_grammar is not None:
+            request.inputs["guided_grammar"].string_ = args.guided_grammar
+        if args.tools is not None:
+            self.tools_cache.copy_into(
+                request.inputs["tools"],
+                tools_adapter.dump_json(args.tools, by_alias=True),
+                lambda: [tool.dict(by_alias=True) for tool in args.tools],
+            )
+        return request
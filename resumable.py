@@ -0,0 +1,447 @@
+import asyncio
+import collections
+import hashlib
+import json
+import logging
+import os
+import secrets
+import sqlite3
+import threading
+import time
+from typing import Any, AsyncIterator, Deque, Dict, List, Optional, Set, Tuple
+
+from metrics import Counter, Gauge
+from stream_writer import IDLE, Item, WorkerBudget
+
+logger = logging.getLogger(__name__)
+
+RESUMABLE_STREAMS = Gauge("ark_resumable_streams", "Resumable streams generated by this worker")
+STREAM_RESUMES = Counter("ark_stream_resumes_total", "Reconnects to resumable streams by outcome", ["result"])
+
+# seconds between reads of the shared event log by readers in other workers
+POLL_SECONDS = 0.05
+
+_SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS streams (
+        req_id TEXT PRIMARY KEY,
+        token TEXT NOT NULL,
+        pid INTEGER NOT NULL,
+        first_id INTEGER NOT NULL,
+        last_id INTEGER NOT NULL,
+        finished INTEGER NOT NULL,
+        attached REAL NOT NULL,
+        expires REAL NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS events (
+        req_id TEXT NOT NULL,
+        id INTEGER NOT NULL,
+        data TEXT NOT NULL,
+        PRIMARY KEY (req_id, id)
+    ) WITHOUT ROWID
+    """,
+)
+
+
+class EventsDropped(Exception):
+    pass
+
+
+class StreamLost(Exception):
+    pass
+
+
+def token_hash(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class ResumableStream:
+    """
+    Numbered SSE events of one streaming request, kept while generation runs on
+    without a client and for a grace period after.
+
+    It takes the place of the StreamBuffer the producer writes to and charges its events
+    to the same worker budget. Generation never waits for a reader; once the events
+    exceed `max_bytes` or the worker budget is spent the oldest are dropped, and a reader
+    that needs one of them gets EventsDropped. Readers in this worker read the events
+    from memory; they are also written in batches to the store's shared event log, from
+    which readers in other workers poll them.
+    """
+
+    def __init__(self, store: "ResumableStreamStore", req_id: str, token: str, max_bytes: int):
+        self.store = store
+        self.req_id = req_id
+        self.token = token
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.first_id = 1
+        self.last_id = 0
+        self.finished = False
+        self.readers = 0
+        self.task: Optional[asyncio.Task] = None
+        self._events: Deque[str] = collections.deque()
+        # one future per waiting reader, so the idle timer of one never wakes the others
+        self._waiters: Set[asyncio.Future] = set()
+        self._expiry: Optional[asyncio.TimerHandle] = None
+        self._unshared: List[Tuple[int, str]] = []
+        self._sharing: Optional[asyncio.Task] = None
+
+    def _notify(self) -> None:
+        for waiter in self._waiters:
+            if not waiter.done():
+                waiter.set_result(True)
+        self._waiters.clear()
+        if self._sharing is None:
+            self._sharing = asyncio.get_running_loop().create_task(self._share())
+
+    async def _share(self) -> None:
+        # one batch write at a time, each holding every event added meanwhile
+        try:
+            while self._unshared or self.finished:
+                events, self._unshared = self._unshared, []
+                finished = self.finished
+                try:
+                    await asyncio.to_thread(self.store.append, self, events, finished)
+                except sqlite3.Error as e:
+                    logger.warning("events of resumable stream %s were not shared: %s", self.req_id, e)
+                if finished and not self._unshared:
+                    return
+        finally:
+            self._sharing = None
+
+    async def _wait(self, idle_timeout: Optional[float]) -> bool:
+        """
+        True once events were added or the stream finished, False when `idle_timeout` passed first
+        """
+        loop = asyncio.get_running_loop()
+        waiter = loop.create_future()
+        self._waiters.add(waiter)
+        timer = None
+        if idle_timeout is not None:
+            # a timer rather than wait_for, which costs a task per wait
+            timer = loop.call_later(idle_timeout, lambda: waiter.done() or waiter.set_result(False))
+        try:
+            return await waiter
+        finally:
+            if timer is not None:
+                timer.cancel()
+            self._waiters.discard(waiter)
+
+    async def put(self, item: Item) -> bool:
+        if self.finished:
+            return True
+        data = item if isinstance(item, str) else json.dumps(item, ensure_ascii=False)
+        budget = self.store.budget
+        self._events.append(data)
+        self.last_id += 1
+        self._unshared.append((self.last_id, data))
+        self.nbytes += len(data)
+        budget.acquire(len(data))
+        while len(self._events) > 1 and (self.nbytes > self.max_bytes or budget.nbytes > budget.max_bytes):
+            size = len(self._events.popleft())
+            self.nbytes -= size
+            budget.release(size)
+            self.first_id += 1
+        self._notify()
+        return True
+
+    def release(self) -> None:
+        """
+        Drop the kept events and return them to the worker budget
+        """
+        self._events.clear()
+        self.first_id = self.last_id + 1
+        self.store.budget.release(self.nbytes)
+        self.nbytes = 0
+
+    def close(self) -> None:
+        if not self.finished:
+            self.finished = True
+            self._notify()
+            if not self.readers:
+                self._schedule_expiry()
+
+    async def events(self, after: int = 0, idle_timeout: Optional[float] = None) -> AsyncIterator[Any]:
+        """
+        (event id, data) of every event after `after`, live until the stream finishes, and
+        IDLE whenever none came within `idle_timeout`
+        """
+        if self._expiry is not None:
+            self._expiry.cancel()
+            self._expiry = None
+        self.readers += 1
+        try:
+            next_id = after + 1
+            while True:
+                if next_id < self.first_id:
+                    raise EventsDropped(f"events after {next_id - 1} are no longer buffered")
+                while next_id <= self.last_id:
+                    yield next_id, self._events[next_id - self.first_id]
+                    next_id += 1
+                    if next_id < self.first_id:
+                        raise EventsDropped(f"events after {next_id - 1} are no longer buffered")
+                if self.finished:
+                    return
+                if not await self._wait(idle_timeout):
+                    yield IDLE
+        finally:
+            self.readers -= 1
+            if not self.readers:
+                self._schedule_expiry()
+
+    def _schedule_expiry(self, delay: Optional[float] = None) -> None:
+        if self._expiry is not None:
+            self._expiry.cancel()
+        delay = self.store.grace_seconds if delay is None else delay
+        self._expiry = asyncio.get_running_loop().call_later(delay, self._check_expiry)
+
+    def _check_expiry(self) -> None:
+        self._expiry = None
+        if self.readers:
+            return
+        task = asyncio.get_running_loop().create_task(self._expire())
+        self.store._tasks.add(task)
+        task.add_done_callback(self.store._tasks.discard)
+
+    async def _expire(self) -> None:
+        # readers in other workers keep the stream alive through the shared log
+        try:
+            attached = await asyncio.to_thread(self.store.attached, self.req_id)
+        except sqlite3.Error:
+            attached = None
+        idle = time.time() - attached if attached is not None else self.store.grace_seconds
+        if self.readers:
+            return
+        if idle < self.store.grace_seconds:
+            self._schedule_expiry(self.store.grace_seconds - idle)
+            return
+        # nobody came back, stop generating
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+        await self.store.remove(self)
+
+
+class ResumableStreamStore:
+    """
+    Resumable streams by request id, shared by the uvicorn workers of a host.
+
+    Generation runs in the worker that took the request and readers there are served
+    from memory. Every event also goes to a SQLite event log, by default on /dev/shm, so
+    a reconnect reaching any worker replays and follows the stream from there, and keeps
+    it alive while attached. Resuming needs the token issued when the stream started.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        grace_seconds: float,
+        max_bytes: int,
+        max_streams: int,
+        budget: WorkerBudget,
+        busy_timeout: float = 5.0,
+    ):
+        self.path = path
+        self.grace_seconds = grace_seconds
+        self.max_bytes = max_bytes
+        self.max_streams = max_streams
+        self.budget = budget
+        self.busy_timeout = busy_timeout
+        self._streams: Dict[str, ResumableStream] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._pid = 0
+        # one connection per worker, its transactions must not interleave across threads
+        self._lock = threading.Lock()
+        RESUMABLE_STREAMS.set_function(lambda: len(self._streams))
+
+    @property
+    def enabled(self) -> bool:
+        return self.grace_seconds > 0
+
+    def _connection(self) -> sqlite3.Connection:
+        # connections must not cross a fork
+        if self._conn is None or self._pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF")
+            for statement in _SCHEMA:
+                conn.execute(statement)
+            self._conn, self._pid = conn, os.getpid()
+        return self._conn
+
+    def _write(self, fn, *args):
+        with self._lock:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = fn(conn, *args)
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return result
+
+    def get(self, req_id: str) -> Optional[ResumableStream]:
+        """
+        The stream `req_id` if this worker generates it
+        """
+        return self._streams.get(req_id)
+
+    async def create(self, req_id: str) -> Optional[ResumableStream]:
+        """
+        A new stream for `req_id`, or None when the id is taken, the host holds too many
+        streams or the buffer budget of this worker is spent
+        """
+        if req_id in self._streams or self.budget.nbytes >= self.budget.max_bytes:
+            return None
+        token = secrets.token_urlsafe(24)
+
+        def insert(conn: sqlite3.Connection) -> bool:
+            now = time.time()
+            # streams of workers that are gone
+            for stale, pid in conn.execute("SELECT req_id, pid FROM streams WHERE expires < ?", (now,)).fetchall():
+                if not _pid_alive(pid):
+                    conn.execute("DELETE FROM streams WHERE req_id = ?", (stale,))
+                    conn.execute("DELETE FROM events WHERE req_id = ?", (stale,))
+            (count,) = conn.execute("SELECT COUNT(*) FROM streams").fetchone()
+            if count >= self.max_streams:
+                return False
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO streams (req_id, token, pid, first_id, last_id, finished, attached, expires)"
+                " VALUES (?, ?, ?, 1, 0, 0, ?, ?)",
+                (req_id, token_hash(token), os.getpid(), now, now + self.grace_seconds),
+            )
+            return cursor.rowcount > 0
+
+        try:
+            created = await asyncio.to_thread(self._write, insert)
+        except sqlite3.Error as e:
+            logger.warning("resumable stream %s was not created: %s", req_id, e)
+            return None
+        if not created or req_id in self._streams:
+            return None
+        stream = self._streams[req_id] = ResumableStream(self, req_id, token, self.max_bytes)
+        return stream
+
+    def append(self, stream: ResumableStream, events: List[Tuple[int, str]], finished: bool) -> None:
+        """
+        Add `events` of `stream` to the shared log and drop those it no longer keeps; blocks
+        """
+
+        def update(conn: sqlite3.Connection) -> None:
+            conn.executemany(
+                "INSERT OR REPLACE INTO events (req_id, id, data) VALUES (?, ?, ?)",
+                [(stream.req_id, event_id, data) for event_id, data in events],
+            )
+            conn.execute("DELETE FROM events WHERE req_id = ? AND id < ?", (stream.req_id, stream.first_id))
+            conn.execute(
+                "UPDATE streams SET first_id = ?, last_id = MAX(last_id, ?), finished = ?, expires = ?"
+                " WHERE req_id = ?",
+                (stream.first_id, events[-1][0] if events else 0, int(finished),
+                 time.time() + self.grace_seconds, stream.req_id),
+            )
+
+        self._write(update)
+
+    def lookup(self, req_id: str) -> Optional[Tuple[str, int]]:
+        """
+        Token hash and generating worker of the stream `req_id`, if any; blocks
+        """
+        with self._lock:
+            return self._connection().execute("SELECT token, pid FROM streams WHERE req_id = ?", (req_id,)).fetchone()
+
+    def attached(self, req_id: str) -> Optional[float]:
+        """
+        When a reader in any worker last read the stream `req_id`; blocks
+        """
+        with self._lock:
+            row = self._connection().execute("SELECT attached FROM streams WHERE req_id = ?", (req_id,)).fetchone()
+        return row[0] if row is not None else None
+
+    def _poll(self, req_id: str, after: int) -> Optional[Tuple[int, int, bool, int, List[Tuple[int, str]]]]:
+        with self._lock:
+            conn = self._connection()
+            # the row first: events written with it are then visible too
+            row = conn.execute(
+                "SELECT first_id, last_id, finished, pid FROM streams WHERE req_id = ?", (req_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            events = conn.execute(
+                "SELECT id, data FROM events WHERE req_id = ? AND id > ? ORDER BY id LIMIT 256", (req_id, after)
+            ).fetchall()
+        first_id, last_id, finished, pid = row
+        return first_id, last_id, bool(finished), pid, events
+
+    def _attach(self, req_id: str) -> None:
+        self._write(
+            lambda conn: conn.execute("UPDATE streams SET attached = ? WHERE req_id = ?", (time.time(), req_id))
+        )
+
+    async def shared_events(self, req_id: str, after: int = 0, idle_timeout: Optional[float] = None):
+        """
+        Like ResumableStream.events, for a stream generated by another worker, read from the
+        shared log
+        """
+        next_id = after + 1
+        idle_since = time.monotonic()
+        attached = 0.0
+        while True:
+            if time.monotonic() - attached >= 1.0:
+                # keeps the generating worker from expiring the stream
+                await asyncio.to_thread(self._attach, req_id)
+                attached = time.monotonic()
+            polled = await asyncio.to_thread(self._poll, req_id, next_id - 1)
+            if polled is None:
+                raise StreamLost("the stream is no longer available")
+            first_id, last_id, finished, pid, events = polled
+            if next_id < first_id:
+                raise EventsDropped(f"events after {next_id - 1} are no longer buffered")
+            for event_id, data in events:
+                yield event_id, data
+                next_id = event_id + 1
+                idle_since = time.monotonic()
+            if events:
+                continue
+            if finished and next_id > last_id:
+                return
+            if not _pid_alive(pid):
+                raise StreamLost("the worker generating the stream is gone")
+            if idle_timeout is not None and time.monotonic() - idle_since >= idle_timeout:
+                idle_since = time.monotonic()
+                yield IDLE
+            await asyncio.sleep(POLL_SECONDS)
+
+    async def remove(self, stream: ResumableStream) -> None:
+        if self._streams.get(stream.req_id) is not stream:
+            return
+        del self._streams[stream.req_id]
+        stream.release()
+
+        def delete(conn: sqlite3.Connection) -> None:
+            conn.execute("DELETE FROM streams WHERE req_id = ?", (stream.req_id,))
+            conn.execute("DELETE FROM events WHERE req_id = ?", (stream.req_id,))
+
+        try:
+            await asyncio.to_thread(self._write, delete)
+        except sqlite3.Error as e:
+            logger.warning("resumable stream %s was not deleted: %s", stream.req_id, e)
+
+
+def parse_last_event_id(header: Optional[str]) -> int:
+    try:
+        return max(0, int(header)) if header else 0
+    except ValueError:
+        return 0
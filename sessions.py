@@ -0,0 +1,196 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Optional, Tuple
+
+from metrics import Counter, Gauge
+from proto import ark_pb2
+
+logger = logging.getLogger(__name__)
+
+# request inputs make_ark_req fills from `messages`
+MESSAGE_KEYS = ("messages.role", "messages.content", "messages")
+
+SESSION_EVENTS = Counter("ark_session_events_total", "Session lookups and lifecycle events", ["event"])
+SESSION_COUNT = Gauge("ark_sessions", "Live sessions of this host as of the last write of this worker")
+SESSION_BYTES = Gauge("ark_session_bytes", "Encoded history bytes of this host as of the last write of this worker")
+
+_SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS sessions (
+        id TEXT PRIMARY KEY,
+        backend TEXT NOT NULL,
+        nbytes INTEGER NOT NULL,
+        expires REAL NOT NULL,
+        history BLOB NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS sessions_expires ON sessions (expires)",
+)
+
+
+class Session:
+    __slots__ = ("session_id", "history", "backend")
+
+    def __init__(self, session_id: str, backend: str, history: Optional[ark_pb2.InferenceRequest] = None):
+        self.session_id = session_id
+        # only the message inputs of an InferenceRequest are kept
+        self.history = history if history is not None else ark_pb2.InferenceRequest()
+        self.backend = backend
+
+    def extend_request(self, request: ark_pb2.InferenceRequest) -> ark_pb2.InferenceRequest:
+        """
+        Prepend the encoded history to the messages of `request`, which holds the new turn
+        only, and return the messages of that turn for a later SessionStore.commit
+        """
+        turn = ark_pb2.InferenceRequest()
+        for key in MESSAGE_KEYS:
+            if key in request.inputs:
+                turn.inputs[key].CopyFrom(request.inputs[key])
+            if key not in self.history.inputs:
+                continue
+            merged = ark_pb2.Value()
+            merged.CopyFrom(self.history.inputs[key])
+            if key in turn.inputs:
+                # repeated fields of the same oneof kind are appended by MergeFrom
+                merged.MergeFrom(turn.inputs[key])
+            request.inputs[key].CopyFrom(merged)
+        return turn
+
+
+class SessionStore:
+    """
+    Encoded conversation histories with an idle TTL, evicted least recently used first
+    past a count or byte budget.
+
+    Clients create a session, then send only the new turn plus `session_id`; the
+    history is prepended to the already encoded request, and the turn and the reply
+    are appended to the history once the response completes.
+
+    Sessions live in a SQLite database, by default on /dev/shm, so every uvicorn worker
+    of a host serves every session. The methods block on the database and are meant to
+    run off the event loop; concurrent turns of one session keep the last committed one.
+    """
+
+    def __init__(self, path: str, max_bytes: int, ttl: float, max_sessions: int, busy_timeout: float = 5.0):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.busy_timeout = busy_timeout
+        self._conn: Optional[sqlite3.Connection] = None
+        self._pid = 0
+        # one connection per worker, its transactions must not interleave across threads
+        self._lock = threading.Lock()
+
+    def _connection(self) -> sqlite3.Connection:
+        # connections must not cross a fork
+        if self._conn is None or self._pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF")
+            for statement in _SCHEMA:
+                conn.execute(statement)
+            self._conn, self._pid = conn, os.getpid()
+        return self._conn
+
+    def _write(self, fn, *args):
+        with self._lock:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = fn(conn, *args)
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return result
+
+    def _evict(self, conn: sqlite3.Connection, now: float) -> None:
+        expired = conn.execute("DELETE FROM sessions WHERE expires < ?", (now,)).rowcount
+        if expired > 0:
+            SESSION_EVENTS.labels("expired").inc(expired)
+        count, total = conn.execute("SELECT COUNT(*), COALESCE(SUM(nbytes), 0) FROM sessions").fetchone()
+        while count and (count > self.max_sessions or total > self.max_bytes):
+            rows = conn.execute("SELECT id, nbytes FROM sessions ORDER BY expires LIMIT 64").fetchall()
+            for session_id, nbytes in rows:
+                if count <= self.max_sessions and total <= self.max_bytes:
+                    break
+                conn.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+                count, total = count - 1, total - nbytes
+                SESSION_EVENTS.labels("evicted").inc()
+        SESSION_COUNT.set(count)
+        SESSION_BYTES.set(total)
+
+    def create(self, backend: str) -> Session:
+        session = Session(f"sess-{uuid.uuid4().hex}", backend)
+
+        def insert(conn: sqlite3.Connection) -> None:
+            now = time.time()
+            conn.execute(
+                "INSERT INTO sessions (id, backend, nbytes, expires, history) VALUES (?, ?, 0, ?, ?)",
+                (session.session_id, backend, now + self.ttl, b""),
+            )
+            self._evict(conn, now)
+
+        self._write(insert)
+        SESSION_EVENTS.labels("created").inc()
+        return session
+
+    def get(self, session_id: str) -> Optional[Session]:
+        def touch(conn: sqlite3.Connection) -> Optional[Tuple[str, bytes]]:
+            now = time.time()
+            row = conn.execute("SELECT backend, expires, history FROM sessions WHERE id = ?", (session_id,)).fetchone()
+            if row is not None and row[1] < now:
+                conn.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+                SESSION_EVENTS.labels("expired").inc()
+                return None
+            if row is not None:
+                conn.execute("UPDATE sessions SET expires = ? WHERE id = ?", (now + self.ttl, session_id))
+                return row[0], row[2]
+            return None
+
+        row = self._write(touch)
+        if row is None:
+            SESSION_EVENTS.labels("miss").inc()
+            return None
+        SESSION_EVENTS.labels("hit").inc()
+        backend, history = row
+        return Session(session_id, backend, ark_pb2.InferenceRequest.FromString(history))
+
+    def delete(self, session_id: str) -> bool:
+        return self._write(lambda conn: conn.execute("DELETE FROM sessions WHERE id = ?", (session_id,)).rowcount) > 0
+
+    def commit(
+        self, session: Session, turn: ark_pb2.InferenceRequest, reply: Optional[ark_pb2.InferenceRequest]
+    ) -> None:
+        """
+        Append the messages of `turn` and of the assistant `reply` to the session history,
+        and store the backend the session is pinned to
+        """
+        history = ark_pb2.InferenceRequest()
+        history.CopyFrom(session.history)
+        for message in (turn, reply) if reply is not None else (turn,):
+            for key in MESSAGE_KEYS:
+                if key in message.inputs:
+                    history.inputs[key].MergeFrom(message.inputs[key])
+        data = history.SerializeToString()
+
+        def update(conn: sqlite3.Connection) -> None:
+            now = time.time()
+            conn.execute(
+                "UPDATE sessions SET backend = ?, nbytes = ?, expires = ?, history = ? WHERE id = ?",
+                (session.backend, len(data), now + self.ttl, data, session.session_id),
+            )
+            # a session deleted or evicted meanwhile stays gone
+            self._evict(conn, now)
+
+        try:
+            self._write(update)
+        except sqlite3.Error as e:
+            logger.warning("session %s was not saved: %s", session.session_id, e)
+            return
+        session.history = history
@@ -0,0 +1,209 @@
+import asyncio
+import collections
+import json
+from typing import Any, Deque, Dict, Optional, Tuple, Union
+
+from metrics import Counter, Gauge
+
+STREAM_BUFFERED_BYTES = Gauge("ark_stream_buffered_bytes", "Bytes of SSE chunks buffered for clients in this worker")
+STREAM_BUFFERED_STREAMS = Gauge("ark_stream_buffers", "Open stream buffers in this worker")
+SLOW_CLIENT_ACTIONS = Counter(
+    "ark_stream_slow_client_total", "Times a full stream buffer applied the slow client policy", ["action"]
+)
+
+SLOW_CLIENT_POLICIES = ("block", "coalesce", "disconnect")
+
+# JSON envelope of one chunk besides its delta text, used for size estimates
+CHUNK_OVERHEAD_BYTES = 256
+
+Item = Union[Dict[str, Any], str]
+
+# what a read of a stream gives back when nothing arrived within its idle timeout
+IDLE = object()
+
+
+def estimate_size(item: Item) -> int:
+    if isinstance(item, str):
+        return len(item)
+    size = CHUNK_OVERHEAD_BYTES
+    for choice in item.get("choices", ()):
+        delta = choice.get("delta", {})
+        size += len(delta.get("content") or "") + len(delta.get("reasoning_content") or "")
+    return size
+
+
+class WorkerBudget:
+    """
+    Bytes buffered by every stream of this worker; releasing wakes all blocked producers.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._released: Optional[asyncio.Event] = None
+        STREAM_BUFFERED_BYTES.set_function(lambda: self.nbytes)
+
+    def acquire(self, size: int) -> None:
+        self.nbytes += size
+
+    def release(self, size: int) -> None:
+        self.nbytes -= size
+        if self._released is not None:
+            self._released.set()
+            self._released = None
+
+    async def wait_for_release(self) -> None:
+        if self._released is None:
+            self._released = asyncio.Event()
+        await self._released.wait()
+
+
+class StreamBuffer:
+    """
+    Bounded queue of chunks between the task reading the backend stream and the HTTP
+    writer, so a slow reader cannot make the proxy buffer without limit.
+
+    When a put would exceed the per-stream or per-worker cap, `policy` decides:
+      * block: the producer waits, stops reading the gRPC stream and lets HTTP/2
+        flow control push back on the backend
+      * coalesce: merge the chunk into the last pending one of the same choice,
+        saving the per-chunk envelope, and block if that is not possible
+      * disconnect: drop what is pending and end the stream with an error event
+    Items are chunk dicts, or already serialized event data strings. With `idle_timeout`,
+    iterating yields IDLE whenever the producer stays silent that long.
+    """
+
+    _END = object()
+
+    def __init__(
+        self, budget: WorkerBudget, max_bytes: int, policy: str = "block", idle_timeout: Optional[float] = None
+    ):
+        if policy not in SLOW_CLIENT_POLICIES:
+            raise ValueError(f"slow client policy {policy} is not one of {SLOW_CLIENT_POLICIES}")
+        self.budget = budget
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.idle_timeout = idle_timeout
+        self.nbytes = 0
+        self.aborted = False
+        self._items: Deque[Tuple[Any, int]] = collections.deque()
+        self._closed = False
+        self._ready = asyncio.Event()
+        STREAM_BUFFERED_STREAMS.inc()
+
+    def _full(self, size: int) -> bool:
+        # an empty buffer always admits one item, however large
+        if not self._items:
+            return False
+        return self.nbytes + size > self.max_bytes or self.budget.nbytes + size > self.budget.max_bytes
+
+    def _coalesce(self, item: Item) -> bool:
+        if not self._items or isinstance(item, str):
+            return False
+        last, last_size = self._items[-1]
+        if isinstance(last, str) or len(last["choices"]) != 1 or len(item["choices"]) != 1:
+            return False
+        last_choice, choice = last["choices"][0], item["choices"][0]
+        if last_choice["index"] != choice["index"] or last_choice["finish_reason"]:
+            return False
+        # merging saves the envelope of the new chunk but still has to fit its text
+        grown = estimate_size(item) - CHUNK_OVERHEAD_BYTES
+        if self.nbytes + grown > self.max_bytes or self.budget.nbytes + grown > self.budget.max_bytes:
+            return False
+        last_delta, delta = last_choice["delta"], choice["delta"]
+        last_delta["content"] += delta["content"]
+        last_delta["reasoning_content"] += delta["reasoning_content"]
+        last_delta["tool_calls"] = last_delta["tool_calls"] + delta["tool_calls"]
+        last_choice["finish_reason"] = choice["finish_reason"]
+        last["usage"] = item["usage"]
+        self._items[-1] = (last, last_size + grown)
+        self.nbytes += grown
+        self.budget.acquire(grown)
+        return True
+
+    async def put(self, item: Item) -> bool:
+        """
+        Queue `item`, returning False once the stream was aborted by the disconnect policy
+        """
+        if self.aborted or self._closed:
+            return not self.aborted
+        size = estimate_size(item)
+        while self._full(size):
+            if self.policy == "disconnect":
+                SLOW_CLIENT_ACTIONS.labels("disconnect").inc()
+                self.abort(json.dumps({"error": "client is reading too slowly"}))
+                return False
+            if self.policy == "coalesce" and self._coalesce(item):
+                SLOW_CLIENT_ACTIONS.labels("coalesce").inc()
+                return True
+            SLOW_CLIENT_ACTIONS.labels("block").inc()
+            await self.budget.wait_for_release()
+            if self.aborted or self._closed:
+                return not self.aborted
+        self._items.append((item, size))
+        self.nbytes += size
+        self.budget.acquire(size)
+        self._ready.set()
+        return True
+
+    def abort(self, data: str) -> None:
+        """
+        Drop pending chunks and end the stream with the event `data`
+        """
+        self._drop_pending()
+        self.aborted = True
+        self._items.append((data, 0))
+        self.close()
+
+    def close(self) -> None:
+        if not self._closed:
+            self._closed = True
+            self._items.append((self._END, 0))
+            self._ready.set()
+
+    def _drop_pending(self) -> None:
+        dropped = self.nbytes
+        self._items.clear()
+        self.nbytes = 0
+        self.budget.release(dropped)
+
+    async def get(self, idle_timeout: Optional[float] = None) -> Any:
+        """
+        Next item, StreamBuffer._END after close, or IDLE when none came within `idle_timeout`
+        """
+        while not self._items:
+            self._ready.clear()
+            if idle_timeout is None:
+                await self._ready.wait()
+                continue
+            # a timer rather than wait_for, which costs a task per chunk
+            timer = asyncio.get_running_loop().call_later(idle_timeout, self._ready.set)
+            try:
+                await self._ready.wait()
+            finally:
+                timer.cancel()
+            if not self._items:
+                return IDLE
+        item, size = self._items.popleft()
+        if size:
+            self.nbytes -= size
+            self.budget.release(size)
+        return item
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> Item:
+        item = await self.get(self.idle_timeout)
+        if item is self._END:
+            raise StopAsyncIteration
+        return item
+
+    def release(self) -> None:
+        """
+        Return what is still buffered to the worker budget; call once the writer is done
+        """
+        self._drop_pending()
+        if not self._closed:
+            self._closed = True
+        STREAM_BUFFERED_STREAMS.dec()
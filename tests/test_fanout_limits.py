@@ -0,0 +1,97 @@
+"""
+Fanout together with the fair queue and the rate limiter, against fake_backend.py
+"""
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import httpx
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture(scope="module")
+def proxy(tmp_path_factory):
+    backend_port, proxy_port = free_port(), free_port()
+    backend = subprocess.Popen(
+        [sys.executable, "fake_backend.py", "--host", "127.0.0.1", "--port", str(backend_port), "--ttft", "0.01",
+         "--itl", "0.001", "--tokens", "4"],
+        cwd=ROOT,
+    )
+    env = {
+        **os.environ,
+        # two targets on one fake backend, so requests fan out
+        "http_forward_grpc_host_list": "127.0.0.1,localhost",
+        "http_forward_grpc_port": str(backend_port),
+        "http_forward_grpc_target_suffix": "",
+        "http_forward_fanout_min_n": "2",
+        "http_forward_fair_queue_slots": "4",
+        "http_forward_rate_limit_rpm": "1000",
+        "http_forward_rate_limit_tpm": "1000000",
+        "http_forward_rate_limit_db": str(tmp_path_factory.mktemp("rate") / "rate.sqlite"),
+        "http_forward_session_db": str(tmp_path_factory.mktemp("sessions") / "sessions.sqlite"),
+        "http_forward_prewarm_lock": "",
+        "http_forward_prewarm_state": "",
+    }
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "openai_api_server:app", "--host", "127.0.0.1", "--port", str(proxy_port)],
+        cwd=ROOT,
+        env=env,
+    )
+    url = f"http://127.0.0.1:{proxy_port}"
+    try:
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                if httpx.get(url + "/ready").status_code == 200:
+                    break
+            except httpx.HTTPError:
+                pass
+            if time.monotonic() > deadline:
+                pytest.fail("the proxy did not get ready")
+            time.sleep(0.2)
+        yield url
+    finally:
+        server.terminate()
+        backend.terminate()
+        server.wait()
+        backend.wait()
+
+
+def metric(url: str, prefix: str) -> float:
+    lines = httpx.get(url + "/metrics").text.splitlines()
+    return sum(float(line.rsplit(" ", 1)[1]) for line in lines if line.startswith(prefix))
+
+
+BODY = {"model": "m", "messages": [{"role": "user", "content": "hi"}], "max_tokens": 4, "n": 4}
+
+
+def test_non_streaming_fanout(proxy):
+    response = httpx.post(proxy + "/v1/chat/completions", json=BODY, timeout=30)
+    assert response.status_code == 200, response.text
+    assert [choice["index"] for choice in response.json()["choices"]] == [0, 1, 2, 3]
+    assert "x-ratelimit-remaining-requests" in response.headers
+    assert metric(proxy, "ark_fair_queue_inflight") == 0
+
+
+def test_streaming_fanout(proxy):
+    body = {**BODY, "stream": True, "stream_options": {"include_usage": True}}
+    response = httpx.post(proxy + "/v1/chat/completions", json=body, timeout=30)
+    assert response.status_code == 200
+    events = [line[len("data: "):] for line in response.text.splitlines() if line.startswith("data: ")]
+    assert events[-1] == "[DONE]"
+    chunks = [json.loads(event) for event in events[:-1]]
+    assert not any("error" in chunk for chunk in chunks)
+    assert {choice["index"] for chunk in chunks for choice in chunk["choices"]} == {0, 1, 2, 3}
+    assert chunks[-1]["usage"]["completion_tokens"] == 16
+    assert metric(proxy, "ark_fair_queue_inflight") == 0
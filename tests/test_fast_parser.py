@@ -0,0 +1,52 @@
+import json
+
+import pytest
+from fastapi import FastAPI, Request
+from fastapi.testclient import TestClient
+
+import fast_parser
+
+VALID = {"model": "m", "messages": [{"role": "user", "content": "hi"}]}
+
+
+@pytest.fixture(params=["orjson", "json"])
+def client(request, monkeypatch):
+    if request.param == "json":
+        monkeypatch.setattr(fast_parser, "_loads", json.loads)
+    elif fast_parser._loads is json.loads:
+        pytest.skip("orjson is not installed")
+    app = FastAPI()
+
+    @app.post("/v1/chat/completions")
+    async def create(raw_request: Request):
+        request = fast_parser.parse_chat_completion_request(await raw_request.body())
+        return {"model": request.model, "messages": len(request.messages)}
+
+    return TestClient(app)
+
+
+def post(client, body: bytes):
+    return client.post("/v1/chat/completions", content=body, headers={"content-type": "application/json"})
+
+
+def test_parses_simple_request(client):
+    response = post(client, json.dumps(VALID).encode())
+    assert response.status_code == 200
+    assert response.json() == {"model": "m", "messages": 1}
+
+
+def test_invalid_json_is_422(client):
+    response = post(client, b'{"model": ')
+    assert response.status_code == 422
+    assert response.json()["detail"][0]["type"] == "json_invalid"
+
+
+def test_invalid_utf8_is_422(client):
+    response = post(client, b'{"model": "m", "messages": [{"role": "user", "content": "\xff"}]}')
+    assert response.status_code == 422
+    assert response.json()["detail"][0]["type"] == "json_invalid"
+
+
+def test_non_object_body_is_422(client):
+    response = post(client, b"[]")
+    assert response.status_code == 422
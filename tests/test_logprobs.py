@@ -0,0 +1,34 @@
+import json
+
+from logprobs import LOGPROBS, TOKEN_IDS, TOKENS, TOP_LOGPROBS, TOP_TOKEN_IDS, LogprobsEncoder, TokenTable
+from proto import ark_pb2
+
+
+def make_outputs(token_ids, tokens=None):
+    response = ark_pb2.InferenceResponse()
+    response.outputs[TOKEN_IDS].int64_list.values.extend(token_ids)
+    response.outputs[LOGPROBS].float_list.values.extend(-0.5 for _ in token_ids)
+    response.outputs[TOP_TOKEN_IDS].int64_list.values.extend([])
+    response.outputs[TOP_LOGPROBS].float_list.values.extend([])
+    if tokens is not None:
+        response.outputs[TOKENS].bytes_list.values.extend(tokens)
+    return response.outputs
+
+
+def tokens_of(entries):
+    return [(entry["token"], entry["bytes"]) for entry in map(json.loads, entries)]
+
+
+def test_backend_token_wins_over_cached_entry():
+    encoder = LogprobsEncoder(TokenTable())
+    assert tokens_of(encoder.encode(make_outputs([7]), "m")) == [("token_id:7", None)]
+    assert tokens_of(encoder.encode(make_outputs([7], [b"a"]), "m")) == [("a", [97])]
+    assert tokens_of(encoder.encode(make_outputs([7], [b"b"]), "m")) == [("b", [98])]
+
+
+def test_models_do_not_share_entries():
+    encoder = LogprobsEncoder(TokenTable())
+    assert tokens_of(encoder.encode(make_outputs([7], [b"a"]), "m1")) == [("a", [97])]
+    assert tokens_of(encoder.encode(make_outputs([7], [b"b"]), "m2")) == [("b", [98])]
+    assert tokens_of(encoder.encode(make_outputs([7, 7], [b"a", b"a"]), "m1")) == [("a", [97]), ("a", [97])]
+    assert encoder.table.misses == 2
@@ -0,0 +1,41 @@
+from encode_cache import EncodedValueCache
+from request_builder import RequestBuilder, merge_tool_calls
+from rpc_method import decode_value
+
+
+def make_builder() -> RequestBuilder:
+    return RequestBuilder(EncodedValueCache("tools", 0), EncodedValueCache("response_format", 0))
+
+
+def test_merge_tool_calls_joins_deltas_by_index():
+    deltas = [
+        {"index": 0, "id": "call-1", "type": "function", "function": {"name": "get_weather", "arguments": '{"city"'}},
+        {"index": 1, "id": "call-2", "type": "function", "function": {"name": "get_time", "arguments": "{}"}},
+        {"index": 0, "function": {"arguments": ': "Paris"}'}},
+    ]
+    assert merge_tool_calls(deltas) == [
+        {"id": "call-1", "type": "function", "function": {"name": "get_weather", "arguments": '{"city": "Paris"}'}},
+        {"id": "call-2", "type": "function", "function": {"name": "get_time", "arguments": "{}"}},
+    ]
+
+
+def test_reply_with_reasoning_is_plain_text():
+    reply = make_builder().encode_reply({"content": "Hi", "reasoning_content": "think", "tool_calls": []})
+    assert list(reply.inputs["messages.role"].bytes_list.values) == [b"assistant"]
+    assert list(reply.inputs["messages.content"].bytes_list.values) == [b"Hi"]
+    assert "messages" not in reply.inputs
+
+
+def test_reply_with_tool_calls_keeps_merged_calls():
+    deltas = [
+        {"index": 0, "id": "call-1", "type": "function", "function": {"name": "f", "arguments": "{"}},
+        {"index": 0, "function": {"arguments": "}"}},
+    ]
+    reply = make_builder().encode_reply({"content": "", "tool_calls": deltas})
+    assert list(reply.inputs["messages.role"].bytes_list.values) == [b"assistant"]
+    (message,) = reply.inputs["messages"].value_list.values
+    assert decode_value(message) == {
+        "role": "assistant",
+        "content": "",
+        "tool_calls": [{"id": "call-1", "type": "function", "function": {"name": "f", "arguments": "{}"}}],
+    }
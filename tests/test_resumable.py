@@ -0,0 +1,54 @@
+import asyncio
+
+import pytest
+
+from resumable import EventsDropped, ResumableStreamStore, token_hash
+from stream_writer import WorkerBudget
+
+
+def make_store(path, max_bytes=1 << 20) -> ResumableStreamStore:
+    return ResumableStreamStore(str(path), 5.0, max_bytes, 10, WorkerBudget(1 << 20))
+
+
+async def collect(events):
+    return [event async for event in events]
+
+
+def test_other_worker_follows_stream_from_shared_log(tmp_path):
+    async def run():
+        owner, other = make_store(tmp_path / "r.sqlite"), make_store(tmp_path / "r.sqlite")
+        stream = await owner.create("req-1")
+        assert await owner.create("req-1") is None
+        assert await other.create("req-1") is None
+
+        async def produce():
+            for n in range(5):
+                await stream.put(f"event {n}")
+                await asyncio.sleep(0.01)
+            stream.close()
+
+        producer = asyncio.create_task(produce())
+        events = await collect(other.shared_events("req-1", after=2))
+        await producer
+        assert events == [(3, "event 2"), (4, "event 3"), (5, "event 4")]
+        token, _ = await asyncio.to_thread(other.lookup, "req-1")
+        assert token == token_hash(stream.token) != token_hash("guess")
+        await owner.remove(stream)
+        assert await asyncio.to_thread(other.lookup, "req-1") is None
+
+    asyncio.run(run())
+
+
+def test_shared_log_drops_events_past_max_bytes(tmp_path):
+    async def run():
+        owner, other = make_store(tmp_path / "r.sqlite", 16), make_store(tmp_path / "r.sqlite")
+        stream = await owner.create("req-1")
+        for n in range(4):
+            await stream.put(f"event {n}")
+        stream.close()
+        with pytest.raises(EventsDropped):
+            await collect(other.shared_events("req-1"))
+        assert await collect(other.shared_events("req-1", after=2)) == [(3, "event 2"), (4, "event 3")]
+        await owner.remove(stream)
+
+    asyncio.run(run())
@@ -0,0 +1,286 @@
+import json
+import logging
+import queue
+import random
+import threading
+import time
+import urllib.request
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+def _new_id(nbytes: int) -> str:
+    return "%0*x" % (nbytes * 2, random.getrandbits(nbytes * 8))
+
+
+def parse_traceparent(header: Optional[str]) -> Optional[Tuple[str, str, bool]]:
+    """
+    Parse a W3C `traceparent` header into (trace_id, parent_span_id, sampled)
+    """
+    if not header:
+        return None
+    parts = header.strip().split("-")
+    if len(parts) < 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    try:
+        flags = int(parts[3][:2], 16)
+        int(parts[1], 16), int(parts[2], 16)
+    except ValueError:
+        return None
+    return parts[1], parts[2], bool(flags & 0x01)
+
+
+class Trace:
+    """
+    Timing spans of one chat completion request.
+
+    Spans are recorded as (name, start_ns, end_ns) on the perf_counter clock, so
+    recording is cheap enough to do for every request; only sampled traces are
+    handed to the exporter.
+    """
+
+    __slots__ = (
+        "trace_id",
+        "span_id",
+        "parent_span_id",
+        "sampled",
+        "start_ns",
+        "wall_start_ns",
+        "end_ns",
+        "spans",
+        "first_token_ns",
+        "last_token_ns",
+        "attributes",
+        "_exporter",
+    )
+
+    def __init__(
+        self,
+        trace_id: str,
+        parent_span_id: str = "",
+        sampled: bool = False,
+        start_ns: Optional[int] = None,
+        exporter: Optional["TraceExporter"] = None,
+    ):
+        now_ns = time.perf_counter_ns()
+        self.trace_id = trace_id
+        self.span_id = _new_id(8)
+        self.parent_span_id = parent_span_id
+        self.sampled = sampled
+        self.start_ns = start_ns if start_ns is not None else now_ns
+        self.wall_start_ns = time.time_ns() - (now_ns - self.start_ns)
+        self.end_ns: Optional[int] = None
+        self.spans: List[Tuple[str, int, int]] = []
+        self.first_token_ns: Optional[int] = None
+        self.last_token_ns: Optional[int] = None
+        self.attributes: Dict[str, Any] = {}
+        self._exporter = exporter
+
+    def add_span(self, name: str, start_ns: int, end_ns: int) -> None:
+        self.spans.append((name, start_ns, end_ns))
+
+    @contextmanager
+    def span(self, name: str):
+        start_ns = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            self.spans.append((name, start_ns, time.perf_counter_ns()))
+
+    def token(self, call_start_ns: int) -> None:
+        """
+        Mark the arrival of a backend response; the first one closes the `queue` span
+        """
+        now_ns = time.perf_counter_ns()
+        if self.first_token_ns is None:
+            self.first_token_ns = now_ns
+            self.spans.append(("queue", call_start_ns, now_ns))
+        self.last_token_ns = now_ns
+
+    def traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self.sampled else '00'}"
+
+    def grpc_metadata(self, req_id: str) -> Tuple[Tuple[str, str], ...]:
+        return (("x-request-id", req_id), ("traceparent", self.traceparent()))
+
+    def finish(self, **attributes: Any) -> None:
+        if self.end_ns is not None:
+            return
+        self.end_ns = time.perf_counter_ns()
+        if self.first_token_ns is not None:
+            self.spans.append(("stream", self.first_token_ns, self.last_token_ns))
+        self.attributes.update(attributes)
+        if self.sampled and self._exporter is not None:
+            self._exporter.submit(self)
+
+    def server_timing(self) -> str:
+        end_ns = self.end_ns if self.end_ns is not None else time.perf_counter_ns()
+        entries = [f"{name};dur={(end - start) / 1e6:.3f}" for name, start, end in self.spans]
+        entries.append(f"total;dur={(end_ns - self.start_ns) / 1e6:.3f}")
+        return ", ".join(entries)
+
+    def _wall(self, perf_ns: int) -> int:
+        return self.wall_start_ns + (perf_ns - self.start_ns)
+
+    def to_dict(self) -> Dict[str, Any]:
+        end_ns = self.end_ns if self.end_ns is not None else time.perf_counter_ns()
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_span_id": self.parent_span_id,
+            "start_unix_ns": self.wall_start_ns,
+            "duration_ms": (end_ns - self.start_ns) / 1e6,
+            "first_token_unix_ns": self._wall(self.first_token_ns) if self.first_token_ns is not None else None,
+            "last_token_unix_ns": self._wall(self.last_token_ns) if self.last_token_ns is not None else None,
+            "spans": [
+                {"name": name, "start_unix_ns": self._wall(start), "duration_ms": (end - start) / 1e6}
+                for name, start, end in self.spans
+            ],
+            "attributes": self.attributes,
+        }
+
+    def to_otlp_spans(self) -> List[Dict[str, Any]]:
+        def attrs(values: Dict[str, Any]) -> List[Dict[str, Any]]:
+            out = []
+            for key, value in values.items():
+                if isinstance(value, bool):
+                    out.append({"key": key, "value": {"boolValue": value}})
+                elif isinstance(value, int):
+                    out.append({"key": key, "value": {"intValue": str(value)}})
+                elif isinstance(value, float):
+                    out.append({"key": key, "value": {"doubleValue": value}})
+                else:
+                    out.append({"key": key, "value": {"stringValue": str(value)}})
+            return out
+
+        end_ns = self.end_ns if self.end_ns is not None else time.perf_counter_ns()
+        root_attrs = dict(self.attributes)
+        if self.first_token_ns is not None:
+            root_attrs["first_token_unix_ns"] = self._wall(self.first_token_ns)
+            root_attrs["last_token_unix_ns"] = self._wall(self.last_token_ns)
+        root = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": "chat.completion",
+            "kind": 2,  # SPAN_KIND_SERVER
+            "startTimeUnixNano": str(self.wall_start_ns),
+            "endTimeUnixNano": str(self._wall(end_ns)),
+            "attributes": attrs(root_attrs),
+        }
+        if self.parent_span_id:
+            root["parentSpanId"] = self.parent_span_id
+        children = [
+            {
+                "traceId": self.trace_id,
+                "spanId": _new_id(8),
+                "parentSpanId": self.span_id,
+                "name": name,
+                "kind": 1,  # SPAN_KIND_INTERNAL
+                "startTimeUnixNano": str(self._wall(start)),
+                "endTimeUnixNano": str(self._wall(end)),
+            }
+            for name, start, end in self.spans
+        ]
+        return [root] + children
+
+
+class TraceExporter:
+    """
+    Ships sampled traces from a daemon thread so the event loop never blocks on IO.
+
+    Traces are appended as JSON lines to `path` and/or posted as OTLP/HTTP JSON to
+    `otlp_endpoint`. When the queue is full new traces are dropped.
+    """
+
+    def __init__(self, path: str = "", otlp_endpoint: str = "", max_queue: int = 4096, batch_size: int = 64):
+        self.path = path
+        self.otlp_endpoint = otlp_endpoint
+        self.batch_size = batch_size
+        self.dropped = 0
+        self._queue: "queue.Queue[Trace]" = queue.Queue(maxsize=max_queue)
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def submit(self, trace: Trace) -> None:
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="trace-exporter", daemon=True)
+                    self._thread.start()
+        try:
+            self._queue.put_nowait(trace)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.export(batch)
+            except Exception as e:
+                logger.warning("trace export failed: %s", e)
+
+    def export(self, batch: List[Trace]) -> None:
+        if self.path:
+            with open(self.path, "a", encoding="utf-8") as f:
+                for trace in batch:
+                    f.write(json.dumps(trace.to_dict(), ensure_ascii=False) + "\n")
+        if self.otlp_endpoint:
+            payload = {
+                "resourceSpans": [
+                    {
+                        "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": "ark-http-proxy"}}]},
+                        "scopeSpans": [
+                            {
+                                "scope": {"name": "ark-http-proxy"},
+                                "spans": [span for trace in batch for span in trace.to_otlp_spans()],
+                            }
+                        ],
+                    }
+                ]
+            }
+            req = urllib.request.Request(
+                self.otlp_endpoint,
+                data=json.dumps(payload).encode(),
+                headers={"Content-Type": "application/json"},
+                method="POST",
+            )
+            with urllib.request.urlopen(req, timeout=5) as resp:
+                resp.read()
+
+
+class Tracer:
+    def __init__(self, sample_rate: float = 0.0, exporter: Optional[TraceExporter] = None):
+        self.sample_rate = sample_rate if exporter is not None else 0.0
+        self.exporter = exporter
+
+    def start(self, traceparent: Optional[str] = None, start_ns: Optional[int] = None) -> Trace:
+        parent = parse_traceparent(traceparent)
+        if parent is not None:
+            trace_id, parent_span_id, parent_sampled = parent
+        else:
+            trace_id, parent_span_id, parent_sampled = _new_id(16), "", False
+        sampled = self.sample_rate > 0.0 and (parent_sampled or random.random() < self.sample_rate)
+        return Trace(trace_id, parent_span_id, sampled, start_ns, self.exporter)
+
+
+class TraceStartMiddleware:
+    """
+    Pure ASGI middleware stamping the arrival time of each HTTP request, so the time
+    spent reading and validating the body before the handler runs can be attributed.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            scope.setdefault("state", {})["trace_start_ns"] = time.perf_counter_ns()
+        await self.app(scope, receive, send)
@@ -0,0 +1,139 @@
+import asyncio
+import inspect
+import logging
+import os
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple, Union
+
+from metrics import Gauge
+from proto import ark_pb2
+from rpc_method import encode_value
+
+logger = logging.getLogger(__name__)
+
+STARTUP_SECONDS = Gauge(
+    "ark_startup_seconds",
+    "Seconds of each startup phase of this worker: import is process start until the app is imported, "
+    "ready is process start until warm-up finished",
+    ["phase"],
+)
+READY = Gauge("ark_ready", "1 once this worker finished warming up")
+
+Step = Callable[[], Union[None, Awaitable[None]]]
+
+
+def process_uptime() -> Optional[float]:
+    """
+    Seconds since this process started, from /proc; None where that is not available
+    """
+    try:
+        with open("/proc/self/stat") as f:
+            # the command name may contain spaces, the fields after it do not
+            fields = f.read().rsplit(")", 1)[1].split()
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return max(0.0, uptime - int(fields[19]) / os.sysconf("SC_CLK_TCK"))
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def record_import() -> None:
+    uptime = process_uptime()
+    if uptime is not None:
+        STARTUP_SECONDS.labels("import").set(uptime)
+
+
+def synthetic_request(model: str) -> Dict[str, Any]:
+    """
+    Chat completion body touching the text, multimodal and tool paths of parsing and encoding
+    """
+    return {
+        "model": model,
+        "messages": [
+            {"role": "system", "content": "You are a helpful assistant."},
+            {"role": "user", "content": "warm-up"},
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": "warm-up"},
+                    {"type": "image_url", "image_url": {"url": "data:image/png;base64,iVBORw0KGgo="}},
+                ],
+            },
+        ],
+        "tools": [
+            {
+                "type": "function",
+                "function": {
+                    "name": "warm_up",
+                    "description": "warm-up",
+                    "parameters": {"type": "object", "properties": {"value": {"type": "string"}}},
+                },
+            }
+        ],
+        "max_tokens": 1,
+        "temperature": 0.5,
+        "stop": ["</s>"],
+        "stream": True,
+        "stream_options": {"include_usage": True},
+    }
+
+
+def synthetic_response() -> ark_pb2.InferenceResponse:
+    response = ark_pb2.InferenceResponse()
+    response.outputs["choice"].MergeFrom(
+        encode_value({"message": {"role": "assistant", "content": "warm-up", "reasoning_content": ""}})
+    )
+    response.outputs["choice.index"].int64_ = 0
+    response.outputs["choice.finish_reason"].bytes_ = b"stop"
+    usage = response.outputs["usage"].struct_
+    usage.fields["prompt_tokens"].int64_ = 1
+    usage.fields["completion_tokens"].int64_ = 1
+    usage.fields["completion_tokens_details"].struct_.fields["reasoning_tokens"].int64_ = 0
+    return response
+
+
+class Warmup:
+    """
+    Named startup steps run once before the worker takes traffic, each timed into
+    ark_startup_seconds. A failing or slow step is logged and skipped, so warm-up never
+    keeps a worker from starting; it only makes the first requests cheaper.
+    """
+
+    def __init__(self, enabled: bool = True, timeout: float = 30.0):
+        self.enabled = enabled
+        self.timeout = timeout
+        self.ready = False
+        self.results: Dict[str, str] = {}
+        self.seconds: Dict[str, float] = {}
+        self._steps: List[Tuple[str, Step]] = []
+
+    def step(self, name: str) -> Callable[[Step], Step]:
+        def register(fn: Step) -> Step:
+            self._steps.append((name, fn))
+            return fn
+
+        return register
+
+    async def run(self) -> None:
+        deadline = time.perf_counter() + self.timeout
+        for name, fn in self._steps if self.enabled else ():
+            start = time.perf_counter()
+            try:
+                result = fn()
+                if inspect.isawaitable(result):
+                    await asyncio.wait_for(result, max(0.0, deadline - start))
+                self.results[name] = "ok"
+            except asyncio.TimeoutError:
+                self.results[name] = "timeout"
+                logger.warning("warm-up step %s timed out", name)
+            except Exception as e:
+                self.results[name] = f"error: {e}"
+                logger.warning("warm-up step %s failed: %s", name, e)
+            self.seconds[name] = time.perf_counter() - start
+            STARTUP_SECONDS.labels(name).set(self.seconds[name])
+        self.ready = True
+        READY.set(1)
+        uptime = process_uptime()
+        if uptime is not None:
+            STARTUP_SECONDS.labels("ready").set(uptime)
+        logger.info("warm-up finished in %.3fs: %s", sum(self.seconds.values()), self.results)